@@ -0,0 +1,233 @@
+import os
+import io
+import sys
+import json
+import shutil
+import logging
+import platform
+import tempfile
+import contextlib
+from time import perf_counter, thread_time, strftime
+from statistics import median
+from collections import namedtuple
+
+# offline provisioning benchmarks, run from the repository root:
+#   python -m bench.run_bench [--out=bench_results.json] [--repeat=3] [--size-mb=32] [--files=2000] [--only=download,extract]
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if not repo_dir in sys.path:
+  sys.path.insert(0, repo_dir)
+
+from bench.stand_in_server import StandInServer, make_raw, make_zip, make_tar, iter_tree
+from setup import Main, SetupConfig, parse_argv
+from src.http_utils import new_session, size_session_pool, download_file, stream_to_buf, http_request
+from src.cache_utils import DownloadCache
+from src.path_utils import archive_extract_zip, archive_extract_tar, sync_tree, ensure_dir
+
+bench_result_t = namedtuple('BenchResult', ['group', 'name', 'params', 'repeat', 'bytes', 'wall_min', 'wall_median', 'cpu_median', 'cpu_sec_per_gb'])
+
+class NullWriter:
+  def write(self, b):
+    return len(b)
+
+def measure(group, name, fn, repeat=3, nbytes=0, params=None, before=None):
+  walls, cpus = list(), list()
+  for i in range(repeat):
+    if not before is None:
+      before()
+    with contextlib.redirect_stdout(io.StringIO()):
+      w0, c0 = perf_counter(), thread_time()
+      fn()
+      walls.append(perf_counter() - w0)
+      cpus.append(thread_time() - c0)
+  cpu_sec_per_gb = median(cpus) / (nbytes / 1e9) if nbytes > 0 else None
+  result = bench_result_t(group, name, params or {}, repeat, nbytes, min(walls), median(walls), median(cpus), cpu_sec_per_gb)
+  print('{:<10} {:<40} {:>9.04f}s {:>9.02f} MB/s {:>9} cpu s/GB'.format(
+    group, name, result.wall_min, nbytes / max(result.wall_min, 1e-9) / 1e6, '-' if cpu_sec_per_gb is None else '{:.02f}'.format(cpu_sec_per_gb)))
+  return result
+
+def reset_dir(path):
+  shutil.rmtree(path, True)
+  os.makedirs(path)
+
+def bench_download(server, workdir, size, repeat):
+  results = list()
+  session = size_session_pool(new_session(), 4)
+  server.add_file('raw.vpk', make_raw(size))
+  dst_dir = os.path.join(workdir, 'dl')
+  variants = [
+    ('default', {}),
+    ('no-head', {'head': 0}),
+    ('redirect-3', {}),
+    ('no-range', {'ranges': 0}),
+    ('no-validators', {'validators': 0}),
+    ('disposition-star', {'disposition': 'star'}),
+    ('disposition-none', {'disposition': 'none'}),
+  ]
+  for name, query in variants:
+    url = server.url('redirect/3/raw.vpk' if name == 'redirect-3' else 'raw.vpk', **query)
+    results.append(measure('download', 'download_file {}'.format(name), lambda: download_file(session, url, dst_dir), repeat, size, query, lambda: reset_dir(dst_dir)))
+
+  url = server.url('raw.vpk')
+  for head in ('auto', 'always'):
+    results.append(measure('download', 'download_file unchanged head={}'.format(head), lambda: download_file(session, url, dst_dir, head=head), repeat, 0, {'head': head}))
+
+  cache_dir = os.path.join(workdir, 'cache')
+  url = server.url('raw.vpk')
+  results.append(measure('download', 'download_file cache cold', lambda: download_file(session, url, None, cache=DownloadCache(cache_dir)), repeat, size, None, lambda: reset_dir(cache_dir)))
+  results.append(measure('download', 'download_file cache revalidate', lambda: download_file(session, url, None, cache=DownloadCache(cache_dir)), repeat, size))
+  results.append(measure('download', 'download_file segmented x4', lambda: download_file(session, url, dst_dir, segments=4), repeat, size, {'segments': 4}, lambda: reset_dir(dst_dir)))
+
+  for fast in (False, True):
+    for chunk_size in (4096, 1 << 16, 1 << 20):
+      def run():
+        resp = http_request(session, 'GET', url, stream=True, allow_redirects=False)
+        stream_to_buf(resp, NullWriter(), chunk_size=chunk_size, fast=fast)
+        resp.close()
+      results.append(measure('stream', 'stream_to_buf {} chunk {}'.format('fast' if fast else 'iter_content', chunk_size), run, repeat, size, {'chunk_size': chunk_size, 'fast': fast}))
+
+  stream_path = os.path.join(workdir, 'stream.bin')
+  for fast in (False, True):
+    def run():
+      resp = http_request(session, 'GET', url, stream=True, allow_redirects=False)
+      with open(stream_path, 'wb') as fh:
+        stream_to_buf(resp, fh, fast=fast)
+      resp.close()
+    results.append(measure('stream', 'stream_to_buf {} to file'.format('fast' if fast else 'iter_content'), run, repeat, size, {'fast': fast}))
+  session.close()
+  return results
+
+def bench_extract(workdir, n_files, file_size, repeat):
+  results = list()
+  nbytes = n_files * file_size
+  archives = {
+    'zip': (make_zip(n_files, file_size), archive_extract_zip),
+    'tar.gz': (make_tar(n_files, file_size, mode='w:gz'), archive_extract_tar),
+    'tar.xz': (make_tar(n_files, file_size, mode='w:xz'), archive_extract_tar),
+  }
+  dst_dir = os.path.join(workdir, 'extract')
+  for name, (data, extract) in archives.items():
+    path = os.path.join(workdir, 'archive.' + name)
+    with open(path, 'wb') as fh:
+      fh.write(data)
+    params = {'files': n_files, 'file_size': file_size, 'archive_size': len(data)}
+    results.append(measure('extract', '{} cold'.format(name), lambda: extract(path, dst_dir), repeat, nbytes, params, lambda: reset_dir(dst_dir)))
+    results.append(measure('extract', '{} unchanged'.format(name), lambda: extract(path, dst_dir), repeat, nbytes, params))
+  return results
+
+def bench_copy(workdir, n_files, file_size, repeat):
+  src_dir = os.path.join(workdir, 'tree')
+  reset_dir(src_dir)
+  for name, data in iter_tree(n_files, file_size):
+    path = os.path.join(src_dir, *name.split('/'))
+    ensure_dir(os.path.dirname(path))
+    with open(path, 'wb') as fh:
+      fh.write(data)
+  dst_dir = os.path.join(workdir, 'tree_copy')
+  params = {'files': n_files, 'file_size': file_size}
+  def copytree():
+    shutil.rmtree(dst_dir, True)
+    shutil.copytree(src_dir, dst_dir)
+  results = [measure('copy', 'shutil.copytree cold', copytree, repeat, n_files * file_size, params)]
+  for workers in (1, 4):
+    results += [
+      measure('copy', 'sync_tree x{} cold'.format(workers), lambda: sync_tree(src_dir, dst_dir, workers), repeat, n_files * file_size, dict(params, workers=workers), lambda: reset_dir(dst_dir)),
+      measure('copy', 'sync_tree x{} unchanged'.format(workers), lambda: sync_tree(src_dir, dst_dir, workers), repeat, n_files * file_size, dict(params, workers=workers)),
+    ]
+  return results
+
+def write_workspace(server, workdir, n_plugins, n_files, file_size):
+  server.add_file('sourcemod.zip', make_zip(n_files, file_size, 1), 'application/zip')
+  server.add_file('metamod.tar.gz', make_tar(n_files // 4, file_size, 2), 'application/x-gzip')
+  plugins = list()
+  for i in range(n_plugins):
+    name = 'plugin{:03d}.smx'.format(i)
+    server.add_file(name, make_raw(file_size * 8, i))
+    plugins.append({'name': 'plugin {}'.format(i), 'resources': [{'platform': '*', 'url': server.url(name, latency=0.02), 'extractPath': 'left4dead2/addons/sourcemod/plugins'}]})
+  steamapp_info = {
+    'compilerPresets': {},
+    'metaPlugins': [
+      {'name': 'sourcemod', 'resources': [{'platform': '*', 'url': server.url('sourcemod.zip'), 'extractPath': 'left4dead2'}]},
+      {'name': 'metamod', 'resources': [{'platform': '*', 'url': server.url('metamod.tar.gz'), 'extractPath': 'left4dead2'}]},
+    ],
+    'plugins': plugins,
+    'workshopIds': [],
+  }
+  with open(os.path.join(workdir, 'steamapp_info.json'), 'w') as fh:
+    json.dump(steamapp_info, fh)
+  with open(os.path.join(workdir, SetupConfig.config_file), 'w') as fh:
+    fh.write('[setup]\nplatform = linux\nworkers = 4\n\n[pipeline]\nmonitor-sec = 0\n\n[steamapp]\ninfo-json = steamapp_info.json\nparent-dir = {0}\napp-dir = {0}/app\n'.format(workdir))
+
+def bench_install(server, workdir, n_plugins, n_files, file_size, repeat):
+  write_workspace(server, workdir, n_plugins, n_files, file_size)
+  argv = sys.argv
+  sys.argv = [argv[0], '--force']
+
+  def run():
+    main = Main()
+    try:
+      main.prepare()
+      plugin_ents = list(main.iter_plugins())
+      main.install_plugins([p for p in plugin_ents if p.is_meta], 'meta_plugins')
+      main.install_plugins([p for p in plugin_ents if not p.is_meta], 'plugins')
+    finally:
+      main.exit()
+
+  def cold():
+    shutil.rmtree(os.path.join(workdir, 'app'), True)
+    shutil.rmtree(os.path.join(workdir, 'downloads'), True)
+
+  params = {'plugins': n_plugins, 'files': n_files, 'file_size': file_size}
+  try:
+    return [
+      measure('install', 'install_plugins cold', run, repeat, 0, params, cold),
+      measure('install', 'install_plugins warm', run, repeat, 0, params),
+    ]
+  finally:
+    sys.argv = argv
+
+def main():
+  args, opts = parse_argv(sys.argv[1:])
+  out_path = os.path.abspath(opts.get('out', 'bench_results.json'))
+  repeat = int(opts.get('repeat', 3))
+  size = int(float(opts.get('size-mb', 32)) * 1000 * 1000)
+  n_files = int(opts.get('files', 2000))
+  file_size = int(opts.get('file-size', 4096))
+  only = set(opts['only'].split(',')) if 'only' in opts else None
+
+  logging.disable(logging.INFO)
+  workdir = tempfile.mkdtemp(prefix='l4d2_sk_bench_')
+  cwd = os.getcwd()
+  os.chdir(workdir)
+  server = StandInServer().start()
+  results = list()
+  try:
+    if only is None or 'download' in only:
+      results += bench_download(server, workdir, size, repeat)
+    if only is None or 'extract' in only:
+      results += bench_extract(workdir, n_files, file_size, repeat)
+    if only is None or 'copy' in only:
+      results += bench_copy(workdir, n_files, file_size, repeat)
+    if only is None or 'install' in only:
+      results += bench_install(server, workdir, 16, n_files, file_size, repeat)
+  finally:
+    server.stop()
+    os.chdir(cwd)
+    shutil.rmtree(workdir, True)
+
+  report = {
+    'meta': {
+      'timestamp': strftime('%Y-%m-%dT%H:%M:%S%z'),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'cpu_count': os.cpu_count(),
+      'options': opts,
+    },
+    'results': [r._asdict() for r in results],
+  }
+  with open(out_path, 'w') as fh:
+    json.dump(report, fh, indent=1)
+  print('results written to {}'.format(out_path))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,193 @@
+import io
+import os
+import re
+import sys
+import time
+import random
+import tarfile
+import zipfile
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, quote
+
+# in-process origin standing in for alliedmods, sourcemod.net and the workshop mirror
+# per-request behaviour can be overridden with query parameters:
+#   latency=<sec> throttle=<bytes/sec> head=0 ranges=0 validators=0 disposition=none|plain|star
+# and /redirect/<n>/<name> answers with n chained 302s before serving <name>
+
+def make_raw(size, seed=0):
+  return random.Random(seed).randbytes(size) if hasattr(random.Random, 'randbytes') else os.urandom(size)
+
+def iter_tree(n_files, file_size, seed=0, depth=3):
+  rng = random.Random(seed)
+  for i in range(n_files):
+    sub = '/'.join('d{}'.format((i >> (4 * k)) % 16) for k in range(depth))
+    yield 'addons/sourcemod/{}/f{:05d}.bin'.format(sub, i), bytes(rng.getrandbits(8) for _ in range(min(file_size, 64))) * max(file_size // 64, 1)
+
+def make_zip(n_files, file_size, seed=0):
+  buf = io.BytesIO()
+  with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zh:
+    for name, data in iter_tree(n_files, file_size, seed):
+      zh.writestr(name, data)
+  return buf.getvalue()
+
+def make_tar(n_files, file_size, seed=0, mode='w:gz'):
+  buf = io.BytesIO()
+  with tarfile.open(fileobj=buf, mode=mode) as th:
+    for name, data in iter_tree(n_files, file_size, seed):
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      info.mtime = 1700000000
+      info.mode = 0o644
+      th.addfile(info, io.BytesIO(data))
+  return buf.getvalue()
+
+class StandInHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def option(self, query, name):
+    if name in query:
+      return query[name][0]
+    return self.server.options.get(name)
+
+  def respond_empty(self, code, headers=None):
+    self.send_response(code)
+    for k, v in (headers or {}).items():
+      self.send_header(k, v)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def handle_request(self, send_body):
+    r = urlparse(self.path)
+    query = parse_qs(r.query)
+    self.server.count('requests')
+    latency = float(self.option(query, 'latency') or 0)
+    if latency > 0:
+      time.sleep(latency)
+
+    m = re.match(r'^/redirect/(\d+)/(.+)$', r.path)
+    if m:
+      n = int(m.group(1))
+      location = '/{}'.format(m.group(2)) if n <= 1 else '/redirect/{}/{}'.format(n - 1, m.group(2))
+      if r.query:
+        location += '?' + r.query
+      self.server.count('redirects')
+      return self.respond_empty(302, {'Location': location})
+
+    name = r.path.lstrip('/')
+    data = self.server.files.get(name)
+    if data is None:
+      return self.respond_empty(404)
+    if not send_body and self.option(query, 'head') in ('0', 0, False):
+      self.server.count('head_rejected')
+      return self.respond_empty(405)
+
+    etag = '"{}"'.format(self.server.etags[name])
+    last_modified = formatdate(self.server.mtime, usegmt=True)
+    use_validators = not self.option(query, 'validators') in ('0', 0, False)
+    use_ranges = not self.option(query, 'ranges') in ('0', 0, False)
+    headers = dict()
+    if use_validators:
+      headers['ETag'] = etag
+      headers['Last-Modified'] = last_modified
+      if self.headers.get('If-None-Match') == etag or (self.headers.get('If-Modified-Since') == last_modified and not self.headers.get('If-None-Match')):
+        self.server.count('not_modified')
+        return self.respond_empty(304, headers)
+    disposition = self.option(query, 'disposition') or 'plain'
+    if disposition == 'plain':
+      headers['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(name))
+    elif disposition == 'star':
+      headers['Content-Disposition'] = "attachment; filename*=UTF-8''{}".format(quote(os.path.basename(name)))
+    if use_ranges:
+      headers['Accept-Ranges'] = 'bytes'
+
+    start, end = 0, len(data) - 1
+    code = 200
+    rng = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+    if use_ranges and rng and self.headers.get('If-Range', etag) in (etag, last_modified):
+      start = int(rng.group(1))
+      end = int(rng.group(2)) if rng.group(2) else end
+      code = 206
+      headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, len(data))
+      self.server.count('ranges')
+
+    self.send_response(code)
+    for k, v in headers.items():
+      self.send_header(k, v)
+    self.send_header('Content-Type', self.server.content_types.get(name, 'application/octet-stream'))
+    self.send_header('Content-Length', str(end - start + 1))
+    self.end_headers()
+    if send_body:
+      self.send_body(memoryview(data)[start:end + 1], float(self.option(query, 'throttle') or 0))
+
+  def send_body(self, view, throttle):
+    block = 1 << 16
+    t0 = time.perf_counter()
+    try:
+      for pos in range(0, len(view), block):
+        self.wfile.write(view[pos:pos + block])
+        if throttle > 0:
+          ahead = (pos + block) / throttle - (time.perf_counter() - t0)
+          if ahead > 0:
+            time.sleep(ahead)
+    except (BrokenPipeError, ConnectionResetError):
+      # clients close early on purpose, e.g. after reading headers only
+      self.server.count('aborted')
+      self.close_connection = True
+      return
+    self.server.count('bytes_sent', len(view))
+
+  def do_HEAD(self):
+    self.handle_request(False)
+
+  def do_GET(self):
+    self.handle_request(True)
+
+class StandInServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, host='127.0.0.1', port=0, **options):
+    super().__init__((host, port), StandInHandler)
+    self.options = options
+    self.files = dict()
+    self.etags = dict()
+    self.content_types = dict()
+    self.mtime = 1700000000
+    self.stats = dict()
+    self._lock = threading.Lock()
+    self._thread = None
+
+  def handle_error(self, request, client_address):
+    # clients closing a keep-alive connection after an early close are expected
+    if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+      return
+    super().handle_error(request, client_address)
+
+  def count(self, key, n=1):
+    with self._lock:
+      self.stats[key] = self.stats.get(key, 0) + n
+
+  def add_file(self, name, data, content_type='application/octet-stream'):
+    self.files[name] = data
+    self.etags[name] = '{:x}-{:x}'.format(len(data), hash(data[:4096]) & 0xffffffff)
+    self.content_types[name] = content_type
+    return self.url(name)
+
+  def url(self, name, **query):
+    base = 'http://{}:{}/{}'.format(self.server_address[0], self.server_address[1], name)
+    if query:
+      base += '?' + '&'.join('{}={}'.format(k, v) for k, v in query.items())
+    return base
+
+  def start(self):
+    self._thread = threading.Thread(target=self.serve_forever, name='stand_in_server', daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
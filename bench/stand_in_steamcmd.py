@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import random
+
+# stands in for steamcmd when running the steamcmd workshop backend without steam,
+# point [workshop] steamcmd-path at this file (it has to stay executable)
+# understands +runscript <file> and the commands the backend writes, behaviour is set through the environment:
+#   STAND_IN_STEAMCMD_FAIL=<id>,<id>  items that report a download error
+#   STAND_IN_STEAMCMD_SKIP=<id>,<id>  items that report nothing at all
+#   STAND_IN_STEAMCMD_SIZE=<bytes>    size of each fake vpk (default 65536)
+#   STAND_IN_STEAMCMD_DELAY=<sec>     time spent per item (default 0)
+#   STAND_IN_STEAMCMD_LOGIN=fail      the login is refused and every item fails
+
+def env_ids(name):
+  return set(filter(None, os.environ.get(name, '').split(',')))
+
+def read_commands(argv):
+  commands = list()
+  i = 0
+  while i < len(argv):
+    if argv[i] == '+runscript' and i + 1 < len(argv):
+      with open(argv[i + 1], 'r') as fh:
+        commands += [line.strip() for line in fh if line.strip() and not line.startswith('@')]
+      i += 2
+    elif argv[i].startswith('+'):
+      args = list()
+      i += 1
+      while i < len(argv) and not argv[i].startswith('+'):
+        args.append(argv[i])
+        i += 1
+      commands.append(' '.join(args))
+    else:
+      i += 1
+  return commands
+
+def main():
+  fail_ids, skip_ids = env_ids('STAND_IN_STEAMCMD_FAIL'), env_ids('STAND_IN_STEAMCMD_SKIP')
+  size = int(os.environ.get('STAND_IN_STEAMCMD_SIZE', 1 << 16))
+  delay = float(os.environ.get('STAND_IN_STEAMCMD_DELAY', 0))
+  install_dir = os.getcwd()
+  logged_in = False
+  print('Redirecting stderr to \'{}\''.format(os.path.join(install_dir, 'logs', 'stderr.txt')))
+  print('[  0%] Checking for available updates...')
+  print('[----] Verifying installation...')
+  print('Steam Console Client (c) Valve Corporation - version 1700000000')
+  for command in read_commands(sys.argv[1:]):
+    name, _, args = command.partition(' ')
+    args = args.split()
+    if name == 'force_install_dir':
+      install_dir = ' '.join(args).strip('"')
+    elif name == 'login':
+      user = args[0] if args else 'anonymous'
+      print('Logging in user \'{}\' to Steam Public...'.format(user), end='')
+      if os.environ.get('STAND_IN_STEAMCMD_LOGIN') == 'fail':
+        print('FAILED (Invalid Password)')
+      else:
+        logged_in = True
+        print('OK')
+      print('Waiting for user info...OK')
+    elif name == 'workshop_download_item':
+      app_id, workshop_id = args[0], args[1]
+      print('Downloading item {} ...'.format(workshop_id))
+      sys.stdout.flush()
+      time.sleep(delay)
+      if workshop_id in skip_ids:
+        continue
+      if not logged_in or workshop_id in fail_ids:
+        print('ERROR! Download item {} failed ({}).'.format(workshop_id, 'No Connection' if not logged_in else 'Failure'))
+        continue
+      item_dir = os.path.join(install_dir, 'steamapps', 'workshop', 'content', app_id, workshop_id)
+      os.makedirs(item_dir, exist_ok=True)
+      data = random.Random(int(workshop_id)).randbytes(size) if hasattr(random.Random, 'randbytes') else os.urandom(size)
+      # steam stages downloads and swaps the finished file in, the stand-in does the same
+      tmp_path = os.path.join(item_dir, '.{}.tmp'.format(workshop_id))
+      with open(tmp_path, 'wb') as fh:
+        fh.write(data)
+      os.replace(tmp_path, os.path.join(item_dir, '{}_legacy.bin'.format(workshop_id)))
+      print('Success. Downloaded item {} to "{}" ({} bytes) '.format(workshop_id, item_dir, size))
+    elif name == 'quit':
+      break
+    sys.stdout.flush()
+  print('Unloading Steam API...OK')
+  return 0 if logged_in else 5
+
+if __name__ == '__main__':
+  sys.exit(main())
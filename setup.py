@@ -1,26 +1,104 @@
 import sys
 import traceback
-import json
 import os.path
 import configparser
-import subprocess
-import glob
-from requests import Session
+import shutil
+import signal
+import threading
+from time import time
 from itertools import chain
 from collections import namedtuple
-from src.log import init_logger
-from src.path_utils import ensure_dir, mkdtemp, archive_extract_tar, archive_extract_zip, copy2, delete_file, isfile, copy2_r, rmtree_d
-from src.http_utils import download_file, http_request
+from src.log import init_logger, configure_logging, progress
+from src.path_utils import ensure_dir, mkdtemp, archive_kind, archive_extract_tar, archive_extract_tar_stream, archive_extract_zip, spool_file, write_atomic, sync_file, isfile, extract_stats_t
+from src.pool_utils import HostLimiter, run_ordered, url_host
+from src.metrics_utils import metrics
+from src.throttle_utils import throttle
+from src.cache_utils import DownloadCache, HostCapabilities
+from src.state_utils import InstallState, fingerprint
+from src.plan_utils import PlanCache
+from src.steamcmd_utils import SteamcmdWorkshop, default_steamcmd_path
+from src.pipeline_utils import Pipeline
+from src.fleet_utils import materialize, split_patterns
+from src.compile_utils import CompileEngine, compile_job_t, compile_preset_t, discover_sources, log_compile_report
 
 logger = init_logger('setup', 'setup.log')
 pwd = os.path.dirname(__file__)
 
+def import_runtime():
+  # requests and everything built on it load only once a command needs the network, plan and --dry-run never do
+  global Session, download_file, size_session_pool, stream_response, retry_utils, RetryPolicy, CircuitBreaker, WorkshopResolver
+  global Mirror, write_bundle_info, prune_bundle, archive_bundle, BlobManifests, verify_tree, repair_files, StreamReadError
+  from requests import Session
+  from src.http_utils import download_file, size_session_pool, stream_response
+  from src import retry_utils
+  from src.retry_utils import RetryPolicy, CircuitBreaker, StreamReadError
+  from src.workshop_utils import WorkshopResolver
+  from src.mirror_utils import Mirror, write_bundle_info, prune_bundle, archive_bundle
+  from src.verify_utils import BlobManifests, verify_tree, repair_files
+
+def parse_argv(argv):
+  args = list()
+  opts = dict()
+  for arg in argv:
+    if arg.startswith('--'):
+      key, sep, value = arg[2:].partition('=')
+      opts[key] = value if sep else True
+    else:
+      args.append(arg)
+  return args, opts
+
 class SetupConfig:
   config_file = 'setup_config.ini'
   platform = 'windows'
   steamapp_info_path = 'steamapp_info.json'
   steamapp_parent_dir = '/steamcmd'
   steamapp_app_dir = '/steamcmd/l4d2'
+  workers = 1
+  host_concurrency = 4
+  cache_max_size_mb = 4096
+  download_segments = 1
+  download_segment_threshold_mb = 64
+  download_head = 'auto'
+  download_spool_max_mb = 64
+  download_mirror = ''
+  http_max_retry = 3
+  http_backoff_base_sec = 0.5
+  http_backoff_max_sec = 30.0
+  http_retry_after_max_sec = 120.0
+  http_connect_timeout_sec = 10.0
+  http_read_timeout_sec = 60.0
+  http_breaker_threshold = 5
+  http_breaker_cooldown_sec = 60.0
+  throttle_net_kbps = 0
+  throttle_host_kbps = 0
+  throttle_disk_kbps = 0
+  workshop_metadata_ttl_sec = 3600
+  workshop_batch_size = 100
+  workshop_backend = 'http'
+  workshop_steamcmd_path = ''
+  workshop_steamcmd_login = 'anonymous'
+  workshop_steamcmd_export = 'hardlink'
+  workshop_steamcmd_timeout_sec = 3600.0
+  pipeline_download_workers = 0
+  pipeline_extract_workers = 2
+  pipeline_compile_workers = 0
+  pipeline_queue_size = 4
+  pipeline_monitor_sec = 10
+  sync_workers = 4
+  sync_hash_check = False
+  verify_workers = 0
+  reconcile_poll_sec = 2.0
+  reconcile_debounce_sec = 2.0
+  fleet_store_dir = '/steamcmd/l4d2_store'
+  fleet_instances = ''
+  fleet_link_mode = 'hardlink'
+  fleet_copy_patterns = 'left4dead2/cfg/*, left4dead2/addons/sourcemod/configs/*, left4dead2/addons/sourcemod/data/*'
+  fleet_symlink_patterns = ''
+  metrics_jsonl_path = 'log/metrics.jsonl'
+  metrics_prom_path = ''
+  logging_file_format = 'text'
+  logging_stdout_level = 'debug'
+  logging_progress_sec = 5.0
 
   @classmethod
   def get_app_path(cls, *tails):
@@ -37,6 +115,122 @@ class SetupConfig:
       parser['setup'] = {}
     if not 'platform' in parser['setup']:
       parser['setup']['platform'] = cls.platform
+    if not 'workers' in parser['setup']:
+      parser['setup']['workers'] = str(cls.workers)
+    if not 'host-concurrency' in parser['setup']:
+      parser['setup']['host-concurrency'] = str(cls.host_concurrency)
+    if not 'cache' in parser:
+      parser['cache'] = {}
+    if not 'max-size-mb' in parser['cache']:
+      parser['cache']['max-size-mb'] = str(cls.cache_max_size_mb)
+    if not 'download' in parser:
+      parser['download'] = {}
+    if not 'segments' in parser['download']:
+      parser['download']['segments'] = str(cls.download_segments)
+    if not 'segment-threshold-mb' in parser['download']:
+      parser['download']['segment-threshold-mb'] = str(cls.download_segment_threshold_mb)
+    if not 'head' in parser['download']:
+      parser['download']['head'] = cls.download_head
+    if not 'spool-max-mb' in parser['download']:
+      parser['download']['spool-max-mb'] = str(cls.download_spool_max_mb)
+    if not 'mirror' in parser['download']:
+      parser['download']['mirror'] = cls.download_mirror
+    if not 'http' in parser:
+      parser['http'] = {}
+    if not 'max-retry' in parser['http']:
+      parser['http']['max-retry'] = str(cls.http_max_retry)
+    if not 'backoff-base-sec' in parser['http']:
+      parser['http']['backoff-base-sec'] = str(cls.http_backoff_base_sec)
+    if not 'backoff-max-sec' in parser['http']:
+      parser['http']['backoff-max-sec'] = str(cls.http_backoff_max_sec)
+    if not 'retry-after-max-sec' in parser['http']:
+      parser['http']['retry-after-max-sec'] = str(cls.http_retry_after_max_sec)
+    if not 'connect-timeout-sec' in parser['http']:
+      parser['http']['connect-timeout-sec'] = str(cls.http_connect_timeout_sec)
+    if not 'read-timeout-sec' in parser['http']:
+      parser['http']['read-timeout-sec'] = str(cls.http_read_timeout_sec)
+    if not 'breaker-threshold' in parser['http']:
+      parser['http']['breaker-threshold'] = str(cls.http_breaker_threshold)
+    if not 'breaker-cooldown-sec' in parser['http']:
+      parser['http']['breaker-cooldown-sec'] = str(cls.http_breaker_cooldown_sec)
+    if not 'throttle' in parser:
+      parser['throttle'] = {}
+    if not 'net-kbps' in parser['throttle']:
+      parser['throttle']['net-kbps'] = str(cls.throttle_net_kbps)
+    if not 'host-kbps' in parser['throttle']:
+      parser['throttle']['host-kbps'] = str(cls.throttle_host_kbps)
+    if not 'disk-kbps' in parser['throttle']:
+      parser['throttle']['disk-kbps'] = str(cls.throttle_disk_kbps)
+    if not 'workshop' in parser:
+      parser['workshop'] = {}
+    if not 'metadata-ttl-sec' in parser['workshop']:
+      parser['workshop']['metadata-ttl-sec'] = str(cls.workshop_metadata_ttl_sec)
+    if not 'batch-size' in parser['workshop']:
+      parser['workshop']['batch-size'] = str(cls.workshop_batch_size)
+    if not 'backend' in parser['workshop']:
+      parser['workshop']['backend'] = cls.workshop_backend
+    if not 'steamcmd-path' in parser['workshop']:
+      parser['workshop']['steamcmd-path'] = cls.workshop_steamcmd_path
+    if not 'steamcmd-login' in parser['workshop']:
+      parser['workshop']['steamcmd-login'] = cls.workshop_steamcmd_login
+    if not 'steamcmd-export' in parser['workshop']:
+      parser['workshop']['steamcmd-export'] = cls.workshop_steamcmd_export
+    if not 'steamcmd-timeout-sec' in parser['workshop']:
+      parser['workshop']['steamcmd-timeout-sec'] = str(cls.workshop_steamcmd_timeout_sec)
+    if not 'pipeline' in parser:
+      parser['pipeline'] = {}
+    if not 'download-workers' in parser['pipeline']:
+      parser['pipeline']['download-workers'] = str(cls.pipeline_download_workers)
+    if not 'extract-workers' in parser['pipeline']:
+      parser['pipeline']['extract-workers'] = str(cls.pipeline_extract_workers)
+    if not 'compile-workers' in parser['pipeline']:
+      parser['pipeline']['compile-workers'] = str(cls.pipeline_compile_workers)
+    if not 'queue-size' in parser['pipeline']:
+      parser['pipeline']['queue-size'] = str(cls.pipeline_queue_size)
+    if not 'monitor-sec' in parser['pipeline']:
+      parser['pipeline']['monitor-sec'] = str(cls.pipeline_monitor_sec)
+    if not 'sync' in parser:
+      parser['sync'] = {}
+    if not 'workers' in parser['sync']:
+      parser['sync']['workers'] = str(cls.sync_workers)
+    if not 'hash-check' in parser['sync']:
+      parser['sync']['hash-check'] = 'yes' if cls.sync_hash_check else 'no'
+    if not 'verify' in parser:
+      parser['verify'] = {}
+    if not 'workers' in parser['verify']:
+      parser['verify']['workers'] = str(cls.verify_workers)
+    if not 'reconcile' in parser:
+      parser['reconcile'] = {}
+    if not 'poll-sec' in parser['reconcile']:
+      parser['reconcile']['poll-sec'] = str(cls.reconcile_poll_sec)
+    if not 'debounce-sec' in parser['reconcile']:
+      parser['reconcile']['debounce-sec'] = str(cls.reconcile_debounce_sec)
+    if not 'fleet' in parser:
+      parser['fleet'] = {}
+    if not 'store-dir' in parser['fleet']:
+      parser['fleet']['store-dir'] = cls.fleet_store_dir
+    if not 'instances' in parser['fleet']:
+      parser['fleet']['instances'] = cls.fleet_instances
+    if not 'link-mode' in parser['fleet']:
+      parser['fleet']['link-mode'] = cls.fleet_link_mode
+    if not 'copy-patterns' in parser['fleet']:
+      parser['fleet']['copy-patterns'] = cls.fleet_copy_patterns
+    if not 'symlink-patterns' in parser['fleet']:
+      parser['fleet']['symlink-patterns'] = cls.fleet_symlink_patterns
+    if not 'metrics' in parser:
+      parser['metrics'] = {}
+    if not 'jsonl-path' in parser['metrics']:
+      parser['metrics']['jsonl-path'] = cls.metrics_jsonl_path
+    if not 'prom-path' in parser['metrics']:
+      parser['metrics']['prom-path'] = cls.metrics_prom_path
+    if not 'logging' in parser:
+      parser['logging'] = {}
+    if not 'file-format' in parser['logging']:
+      parser['logging']['file-format'] = cls.logging_file_format
+    if not 'stdout-level' in parser['logging']:
+      parser['logging']['stdout-level'] = cls.logging_stdout_level
+    if not 'progress-sec' in parser['logging']:
+      parser['logging']['progress-sec'] = str(cls.logging_progress_sec)
     if not 'steamapp' in parser:
       parser['steamapp'] = {}
     if not 'info-json' in parser['steamapp']:
@@ -47,16 +241,130 @@ class SetupConfig:
       parser['steamapp']['app-dir'] = cls.steamapp_parent_dir
 
     cls.platform = parser['setup']['platform']
+    cls.workers = parser['setup'].getint('workers')
+    cls.host_concurrency = parser['setup'].getint('host-concurrency')
+    cls.cache_max_size_mb = parser['cache'].getint('max-size-mb')
+    cls.download_segments = parser['download'].getint('segments')
+    cls.download_segment_threshold_mb = parser['download'].getint('segment-threshold-mb')
+    cls.download_head = parser['download']['head']
+    cls.download_spool_max_mb = parser['download'].getint('spool-max-mb')
+    cls.download_mirror = parser['download']['mirror']
+    cls.http_max_retry = parser['http'].getint('max-retry')
+    cls.http_backoff_base_sec = parser['http'].getfloat('backoff-base-sec')
+    cls.http_backoff_max_sec = parser['http'].getfloat('backoff-max-sec')
+    cls.http_retry_after_max_sec = parser['http'].getfloat('retry-after-max-sec')
+    cls.http_connect_timeout_sec = parser['http'].getfloat('connect-timeout-sec')
+    cls.http_read_timeout_sec = parser['http'].getfloat('read-timeout-sec')
+    cls.http_breaker_threshold = parser['http'].getint('breaker-threshold')
+    cls.http_breaker_cooldown_sec = parser['http'].getfloat('breaker-cooldown-sec')
+    cls.throttle_net_kbps = parser['throttle'].getint('net-kbps')
+    cls.throttle_host_kbps = parser['throttle'].getint('host-kbps')
+    cls.throttle_disk_kbps = parser['throttle'].getint('disk-kbps')
+    cls.workshop_metadata_ttl_sec = parser['workshop'].getint('metadata-ttl-sec')
+    cls.workshop_batch_size = parser['workshop'].getint('batch-size')
+    cls.workshop_backend = parser['workshop']['backend']
+    cls.workshop_steamcmd_path = parser['workshop']['steamcmd-path']
+    cls.workshop_steamcmd_login = parser['workshop']['steamcmd-login']
+    cls.workshop_steamcmd_export = parser['workshop']['steamcmd-export']
+    cls.workshop_steamcmd_timeout_sec = parser['workshop'].getfloat('steamcmd-timeout-sec')
+    cls.pipeline_download_workers = parser['pipeline'].getint('download-workers')
+    cls.pipeline_extract_workers = parser['pipeline'].getint('extract-workers')
+    cls.pipeline_compile_workers = parser['pipeline'].getint('compile-workers')
+    cls.pipeline_queue_size = parser['pipeline'].getint('queue-size')
+    cls.pipeline_monitor_sec = parser['pipeline'].getint('monitor-sec')
+    cls.sync_workers = parser['sync'].getint('workers')
+    cls.sync_hash_check = parser['sync'].getboolean('hash-check')
+    cls.verify_workers = parser['verify'].getint('workers')
+    cls.reconcile_poll_sec = parser['reconcile'].getfloat('poll-sec')
+    cls.reconcile_debounce_sec = parser['reconcile'].getfloat('debounce-sec')
+    cls.fleet_store_dir = parser['fleet']['store-dir']
+    cls.fleet_instances = parser['fleet']['instances']
+    cls.fleet_link_mode = parser['fleet']['link-mode']
+    cls.fleet_copy_patterns = parser['fleet']['copy-patterns']
+    cls.fleet_symlink_patterns = parser['fleet']['symlink-patterns']
+    cls.metrics_jsonl_path = parser['metrics']['jsonl-path']
+    cls.metrics_prom_path = parser['metrics']['prom-path']
+    cls.logging_file_format = parser['logging']['file-format']
+    cls.logging_stdout_level = parser['logging']['stdout-level']
+    cls.logging_progress_sec = parser['logging'].getfloat('progress-sec')
     cls.steamapp_info_path = parser['steamapp']['info-json']
     cls.steamapp_parent_dir = parser['steamapp']['parent-dir']
     cls.steamapp_app_dir = parser['steamapp']['app-dir']
 
+  @classmethod
+  def load_throttle_config(cls):
+    # rereads only the throttle limits, safe while downloads are running
+    parser = configparser.ConfigParser()
+    with open(cls.config_file) as fh:
+      parser.read_file(fh)
+    cls.throttle_net_kbps = parser.getint('throttle', 'net-kbps', fallback=0)
+    cls.throttle_host_kbps = parser.getint('throttle', 'host-kbps', fallback=0)
+    cls.throttle_disk_kbps = parser.getint('throttle', 'disk-kbps', fallback=0)
+
   @classmethod
   def save_config(cls):
     logger.info('saving config file: {}'.format(cls.config_file))
     parser = configparser.ConfigParser()
     parser['setup'] = {}
     parser['setup']['platform'] = cls.platform
+    parser['setup']['workers'] = str(cls.workers)
+    parser['setup']['host-concurrency'] = str(cls.host_concurrency)
+    parser['cache'] = {}
+    parser['cache']['max-size-mb'] = str(cls.cache_max_size_mb)
+    parser['download'] = {}
+    parser['download']['segments'] = str(cls.download_segments)
+    parser['download']['segment-threshold-mb'] = str(cls.download_segment_threshold_mb)
+    parser['download']['head'] = cls.download_head
+    parser['download']['spool-max-mb'] = str(cls.download_spool_max_mb)
+    parser['download']['mirror'] = cls.download_mirror
+    parser['http'] = {}
+    parser['http']['max-retry'] = str(cls.http_max_retry)
+    parser['http']['backoff-base-sec'] = str(cls.http_backoff_base_sec)
+    parser['http']['backoff-max-sec'] = str(cls.http_backoff_max_sec)
+    parser['http']['retry-after-max-sec'] = str(cls.http_retry_after_max_sec)
+    parser['http']['connect-timeout-sec'] = str(cls.http_connect_timeout_sec)
+    parser['http']['read-timeout-sec'] = str(cls.http_read_timeout_sec)
+    parser['http']['breaker-threshold'] = str(cls.http_breaker_threshold)
+    parser['http']['breaker-cooldown-sec'] = str(cls.http_breaker_cooldown_sec)
+    parser['throttle'] = {}
+    parser['throttle']['net-kbps'] = str(cls.throttle_net_kbps)
+    parser['throttle']['host-kbps'] = str(cls.throttle_host_kbps)
+    parser['throttle']['disk-kbps'] = str(cls.throttle_disk_kbps)
+    parser['workshop'] = {}
+    parser['workshop']['metadata-ttl-sec'] = str(cls.workshop_metadata_ttl_sec)
+    parser['workshop']['batch-size'] = str(cls.workshop_batch_size)
+    parser['workshop']['backend'] = cls.workshop_backend
+    parser['workshop']['steamcmd-path'] = cls.workshop_steamcmd_path
+    parser['workshop']['steamcmd-login'] = cls.workshop_steamcmd_login
+    parser['workshop']['steamcmd-export'] = cls.workshop_steamcmd_export
+    parser['workshop']['steamcmd-timeout-sec'] = str(cls.workshop_steamcmd_timeout_sec)
+    parser['pipeline'] = {}
+    parser['pipeline']['download-workers'] = str(cls.pipeline_download_workers)
+    parser['pipeline']['extract-workers'] = str(cls.pipeline_extract_workers)
+    parser['pipeline']['compile-workers'] = str(cls.pipeline_compile_workers)
+    parser['pipeline']['queue-size'] = str(cls.pipeline_queue_size)
+    parser['pipeline']['monitor-sec'] = str(cls.pipeline_monitor_sec)
+    parser['sync'] = {}
+    parser['sync']['workers'] = str(cls.sync_workers)
+    parser['sync']['hash-check'] = 'yes' if cls.sync_hash_check else 'no'
+    parser['verify'] = {}
+    parser['verify']['workers'] = str(cls.verify_workers)
+    parser['reconcile'] = {}
+    parser['reconcile']['poll-sec'] = str(cls.reconcile_poll_sec)
+    parser['reconcile']['debounce-sec'] = str(cls.reconcile_debounce_sec)
+    parser['fleet'] = {}
+    parser['fleet']['store-dir'] = cls.fleet_store_dir
+    parser['fleet']['instances'] = cls.fleet_instances
+    parser['fleet']['link-mode'] = cls.fleet_link_mode
+    parser['fleet']['copy-patterns'] = cls.fleet_copy_patterns
+    parser['fleet']['symlink-patterns'] = cls.fleet_symlink_patterns
+    parser['metrics'] = {}
+    parser['metrics']['jsonl-path'] = cls.metrics_jsonl_path
+    parser['metrics']['prom-path'] = cls.metrics_prom_path
+    parser['logging'] = {}
+    parser['logging']['file-format'] = cls.logging_file_format
+    parser['logging']['stdout-level'] = cls.logging_stdout_level
+    parser['logging']['progress-sec'] = str(cls.logging_progress_sec)
     parser['steamapp'] = {}
     parser['steamapp']['info-json'] = cls.steamapp_info_path
     parser['steamapp']['parent-dir'] = cls.steamapp_parent_dir
@@ -65,79 +373,144 @@ class SetupConfig:
 
 class Main:
   downloads_dir = './downloads'
-  plugin_t = namedtuple('PluginEnt', ['name', 'resources', 'disable_cache'])
-  resource_t = namedtuple('ResourceEnt', ['url', 'extract_path', 'disable_cache', 'do_compile', 'compiler_preset_name'])
-  workshop_t = namedtuple('WorkshopEnt', ['workshop_id', 'name', 'rel'])
+  resource_job_t = namedtuple('ResourceJob', ['plugin_job', 'resource_ent'])
   setup_config = SetupConfig
+  request_headers = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36',
+  }
   
   def __init__(self):
+    # only what planning needs is set up here, init_runtime adds the session, tempdir and metrics for commands that install
     self.atexit_callback = list()
+    self.session = None
+    self.argv, self.argv_opts = parse_argv(sys.argv[1:])
+    self.setup_config.load_config()
+    self.atexit_callback.append(self.setup_config.save_config)
+    configure_logging(self.setup_config.logging_file_format, self.setup_config.logging_stdout_level.upper())
+    progress.interval = self.setup_config.logging_progress_sec
+    self.plan_cache = PlanCache(os.path.join(self.downloads_dir, 'plans'))
+    self.plan = None
+    self.plugin_jobs_lock = threading.Lock()
+    self.pipeline = None
+    self.session_pool_size = 0
+    self.download_opts = {'host_caps': None}
+    self.cache = None
+    self.host_caps = None
+    self.install_state = None
+    self.compile_engine = None
+    self.compile_results = list()
+    self.workshop_resolver = None
+    self.steamcmd = None
+    self.mirror = None
+
+  def init_runtime(self):
+    if not self.session is None:
+      return
+    import_runtime()
     self.session = Session()
+    self.session.headers.update(self.request_headers)
     self.atexit_callback.append(self.session.close)
     self.tempdir, d_tempdir = mkdtemp()
     self.atexit_callback.append(d_tempdir)
-    self.steamapp_info = dict()
-    self.setup_config.load_config()
-    self.atexit_callback.append(self.setup_config.save_config)
+    metrics.open(self.setup_config.metrics_jsonl_path, self.setup_config.metrics_prom_path)
+    self.atexit_callback.append(metrics.close)
+    self.apply_config()
 
-  def load_steamapp_info(self, json_path):
-    if isfile(json_path):
-      with open(json_path, 'r') as fh:
-        self.steamapp_info.update(json.load(fh))
-        return True
-    logger.error('cannot load json: {}'.format(json_path))
-    return False
+  def apply_config(self):
+    # everything derived from setup_config, rerun by reconcile when setup_config.ini changes
+    retry_utils.default_policy = RetryPolicy(
+      self.setup_config.http_max_retry, self.setup_config.http_backoff_base_sec, self.setup_config.http_backoff_max_sec,
+      self.setup_config.http_connect_timeout_sec, self.setup_config.http_read_timeout_sec, self.setup_config.http_retry_after_max_sec)
+    retry_utils.breaker = CircuitBreaker(self.setup_config.http_breaker_threshold, self.setup_config.http_breaker_cooldown_sec)
+    self.apply_throttle()
+    if 'workers' in self.argv_opts:
+      self.setup_config.workers = int(self.argv_opts['workers'])
+    self.workers = max(self.setup_config.workers, 1)
+    self.host_limiter = HostLimiter(self.setup_config.host_concurrency if max(self.workers, self.setup_config.pipeline_download_workers) > 1 else 0)
+    if 'segments' in self.argv_opts:
+      self.setup_config.download_segments = int(self.argv_opts['segments'])
+    if self.setup_config.download_mirror != (self.mirror.base if not self.mirror is None else ''):
+      self.mirror = Mirror(self.session, self.setup_config.download_mirror) if self.setup_config.download_mirror else None
+    self.download_opts = {
+      'host_limiter': self.host_limiter,
+      'segments': max(self.setup_config.download_segments, 1),
+      'segment_threshold': self.setup_config.download_segment_threshold_mb * 1000 * 1000,
+      'head': self.setup_config.download_head,
+      'host_caps': self.download_opts['host_caps'],
+      'mirror': self.mirror,
+    }
+    # remounting the adapters would drop warm connections, so the pool is only resized when it changes
+    if self.session_pool_size != self.workers * self.download_opts['segments']:
+      self.session_pool_size = self.workers * self.download_opts['segments']
+      size_session_pool(self.session, self.session_pool_size)
+    self.pipeline_opts = {
+      'download_workers': self.setup_config.pipeline_download_workers or self.workers,
+      'extract_workers': self.setup_config.pipeline_extract_workers,
+      'compile_workers': self.setup_config.pipeline_compile_workers or os.cpu_count() or 1,
+      'queue_size': self.setup_config.pipeline_queue_size,
+      'monitor_sec': self.setup_config.pipeline_monitor_sec,
+    }
+    self.sync_opts = {
+      'workers': max(self.setup_config.sync_workers, 1),
+      'hash_check': self.setup_config.sync_hash_check,
+    }
+    if not self.compile_engine is None:
+      self.compile_engine.sync_opts = self.sync_opts
 
-  @classmethod
-  def _iter_plugins(cls, d):
-    meta_plugins = d.get('metaPlugins', list())
-    plugins = d.get('plugins', list())
-    for plugin in chain(meta_plugins, plugins):
-      plugin_name = plugin.get('name')
-      if plugin_name is None or not plugin_name:
-        continue
-      plugin_exclude = plugin.get('exclude', False)
-      if plugin_exclude:
-        continue
-      plugin_extract_path = plugin.get('extractPath', '')
-      plugin_resources = plugin.get('resources', [])
-      plugin_disable_cache = plugin.get('disableCache', False)
-      yield cls.plugin_t(plugin_name, cls._iter_resources(plugin_resources), plugin_disable_cache)
+  def apply_throttle(self):
+    throttle.configure(self.setup_config.throttle_net_kbps * 1000, self.setup_config.throttle_host_kbps * 1000, self.setup_config.throttle_disk_kbps * 1000)
 
-  @classmethod
-  def _iter_resources(cls, l):
-    for resource in l:
-      resource_exclude = resource.get('exclude', False)
-      if resource_exclude:
-        continue
-      resource_platform = resource.get('platform', cls.setup_config.platform)
-      if not (resource_platform == cls.setup_config.platform or resource_platform == '*'):
-        continue 
-      resource_disable_cache = resource.get('disableCache', False)
-      resource_extract_path = resource.get('extractPath', '')
-      resource_url = resource.get('url')
-      resource_do_compile = resource.get('doCompile', False)
-      resource_compiler_preset_name = resource.get('compilerPresetName')
-      yield cls.resource_t(resource_url, resource_extract_path, resource_disable_cache, resource_do_compile, resource_compiler_preset_name)
+  def watch_throttle(self):
+    # limits edited in setup_config.ini take effect within poll-sec, without restarting a long install
+    stop = threading.Event()
+    self.atexit_callback.append(stop.set)
+    def watch():
+      signature = self.file_signature(self.setup_config.config_file)
+      while not stop.wait(self.setup_config.reconcile_poll_sec):
+        if self.file_signature(self.setup_config.config_file) == signature:
+          continue
+        signature = self.file_signature(self.setup_config.config_file)
+        try:
+          self.setup_config.load_throttle_config()
+        except (OSError, ValueError, configparser.Error) as e:
+          logger.warning('cannot reload throttle limits: {}'.format(e))
+          continue
+        self.apply_throttle()
+    threading.Thread(target=watch, name='throttle-watch', daemon=True).start()
 
-  def iter_plugins(self):
-    yield from self._iter_plugins(self.steamapp_info)
+  def load_plan(self):
+    return self.plan_cache.load(self.setup_config.steamapp_info_path, self.setup_config.config_file, self.setup_config.platform)
 
-  @classmethod
-  def _iter_workshops(cls, l):
-    for workshop_ent in l:
-      include, workshop_id, workshop_name, workshop_rel = workshop_ent
-      if not include:
-        continue
-      yield cls.workshop_t(workshop_id, workshop_name, workshop_rel)
+  @staticmethod
+  def check_plan(plan):
+    for error in plan.errors:
+      logger.error('steamapp_info {}: {}'.format(error.where or '(root)', error.message))
+    return not plan.errors
+
+  def reload(self):
+    # a half-written or invalid file keeps the previous plan, the next change retries
+    app_dir = self.setup_config.steamapp_app_dir
+    self.setup_config.load_config()
+    self.apply_config()
+    plan = self.load_plan()
+    if not self.check_plan(plan):
+      return False
+    self.plan = plan
+    if self.setup_config.steamapp_app_dir != app_dir:
+      self.install_state = InstallState(self.setup_config.steamapp_app_dir)
+    return True
+
+  def iter_plugins(self):
+    yield from self.plan.plugins
 
   def iter_workshops(self):
-    yield from self._iter_workshops(self.steamapp_info.get('workshopIds', []))
+    yield from self.plan.workshops
 
   def print_config_stats(self):
     print()
     print('using platform       : {}'.format(self.setup_config.platform))
     print('target app directory : {}'.format(self.setup_config.steamapp_app_dir))
+    print('install workers      : {}'.format(self.workers))
 
   def print_plugins_stats(self):
     print()
@@ -152,144 +525,477 @@ class Main:
       print('{:>3d}. {}'.format(m+1, workshop_ent.name))
 
 
-  @staticmethod
-  def prompt_confirm():
+  def prompt_confirm(self):
     print()
-    res = input('continue? [Y/n] : ') == 'Y'
+    if 'yes' in self.argv_opts:
+      print('continue? [Y/n] : Y (--yes)')
+      res = True
+    else:
+      res = input('continue? [Y/n] : ') == 'Y'
     print()
     return res
 
-  def run(self):
-    self.load_steamapp_info(self.setup_config.steamapp_info_path)
+  def prepare(self):
+    self.init_runtime()
+    self.plan = self.load_plan()
     ensure_dir(self.downloads_dir)
-    if len(sys.argv) > 1 and sys.argv[1] == 'install-workshop':
+    self.cache = DownloadCache(self.downloads_dir, self.setup_config.cache_max_size_mb * 1000 * 1000)
+    self.atexit_callback.append(self.cache.close)
+    self.host_caps = HostCapabilities(os.path.join(self.downloads_dir, 'host_caps.json'))
+    self.atexit_callback.append(self.host_caps.close)
+    self.download_opts['host_caps'] = self.host_caps
+    self.install_state = InstallState(self.setup_config.steamapp_app_dir)
+    self.compile_engine = CompileEngine(os.path.join(self.downloads_dir, 'compiled'), self.pipeline_opts['compile_workers'], self.sync_opts)
+    self.workshop_resolver = WorkshopResolver(self.session, os.path.join(self.downloads_dir, 'workshop_meta.json'), self.setup_config.workshop_metadata_ttl_sec, self.setup_config.workshop_batch_size)
+    if not self.mirror is None and not 'prefetch' in self.argv:
+      self.workshop_resolver.seed(self.mirror.workshop_details())
+    if self.setup_config.workshop_backend == 'steamcmd':
+      self.steamcmd = SteamcmdWorkshop(
+        self.setup_config.workshop_steamcmd_path or default_steamcmd_path(self.setup_config.steamapp_parent_dir, self.setup_config.platform),
+        os.path.join(self.setup_config.steamapp_parent_dir, 'workshop'),
+        self.setup_config.workshop_steamcmd_login, self.setup_config.workshop_steamcmd_export, self.setup_config.workshop_steamcmd_timeout_sec)
+    self.watch_throttle()
+
+  def run(self):
+    command = self.argv[0] if len(self.argv) > 0 else ''
+    if command == 'materialize':
+      self.init_runtime()
+      self.run_materialize()
+      return
+    if command == 'fleet':
+      # plugins and workshop items are installed once into the store, instances only link to it
+      self.setup_config.steamapp_app_dir = self.setup_config.fleet_store_dir
+    if command == 'plan' or 'dry-run' in self.argv_opts:
+      self.run_plan()
+      return
+    self.prepare()
+    if command == 'fleet':
+      self.run_fleet()
+      return
+    if len(self.argv) > 0 and self.argv[0] == 'install-workshop':
       self.run_install_workshop()
       return
+    if command == 'prefetch':
+      self.run_prefetch()
+      return
+    if command == 'verify':
+      self.run_verify()
+      return
+    if len(self.argv) > 0 and self.argv[0] == 'reconcile':
+      self.run_reconcile()
+      return
     self.run_install_all()
 
-  def install_plugin(self, plugin_ent):
-    logger.info('installing: {}'.format(plugin_ent.name))
-    for n, resource_ent in enumerate(plugin_ent.resources):
-      target_dir = self.setup_config.get_app_path(resource_ent.extract_path)
-      resource_url = resource_ent.url
-      if resource_url is None or resource_url == '':
-        logger.warning('url is empty')
-        continue
-      status, download_path, info = download_file(self.session, resource_url, self.downloads_dir)
-      if not status:
-        logger.warning('failed to retrieve content: {} {}'.format(plugin_ent.name, resource_url))
-        continue
-      if info.content_type == 'application/zip' or info.file_type == 'zip':
+  def get_compiler_preset(self, compiler_preset_name):
+    # the plan holds the preset for its platform, build_plan already reported unknown names
+    compiler_preset = self.plan.compiler_presets.get(compiler_preset_name)
+    if not compiler_preset:
+      logger.warning('compiler preset for platform is not recognized: {} {}'.format(self.plan.platform, compiler_preset_name))
+      return None
+    return compiler_preset
+
+  def get_compile_preset(self, compiler_preset_name):
+    compiler_preset = self.get_compiler_preset(compiler_preset_name)
+    if compiler_preset is None:
+      return None
+    exec_path = self.setup_config.get_app_path(compiler_preset.get('execPath'))
+    compiled_dst_path = self.setup_config.get_app_path(compiler_preset.get('compiledDstPath'))
+    extract_path = self.setup_config.get_app_path(compiler_preset.get('extractPath'))
+    # spcomp next to the compile script is called directly so every job gets its own output dir
+    spcomp_path = compiler_preset.get('spcompPath')
+    if spcomp_path:
+      spcomp_path = self.setup_config.get_app_path(spcomp_path)
+    else:
+      spcomp_path = os.path.join(os.path.dirname(exec_path), 'spcomp.exe' if self.setup_config.platform == 'windows' else 'spcomp')
+    if not isfile(spcomp_path):
+      spcomp_path = None
+    include_dirs = [self.setup_config.get_app_path(p) for p in compiler_preset.get('includePaths', [])]
+    if not include_dirs:
+      include_dirs = [os.path.join(os.path.dirname(exec_path), 'include')]
+    return compile_preset_t(exec_path, spcomp_path, include_dirs, compiled_dst_path, extract_path, compiler_preset.get('acceptFileType', '*.sp'))
+
+  def compile_resource(self, resource_ent, info, resource_record):
+    logger.info('recompiling plugin: {}'.format(resource_ent.compiler_preset_name))
+    compile_preset = self.get_compile_preset(resource_ent.compiler_preset_name)
+    if compile_preset is None:
+      return False
+    sources = discover_sources(resource_record['files'], compile_preset.accept_file_type)
+    if not sources:
+      logger.warning('no sources matching {} in {}'.format(compile_preset.accept_file_type, info.file_name))
+      return False
+    compile_results = self.compile_engine.compile_many([compile_job_t(source, compile_preset) for source in sources])
+    log_compile_report(compile_results)
+    with self.plugin_jobs_lock:
+      self.compile_results += compile_results
+      for compile_result in compile_results:
+        resource_record['files'] += compile_result.outputs
+    return all(compile_result.status for compile_result in compile_results)
+
+  def finalize_plugin(self, plugin_job):
+    plugin_ent = plugin_job['plugin_ent']
+    logger.info('finished installing plugin: {}'.format(plugin_ent.name))
+    metrics.count('plugins_total', status='ok' if plugin_job['status'] else 'failed')
+    metrics.emit('plugin', plugin=plugin_ent.name, status='ok' if plugin_job['status'] else 'failed', resources=len(plugin_ent.resources))
+    if plugin_job['status']:
+      self.install_state.record('plugins', plugin_ent.name, plugin_ent.fingerprint, plugin_job['records'])
+
+  def finish_resource(self, job, status=True):
+    plugin_job = job.plugin_job
+    with self.plugin_jobs_lock:
+      plugin_job['status'] = plugin_job['status'] and status
+      plugin_job['pending'] -= 1
+      if plugin_job['pending'] > 0:
+        return
+      compile_jobs = plugin_job['compile_jobs']
+      plugin_job['pending_compile'] = len(compile_jobs)
+    # compiles start only once every resource of the plugin, includes too, is in place
+    if not compile_jobs:
+      self.finalize_plugin(plugin_job)
+    for compile_job in compile_jobs:
+      self.pipeline.put('compile', compile_job)
+
+  def finish_compile(self, job, status=True):
+    plugin_job = job.plugin_job
+    with self.plugin_jobs_lock:
+      plugin_job['status'] = plugin_job['status'] and status
+      plugin_job['pending_compile'] -= 1
+      if plugin_job['pending_compile'] > 0:
+        return
+    self.finalize_plugin(plugin_job)
+
+  def stage_download(self, job):
+    resource_url = job.resource_ent.url
+    if resource_url is None or resource_url == '':
+      logger.warning('url is empty')
+      self.finish_resource(job)
+      return None
+    plugin_name = job.plugin_job['plugin_ent'].name
+    if (job.plugin_job['plugin_ent'].disable_cache or job.resource_ent.disable_cache) and not self.in_mirror(resource_url):
+      self.stream_resource(job)
+      return None
+    with metrics.context(plugin=plugin_name, resource=resource_url), metrics.phase('download', plugin=plugin_name, host=url_host(resource_url)) as m:
+      status, download_path, info = download_file(self.session, resource_url, self.downloads_dir, cache=self.cache, **self.download_opts)
+      m['status'] = 'ok' if status else 'failed'
+      m['bytes'] = info.file_size if info else 0
+    if not status:
+      logger.warning('failed to retrieve content: {} {}'.format(job.plugin_job['plugin_ent'].name, resource_url))
+      self.finish_resource(job, False)
+      return None
+    return job, download_path, info
+
+  def in_mirror(self, url):
+    return not self.mirror is None and not url is None and not self.mirror.lookup(url) is None
+
+  def stream_resource(self, job):
+    # uncached resources skip the downloads dir: tarballs are extracted while the body arrives,
+    # zips need their central directory and are spooled to memory or an anonymous temp file first
+    plugin_ent, resource_ent = job.plugin_job['plugin_ent'], job.resource_ent
+    target_dir = self.setup_config.get_app_path(resource_ent.extract_path)
+    stats, info, sha256 = None, None, None
+    with metrics.context(plugin=plugin_ent.name, resource=resource_ent.url), metrics.phase('download', plugin=plugin_ent.name, host=url_host(resource_ent.url)) as m:
+      # a broken stream restarts from the top, members already written match and are skipped,
+      # any other error comes from the archive or our side and another download would not change it
+      for i_attempt in range(retry_utils.default_policy.max_retry):
+        with stream_response(self.session, resource_ent.url, self.download_opts['host_limiter']) as (reader, info):
+          if reader is None:
+            break
+          try:
+            kind = archive_kind(info)
+            if kind == 'tar':
+              logger.info('stream extracting {}: {}'.format(info.file_type, info.file_name))
+              stats = archive_extract_tar_stream(reader, target_dir)
+            elif kind == 'zip':
+              logger.info('spooling zip: {}'.format(info.file_name))
+              with spool_file(info.file_size, self.setup_config.download_spool_max_mb * 1000 * 1000, self.downloads_dir) as spool:
+                shutil.copyfileobj(reader, spool, 1 << 20)
+                spool.seek(0)
+                stats = archive_extract_zip(spool, target_dir)
+            else:
+              logger.info('writing file: {}'.format(info.file_name))
+              dst_path = os.path.join(target_dir, info.file_name)
+              write_atomic(reader, dst_path)
+              stats = extract_stats_t(1, 0, reader.nbytes, [dst_path])
+            sha256 = reader.hasher.hexdigest()
+            break
+          except StreamReadError as e:
+            logger.warning('stream interrupted after {} bytes, attempt {}: {} {}'.format(reader.nbytes, i_attempt + 1, resource_ent.url, e))
+          except Exception:
+            logger.error('cannot extract streamed {}: {}'.format(resource_ent.url, traceback.format_exc()))
+            break
+      m['status'] = 'ok' if not stats is None else 'failed'
+      m['bytes'] = 0 if stats is None else stats.bytes
+      m['streamed'] = True
+    if stats is None:
+      logger.warning('failed to retrieve content: {} {}'.format(plugin_ent.name, resource_ent.url))
+      self.finish_resource(job, False)
+      return
+    metrics.count('extract_files_total', stats.files)
+    metrics.count('extract_bytes_total', stats.bytes)
+    # a resource that was cached before is dropped now that it is streamed
+    self.cache.discard(resource_ent.url)
+    self.record_resource(job, info, {'url': resource_ent.url, 'sha256': sha256, 'extract_path': resource_ent.extract_path, 'files': list(stats.paths)})
+
+  def record_resource(self, job, info, resource_record):
+    with self.plugin_jobs_lock:
+      job.plugin_job['records'].append(resource_record)
+      if job.resource_ent.do_compile and job.resource_ent.compiler_preset_name:
+        job.plugin_job['compile_jobs'].append((job, info, resource_record))
+    self.finish_resource(job)
+
+  def stage_extract(self, args):
+    job, download_path, info = args
+    plugin_ent, resource_ent = job.plugin_job['plugin_ent'], job.resource_ent
+    target_dir = self.setup_config.get_app_path(resource_ent.extract_path)
+    resource_record = {'url': resource_ent.url, 'sha256': os.path.basename(download_path), 'extract_path': resource_ent.extract_path, 'files': list()}
+    with metrics.context(plugin=plugin_ent.name, resource=resource_ent.url), metrics.phase('extract', plugin=plugin_ent.name) as m:
+      kind = archive_kind(info)
+      if kind == 'zip':
         logger.info('extracting zip: {}'.format(info.file_name))
-        archive_extract_zip(download_path, target_dir, self.tempdir)
-      elif info.content_type == 'application/x-xz' or info.file_type.startswith('tar'):
+        stats = archive_extract_zip(download_path, target_dir)
+      elif kind == 'tar':
         logger.info('extracting {}: {}'.format(info.file_type, info.file_name))
-        archive_extract_tar(download_path, target_dir, self.tempdir)
+        stats = archive_extract_tar(download_path, target_dir)
       else:
         logger.info('copying file: {}'.format(info.file_name))
-        copy2(download_path, os.path.join(target_dir, info.file_name))
-      
-      if plugin_ent.disable_cache:
-        delete_file(download_path)
-
-      if resource_ent.do_compile and resource_ent.compiler_preset_name:
-        logger.info('recompiling plugin: {}'.format(resource_ent.compiler_preset_name))
-        compiler_preset = self.steamapp_info.get('compilerPresets', {}).get(resource_ent.compiler_preset_name)
-        if not compiler_preset:
-          logger.warning('compiler preset name is not recognized: {}'.format(resource_ent.compiler_preset_name))
-          return
-        compiler_preset = list(filter(lambda x: x.get('platform') == self.setup_config.platform, compiler_preset))
-        if not compiler_preset:
-          logger.warning('compiler preset for platform is not recognized: {} {}'.format(self.setup_config.platform, resource_ent.compiler_preset_name))
-          return
-        compiler_preset = compiler_preset[0]
-
-        exec_path = compiler_preset.get('execPath')
-        compiled_dst_path = compiler_preset.get('compiledDstPath')
-        extract_path = compiler_preset.get('extractPath')
-
-        exec_path = self.setup_config.get_app_path(exec_path)
-        compiled_dst_path = self.setup_config.get_app_path(compiled_dst_path)
-        extract_path = self.setup_config.get_app_path(extract_path)
-
-        target_file = os.path.join(target_dir, info.file_name)
-        subprocess.call([exec_path, os.path.abspath(target_file)])
-        copy2_r(compiled_dst_path, extract_path)
-        rmtree_d(compiled_dst_path)
-
-        # file_type_fmt = compiler_preset.get('acceptFileType', '')
-        # target_files = glob.glob(os.path.join(target_dir, file_type_fmt))
-        # for target_file in target_files:
-        #   target_file = self.setup_config.get_app_path(target_file)
-        #   subprocess.call([exec_path, os.path.abspath(target_file)])
-        #   copy2_r(compiled_dst_path, extract_path)
-        #   rmtree_d(compiled_dst_path)
+        dst_path, copied = sync_file(download_path, os.path.join(target_dir, info.file_name), self.sync_opts['hash_check'])
+        stats = extract_stats_t(int(copied), int(not copied), os.path.getsize(dst_path) if copied else 0, [dst_path])
+      resource_record['files'] += stats.paths
+      m.update(files=stats.files, skipped=stats.skipped, bytes=stats.bytes)
+      metrics.count('extract_files_total', stats.files)
+      metrics.count('extract_bytes_total', stats.bytes)
 
-    logger.info('finished installing plugin: {}'.format(plugin_ent.name))
+    # only reached by an uncached resource when it came from the mirror
+    if plugin_ent.disable_cache or resource_ent.disable_cache:
+      self.cache.discard(resource_ent.url)
+    self.record_resource(job, info, resource_record)
+    return None
+
+  def stage_compile(self, args):
+    job, info, resource_record = args
+    plugin_name = job.plugin_job['plugin_ent'].name
+    with metrics.context(plugin=plugin_name), metrics.phase('compile', plugin=plugin_name) as m:
+      status = self.compile_resource(job.resource_ent, info, resource_record)
+      m['status'] = 'ok' if status else 'failed'
+    self.finish_compile(job, status)
+    return None
+
+  def install_plugins(self, plugin_ents, name='plugins'):
+    opts = self.pipeline_opts
+    self.pipeline = Pipeline(name, opts['monitor_sec'])
+    self.pipeline.add_stage('download', self.stage_download, opts['download_workers'], opts['queue_size'], lambda job, e: self.finish_resource(job, False))
+    self.pipeline.add_stage('extract', self.stage_extract, opts['extract_workers'], opts['queue_size'], lambda args, e: self.finish_resource(args[0], False))
+    self.pipeline.add_stage('compile', self.stage_compile, opts['compile_workers'], 0, lambda args, e: self.finish_compile(args[0], False))
+
+    plugin_jobs = list()
+    resource_jobs = list()
+    for plugin_ent in plugin_ents:
+      logger.info('installing: {}'.format(plugin_ent.name))
+      plugin_job = {'plugin_ent': plugin_ent, 'pending': len(plugin_ent.resources), 'pending_compile': 0, 'status': True, 'records': list(), 'compile_jobs': list()}
+      plugin_jobs.append(plugin_job)
+      if not plugin_ent.resources:
+        self.finalize_plugin(plugin_job)
+      resource_jobs += [self.resource_job_t(plugin_job, resource_ent) for resource_ent in plugin_ent.resources]
+    if resource_jobs:
+      self.pipeline.run(resource_jobs)
+    return [plugin_job['status'] for plugin_job in plugin_jobs]
 
-  def download_workshop(self, workshop_id):
-    logger.info('retrieving workshop info: {}'.format(workshop_id))
-    db_hostname = 'https://db.steamworkshopdownloader.io'
-    db_api_path = 'prod/api/details/file'
-    data = bytes(f'[{workshop_id}]', 'utf8')
-    db_resp = http_request(self.session, 'POST', url='{}/{}'.format(db_hostname, db_api_path), data=data)
-    if db_resp is None:
+  def download_workshop_item(self, workshop_id, details):
+    written = list()
+    if details is None or not details.get('result'):
       logger.warning('cannot retrieve workshop info: {}'.format(workshop_id))
-      return
-    workshop_db_res = db_resp.json()
-
-    for workshop_ent in workshop_db_res:
-    
-      result = workshop_ent.get('result')
-      file_url = workshop_ent.get('file_url')
-      preview_url = workshop_ent.get('preview_url')
-      file_name = workshop_ent.get('filename')
-      is_collection = workshop_ent.get('show_subscribe_all', False)
-      is_collection = is_collection and not workshop_ent.get('can_subscribe', False)
-
-      logger.info('downloading workshop: {}'.format(file_name))
-
-      if result: 
-        if is_collection:
-          logger.info('workshop collection found instead, processing children')
-          for workshop_child_ent in workshop_ent.get('children'):
-            workshop_child_id = workshop_child_ent.get('publishedfileid')
-            if not workshop_child_id is None:
-              self.download_workshop(workshop_child_id)
-        else:
-          workshop_resource_urls = [file_url, preview_url]
-          for workshop_resource_url in workshop_resource_urls:
-            if not workshop_resource_url is None:
-              export_dir = self.setup_config.get_app_path('left4dead2/addons')
-              ensure_dir(export_dir)
-              status, download_file_path, file_info = download_file(self.session, workshop_resource_url, export_dir)
-              if not status and not download_file_path is None:
-                logger.warning('destroying unfinished addon file')
-                delete_file(download_file_path)
+      return False, written
+    logger.info('downloading workshop: {}'.format(details.get('filename')))
+    status_all = True
+    export_dir = self.setup_config.get_app_path('left4dead2/addons')
+    ensure_dir(export_dir)
+    for workshop_resource_url in [details.get('file_url'), details.get('preview_url')]:
+      if workshop_resource_url is None:
+        continue
+      status, download_file_path, file_info = download_file(self.session, workshop_resource_url, export_dir, **self.download_opts)
+      if status:
+        written.append(download_file_path)
+      else:
+        status_all = False
+    return status_all, written
 
+  def download_workshop_batch(self, workshop_ids, workshop_tree):
+    # steamcmd pays for startup and login once, the items are then only exported into addons
+    export_dir = self.setup_config.get_app_path('left4dead2/addons')
+    with metrics.phase('steamcmd', items=len(workshop_ids)) as m:
+      items = self.steamcmd.download(workshop_ids)
+      m['failed'] = sum(not item.status for item in items.values())
+    results = dict()
+    for workshop_id, item in items.items():
+      if not item.status:
+        logger.warning('steamcmd failed to download workshop item: {} {}'.format(workshop_id, item.message))
+        results[workshop_id] = False, list()
+        continue
+      written = self.steamcmd.export(item, export_dir, workshop_tree.items.get(workshop_id, {}).get('filename', ''))
+      results[workshop_id] = bool(written), written
+    return results
+
+  @staticmethod
+  def workshop_fingerprint(workshop_tree, root_id):
+    return fingerprint([(workshop_id, workshop_tree.items.get(workshop_id, {}).get('time_updated')) for workshop_id in workshop_tree.roots[root_id]])
+
+  def install_workshops(self, workshop_tree, root_ids, record=True):
+    # items shared by several collections are downloaded once
+    workshop_ids = list(dict.fromkeys(chain.from_iterable(workshop_tree.roots[root_id] for root_id in root_ids)))
+
+    def install_item(workshop_id):
+      with metrics.context(workshop=workshop_id), metrics.phase('workshop', workshop=workshop_id) as m:
+        status, written = install_item_files(workshop_id)
+        m['status'] = 'ok' if status else 'failed'
+        m['files'] = len(written)
+      return status, written
+
+    def installed_files(workshop_id):
+      details = workshop_tree.items.get(workshop_id)
+      if details is None or 'force' in self.argv_opts:
+        return None
+      installed = self.install_state.find_resource('workshops', workshop_id=workshop_id, time_updated=details.get('time_updated'))
+      if installed is None:
+        return None
+      return [self.install_state.abs_path(f) for f in installed['files']]
+
+    def install_item_files(workshop_id):
+      written = installed_files(workshop_id)
+      if not written is None:
+        logger.info('workshop item is up to date: {} {}'.format(workshop_id, workshop_tree.items[workshop_id].get('filename')))
+        return True, written
+      if workshop_id in batch_results:
+        return batch_results[workshop_id]
+      return self.download_workshop_item(workshop_id, workshop_tree.items.get(workshop_id))
+
+    batch_results = dict()
+    if not self.steamcmd is None:
+      # items the mirror holds are cheaper over the lan than through steam
+      batch_results = self.download_workshop_batch([
+        workshop_id for workshop_id in workshop_ids
+        if installed_files(workshop_id) is None and not self.in_mirror(workshop_tree.items.get(workshop_id, {}).get('file_url'))
+      ], workshop_tree)
+
+    item_results = dict(zip(workshop_ids, run_ordered(install_item, workshop_ids, self.workers, 'workshop')))
+    results = list()
+    for root_id in root_ids:
+      leaf_ids = workshop_tree.roots[root_id]
+      status = all(item_results[workshop_id][0] for workshop_id in leaf_ids)
+      if status and record:
+        self.install_state.record('workshops', root_id, self.workshop_fingerprint(workshop_tree, root_id), [{
+          'workshop_id': workshop_id,
+          'time_updated': workshop_tree.items.get(workshop_id, {}).get('time_updated'),
+          'files': item_results[workshop_id][1],
+        } for workshop_id in leaf_ids])
+      results.append(status)
+    return results
+
+  @staticmethod
+  def print_results_stats(title, names, results):
+    print()
+    print(title)
+    for m, (name, status) in enumerate(zip(names, results)):
+      print('{:>3d}. [{}] {}'.format(m+1, 'ok' if status else 'failed', name))
+
+
+  def diff_install_state(self, plugin_ents, workshop_ents, workshop_tree):
+    if 'force' in self.argv_opts:
+      return plugin_ents, workshop_ents, list(), list()
+    pending_plugin_ents = [
+      plugin_ent for plugin_ent in plugin_ents
+      if plugin_ent.disable_cache or not self.install_state.is_current('plugins', plugin_ent.name, plugin_ent.fingerprint)
+    ]
+    pending_workshop_ents = [
+      workshop_ent for workshop_ent in workshop_ents
+      if not self.install_state.is_current('workshops', str(workshop_ent.workshop_id), self.workshop_fingerprint(workshop_tree, str(workshop_ent.workshop_id)))
+    ]
+    stale_plugins = self.install_state.stale_keys('plugins', [plugin_ent.name for plugin_ent in plugin_ents])
+    stale_workshops = self.install_state.stale_keys('workshops', [str(workshop_ent.workshop_id) for workshop_ent in workshop_ents])
+    return pending_plugin_ents, pending_workshop_ents, stale_plugins, stale_workshops
+
+  def print_diff_stats(self, plugin_ents, workshop_ents, stale_plugins, stale_workshops):
+    print()
+    print('install state:')
+    print('  plugins to install   : {}'.format(len(plugin_ents)))
+    print('  workshops to install : {}'.format(len(workshop_ents)))
+    for key in stale_plugins:
+      print('  remove plugin        : {}'.format(key))
+    for key in stale_workshops:
+      print('  remove workshop      : {}'.format(key))
 
   def run_install_all(self):
     logger.info('running install all routine')
     self.print_config_stats()
     self.print_plugins_stats()
     self.print_addons_stats()
+    if not self.check_plan(self.plan):
+      print()
+      print('{} errors in {}, nothing was installed'.format(len(self.plan.errors), self.setup_config.steamapp_info_path))
+      return False
+    workshop_ents = list(self.iter_workshops())
+    workshop_tree = self.workshop_resolver.resolve([workshop_ent.workshop_id for workshop_ent in workshop_ents])
+    plugin_ents, workshop_ents, stale_plugins, stale_workshops = self.diff_install_state(list(self.iter_plugins()), workshop_ents, workshop_tree)
+    self.print_diff_stats(plugin_ents, workshop_ents, stale_plugins, stale_workshops)
+    if not (plugin_ents or workshop_ents or stale_plugins or stale_workshops):
+      logger.info('install state is current, nothing to do')
+      return True
     if not self.prompt_confirm():
-      return
+      return False
+    self.compile_results = list()
+    for key in stale_plugins:
+      self.install_state.remove('plugins', key)
+    for key in stale_workshops:
+      self.install_state.remove('workshops', key)
     logger.info('installing plugins')
-    for m, plugin_ent in enumerate(self.iter_plugins()):
-      self.install_plugin(plugin_ent)
+    # metaPlugins are installed to completion before any dependent plugin extracts into their tree
+    meta_plugin_ents = [plugin_ent for plugin_ent in plugin_ents if plugin_ent.is_meta]
+    plugin_ents = [plugin_ent for plugin_ent in plugin_ents if not plugin_ent.is_meta]
+    plugin_results = self.install_plugins(meta_plugin_ents, 'meta_plugins')
+    plugin_results += self.install_plugins(plugin_ents, 'plugins')
     logger.info('finished installing all plugins')
     logger.info('installing workshops')
-    for m, workshop_ent in enumerate(self.iter_workshops()):
-      self.download_workshop(workshop_ent.workshop_id)
+    workshop_results = self.install_workshops(workshop_tree, [str(workshop_ent.workshop_id) for workshop_ent in workshop_ents])
     logger.info('finished installing all workshops')
-    return
+    self.print_results_stats('plugin install results:', [plugin_ent.name for plugin_ent in meta_plugin_ents + plugin_ents], plugin_results)
+    self.print_results_stats('compile results:', [compile_result.source for compile_result in self.compile_results], [compile_result.status for compile_result in self.compile_results])
+    self.print_results_stats('workshop install results:', [workshop_ent.name for workshop_ent in workshop_ents], workshop_results)
+    return True
+
+  def run_plan(self):
+    # lists what an install would do from the cached plan, workshop collections are only expanded by an actual install
+    self.plan = self.load_plan()
+    plan = self.plan
+    print()
+    print('using platform       : {}'.format(plan.platform))
+    print('target app directory : {}'.format(self.setup_config.steamapp_app_dir))
+    print('install plan         : {}'.format(plan.key[:12]))
+    print()
+    print('plugins in install order:')
+    for m, plugin_ent in enumerate(plan.plugins):
+      print('{:>3d}. {}{}'.format(m+1, '[meta] ' if plugin_ent.is_meta else '', plugin_ent.name))
+      for resource_ent in plugin_ent.resources:
+        print('       {} -> {}{}'.format(resource_ent.url, resource_ent.extract_path or '.', ' (compile {})'.format(resource_ent.compiler_preset_name) if resource_ent.do_compile else ''))
+    self.print_addons_stats()
+    print()
+    print('compile jobs: {}'.format(sum(resource_ent.do_compile for plugin_ent in plan.plugins for resource_ent in plugin_ent.resources)))
+    if not plan.errors:
+      install_state = InstallState(self.setup_config.steamapp_app_dir)
+      plugin_ents = [
+        plugin_ent for plugin_ent in plan.plugins
+        if 'force' in self.argv_opts or plugin_ent.disable_cache or not install_state.is_current('plugins', plugin_ent.name, plugin_ent.fingerprint)
+      ]
+      stale_plugins = install_state.stale_keys('plugins', [plugin_ent.name for plugin_ent in plan.plugins])
+      print('plugins to install: {}'.format(len(plugin_ents)))
+      for key in stale_plugins:
+        print('remove plugin: {}'.format(key))
+    for error in plan.errors:
+      print('  [error] {}: {}'.format(error.where or '(root)', error.message))
+    return not plan.errors
 
   def run_install_workshop(self):
     logger.info('running install workshop routine')
-    if not len(sys.argv) > 3:
+    if not len(self.argv) > 1:
       logger.warning('no workshop ids')
-    workshop_ids = sys.argv[2:]
+    workshop_ids = self.argv[1:]
     self.print_config_stats()
     for m, workshop_id in enumerate(workshop_ids):
       print('{:>3d}. {}'.format(m+1, workshop_id))
@@ -297,12 +1003,161 @@ class Main:
         logger.warning('invalid workshop id: {}'.format(workshop_id))
     if not self.prompt_confirm():
       return
-    for workshop_id in workshop_ids:
-      if not workshop_id.isnumeric():
-        continue
-      self.download_workshop(int(workshop_id))
+    workshop_ids = [workshop_id for workshop_id in workshop_ids if workshop_id.isnumeric()]
+    workshop_tree = self.workshop_resolver.resolve(workshop_ids)
+    workshop_results = self.install_workshops(workshop_tree, workshop_ids, record=False)
+    self.print_results_stats('workshop install results:', workshop_ids, workshop_results)
     return
 
+  def fleet_instances(self):
+    return self.argv[1:] or split_patterns(self.setup_config.fleet_instances)
+
+  def materialize_instances(self, instance_dirs):
+    store_dir = self.setup_config.fleet_store_dir
+    copy_patterns = split_patterns(self.setup_config.fleet_copy_patterns)
+    symlink_patterns = split_patterns(self.setup_config.fleet_symlink_patterns)
+
+    def materialize_instance(instance_dir):
+      try:
+        return materialize(store_dir, instance_dir, self.setup_config.fleet_link_mode, copy_patterns, symlink_patterns)
+      except OSError as e:
+        logger.error('cannot materialize {}: {}'.format(instance_dir, e))
+        return None
+
+    results = run_ordered(materialize_instance, instance_dirs, self.workers, 'materialize')
+    print()
+    print('fleet instances:')
+    for m, (instance_dir, stats) in enumerate(zip(instance_dirs, results)):
+      if stats is None:
+        print('{:>3d}. [failed] {}'.format(m+1, instance_dir))
+      else:
+        print('{:>3d}. [ok] {} | {} linked, {} copied, {} unchanged, {} removed'.format(m+1, instance_dir, stats.linked, stats.copied, stats.skipped, stats.removed))
+    return [not stats is None for stats in results]
+
+  def run_prefetch(self):
+    # one host fetches every resource and workshop file into a bundle, the others point [download] mirror at it
+    if len(self.argv) < 2:
+      logger.error('usage: prefetch <bundle dir> [--platform=<platform>] [--archive]')
+      return
+    bundle_dir = self.argv[1]
+    if 'platform' in self.argv_opts:
+      self.setup_config.platform = self.argv_opts['platform']
+      self.plan = self.load_plan()
+    if not self.check_plan(self.plan):
+      return
+    logger.info('running prefetch routine, bundle: {} platform: {}'.format(bundle_dir, self.setup_config.platform))
+    bundle = DownloadCache(bundle_dir)
+    workshop_tree = self.workshop_resolver.resolve([workshop_ent.workshop_id for workshop_ent in self.iter_workshops()])
+    urls = [resource_ent.url for plugin_ent in self.iter_plugins() for resource_ent in plugin_ent.resources if resource_ent.url]
+    urls += [details.get(key) for details in workshop_tree.items.values() for key in ('file_url', 'preview_url') if details.get(key)]
+    urls = list(dict.fromkeys(urls))
+    download_opts = dict(self.download_opts, mirror=None)
+
+    def prefetch(url):
+      with metrics.context(resource=url), metrics.phase('prefetch', host=url_host(url)) as m:
+        status, _, info = download_file(self.session, url, bundle_dir, cache=bundle, **download_opts)
+        m['status'] = 'ok' if status else 'failed'
+      if not status:
+        logger.warning('failed to prefetch: {}'.format(url))
+      return status
+
+    results = run_ordered(prefetch, urls, self.workers, 'prefetch')
+    pruned = prune_bundle(bundle, set(urls))
+    bundle.close()
+    write_bundle_info(bundle_dir, {
+      'platform': self.setup_config.platform,
+      'created_at': time(),
+      'workshop': {workshop_id: ent['details'] for workshop_id, ent in self.workshop_resolver.cache.items()},
+    })
+    print()
+    print('prefetched {} of {} urls into {} ({:.02f} MB), {} stale urls dropped'.format(sum(results), len(results), bundle_dir, bundle.total_size() / 1e6, pruned))
+    for url, status in zip(urls, results):
+      if not status:
+        print('  [failed] {}'.format(url))
+    if 'archive' in self.argv_opts:
+      print('bundle archive: {}'.format(archive_bundle(bundle_dir, bundle_dir.rstrip('/\\') + '.tar')))
+
+  def run_verify(self):
+    # hashes the installed tree against the cached downloads, --repair restores diverged files from them
+    logger.info('running verify routine: {}'.format(self.setup_config.steamapp_app_dir))
+    extract_paths = {resource_ent.url: resource_ent.extract_path for plugin_ent in self.iter_plugins() for resource_ent in plugin_ent.resources}
+    manifests = BlobManifests(os.path.join(self.downloads_dir, 'verify'))
+    workers = int(self.argv_opts['workers']) if 'workers' in self.argv_opts else self.setup_config.verify_workers or os.cpu_count() or 1
+    with metrics.phase('verify') as m:
+      results = verify_tree(self.install_state, self.cache, manifests, workers, extract_paths)
+      m['files'] = len(results)
+    diverged = [result for result in results if result.status in ('missing', 'modified', 'ambiguous', 'extra')]
+    print()
+    print('verify results:')
+    for status in ('ok', 'unverified', 'missing', 'modified', 'ambiguous', 'extra'):
+      print('  {:<10}: {}'.format(status, sum(result.status == status for result in results)))
+    for result in diverged:
+      print('  [{}] {}{}'.format(result.status, result.rel_path, ' ({})'.format(result.owner) if result.owner else ''))
+    if not 'repair' in self.argv_opts:
+      return not diverged
+    # extra files are only reported, they may be local additions
+    repaired = repair_files(self.install_state, results)
+    unrepairable = [result for result in diverged if result.status != 'extra' and result.source is None]
+    print('repaired {} files'.format(len(repaired)))
+    for result in unrepairable:
+      if result.status == 'ambiguous':
+        print('  [ambiguous] {} differs from every owner ({}), reinstall to restore it'.format(result.rel_path, result.owner))
+      else:
+        print('  [no cached source] {}, reinstall {} to restore it'.format(result.rel_path, result.owner))
+    return not unrepairable
+
+  def run_fleet(self):
+    logger.info('running fleet routine, store: {}'.format(self.setup_config.fleet_store_dir))
+    instance_dirs = self.fleet_instances()
+    if not instance_dirs:
+      logger.warning('no fleet instances, set [fleet] instances or pass instance dirs')
+    if not self.run_install_all():
+      return
+    self.materialize_instances(instance_dirs)
+
+  def run_materialize(self):
+    logger.info('running materialize routine, store: {}'.format(self.setup_config.fleet_store_dir))
+    instance_dirs = self.fleet_instances()
+    if not instance_dirs:
+      logger.warning('no fleet instances, set [fleet] instances or pass instance dirs')
+      return
+    self.materialize_instances(instance_dirs)
+
+  @staticmethod
+  def file_signature(path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    return st.st_mtime_ns, st.st_size
+
+  def watch_signature(self):
+    return self.file_signature(self.setup_config.config_file), self.file_signature(self.setup_config.steamapp_info_path)
+
+  def run_reconcile(self):
+    # polls the two input files and applies the install diff once they have been quiet for debounce-sec,
+    # the session, connection pools and caches stay warm between passes
+    logger.info('running reconcile routine')
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    applied = None
+    pending, changed_at = self.watch_signature(), 0
+    while not stop.is_set():
+      signature = self.watch_signature()
+      if signature != pending:
+        logger.info('change detected, waiting {}s for edits to settle'.format(self.setup_config.reconcile_debounce_sec))
+        pending, changed_at = signature, time()
+      elif signature != applied and time() - changed_at >= self.setup_config.reconcile_debounce_sec:
+        if applied is None or self.reload():
+          try:
+            self.run_install_all()
+          except Exception:
+            logger.error(traceback.format_exc())
+        applied = signature
+        logger.info('watching {} and {}'.format(self.setup_config.steamapp_info_path, self.setup_config.config_file))
+      stop.wait(self.setup_config.reconcile_poll_sec)
+    logger.info('reconcile stopped')
+
   def exit(self):
     for cb in self.atexit_callback: cb()
 
@@ -310,9 +1165,6 @@ if __name__ == '__main__':
   main = Main()
   errno = 0
   try:
-    main.session.headers.update({
-      'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/102.0.0.0 Safari/537.36',
-    })
     main.run()
   except KeyboardInterrupt as e:
     logger.warning('KeyboardInterrupt')
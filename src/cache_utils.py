@@ -0,0 +1,235 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from time import time
+from src.log import init_logger
+from src.path_utils import ensure_dir, isfile
+from src.pool_utils import url_host
+
+logger = init_logger('cache_utils', 'setup.log')
+
+class HashingWriter:
+  def __init__(self, fh, hasher=None):
+    self.fh = fh
+    self.hasher = hashlib.sha256() if hasher is None else hasher
+    self.size = 0
+
+  def write(self, b):
+    self.hasher.update(b)
+    self.size += len(b)
+    return self.fh.write(b)
+
+  def hexdigest(self):
+    return self.hasher.hexdigest()
+
+  def fileno(self):
+    return self.fh.fileno()
+
+  def tell(self):
+    return self.fh.tell()
+
+  def flush(self):
+    return self.fh.flush()
+
+class DownloadCache:
+  manifest_name = 'manifest.json'
+  blobs_dir_name = 'blobs'
+  temp_dir_name = 'tmp'
+
+  def __init__(self, cache_dir, max_size=0):
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    self.manifest_path = os.path.join(cache_dir, self.manifest_name)
+    self.blobs_dir = os.path.join(cache_dir, self.blobs_dir_name)
+    self.temp_dir = os.path.join(cache_dir, self.temp_dir_name)
+    self._lock = threading.RLock()
+    self.entries = dict()
+    self.dirty = False
+    ensure_dir(self.blobs_dir)
+    ensure_dir(self.temp_dir)
+    self.load()
+
+  def load(self):
+    if not isfile(self.manifest_path):
+      return
+    try:
+      with open(self.manifest_path, 'r') as fh:
+        self.entries.update(json.load(fh).get('entries', {}))
+    except (ValueError, OSError) as e:
+      logger.warning('discarding unreadable cache manifest: {}'.format(e))
+    for url, entry in list(self.entries.items()):
+      if not isfile(self.blob_path(entry['sha256'])):
+        del self.entries[url]
+
+  def save(self):
+    with self._lock:
+      fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+      with os.fdopen(fd, 'w') as fh:
+        json.dump({'entries': self.entries}, fh, indent=1)
+      os.replace(tmp_path, self.manifest_path)
+      self.dirty = False
+
+  def blob_path(self, sha256):
+    return os.path.join(self.blobs_dir, sha256[:2], sha256)
+
+  def lookup(self, url):
+    with self._lock:
+      entry = self.entries.get(url)
+      if entry is None or not isfile(self.blob_path(entry['sha256'])):
+        return None
+      return dict(entry)
+
+  def conditional_headers(self, entry):
+    headers = dict()
+    if entry is None:
+      return headers
+    if entry.get('etag'):
+      headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+      headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+  def headers_match(self, entry, headers):
+    # used when the origin answers 200 to a conditional request, decides from the headers alone
+    if entry is None:
+      return False
+    etag, last_modified = headers.get('etag'), headers.get('last-modified')
+    size = headers.get('content-length', '')
+    if etag and entry.get('etag'):
+      return etag == entry['etag'] and (not size.isnumeric() or int(size) == entry['size'])
+    if last_modified and entry.get('last_modified'):
+      return last_modified == entry['last_modified'] and size.isnumeric() and int(size) == entry['size']
+    return False
+
+  def touch(self, url):
+    # cache hits only move last_access, which eviction alone reads, so they are written out once on close
+    with self._lock:
+      entry = self.entries.get(url)
+      if not entry is None:
+        entry['last_access'] = time()
+        self.dirty = True
+
+  def temp_path(self, url):
+    # stable per url so an interrupted download can be resumed by the next run
+    return os.path.join(self.temp_dir, hashlib.sha256(url.encode('utf8')).hexdigest())
+
+  def store(self, url, tmp_path, sha256, size, etag, last_modified, file_info):
+    blob_path = self.blob_path(sha256)
+    with self._lock:
+      if isfile(blob_path):
+        os.unlink(tmp_path)
+      else:
+        ensure_dir(os.path.dirname(blob_path))
+        os.replace(tmp_path, blob_path)
+      self.entries[url] = {
+        'sha256': sha256,
+        'size': size,
+        'etag': etag,
+        'last_modified': last_modified,
+        'file_info': dict(file_info._asdict()),
+        'last_access': time(),
+      }
+      self.save()
+    return blob_path
+
+  def discard(self, url):
+    with self._lock:
+      entry = self.entries.pop(url, None)
+      if entry is None:
+        return
+      if not any(e['sha256'] == entry['sha256'] for e in self.entries.values()):
+        blob_path = self.blob_path(entry['sha256'])
+        if isfile(blob_path):
+          os.unlink(blob_path)
+      self.save()
+
+  def total_size(self):
+    with self._lock:
+      return sum({e['sha256']: e['size'] for e in self.entries.values()}.values())
+
+  def evict(self):
+    if self.max_size <= 0:
+      return 0
+    with self._lock:
+      blobs = dict()
+      for entry in self.entries.values():
+        size, last_access = blobs.get(entry['sha256'], (entry['size'], 0))
+        blobs[entry['sha256']] = (size, max(last_access, entry.get('last_access', 0)))
+      total = sum(size for size, _ in blobs.values())
+      evicted = 0
+      # least recently used blob first, the most recent one is always kept
+      for sha256, (size, _) in sorted(blobs.items(), key=lambda x: x[1][1])[:-1]:
+        if total <= self.max_size:
+          break
+        for url in [u for u, e in self.entries.items() if e['sha256'] == sha256]:
+          del self.entries[url]
+        blob_path = self.blob_path(sha256)
+        if isfile(blob_path):
+          os.unlink(blob_path)
+        total -= size
+        evicted += 1
+      if evicted:
+        logger.info('evicted {} cached blobs, cache size: {:.02f} MB'.format(evicted, total / 1e6))
+        self.save()
+      return evicted
+
+  def close(self):
+    self.evict()
+    with self._lock:
+      if self.dirty:
+        self.save()
+
+class HostCapabilities:
+  # what each origin supports, learned from earlier responses: head, ranges, validators
+  # a missing or expired value means unknown and callers fall back to the safe strategy
+  keys = ('head', 'ranges', 'validators')
+
+  def __init__(self, path=None, ttl=7 * 86400):
+    self.path = path
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self.hosts = dict()
+    self.dirty = False
+    self.load()
+
+  def load(self):
+    if self.path is None or not isfile(self.path):
+      return
+    try:
+      with open(self.path, 'r') as fh:
+        self.hosts.update(json.load(fh).get('hosts', {}))
+    except (ValueError, OSError) as e:
+      logger.warning('discarding unreadable host capabilities: {}'.format(e))
+
+  def save(self):
+    with self._lock:
+      if self.path is None or not self.dirty:
+        return
+      ensure_dir(os.path.dirname(self.path) or '.')
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.json')
+      with os.fdopen(fd, 'w') as fh:
+        json.dump({'hosts': self.hosts}, fh, indent=1)
+      os.replace(tmp_path, self.path)
+      self.dirty = False
+
+  def get(self, url, key):
+    with self._lock:
+      value = self.hosts.get(url_host(url), {}).get(key)
+    if value is None or time() - value[1] > self.ttl:
+      return None
+    return value[0]
+
+  def set(self, url, **caps):
+    host = url_host(url)
+    with self._lock:
+      host_caps = self.hosts.setdefault(host, dict())
+      for key, value in caps.items():
+        if host_caps.get(key, [None])[0] != value:
+          logger.info('host capability {} {}: {}'.format(host, key, value))
+        host_caps[key] = [value, time()]
+      self.dirty = True
+
+  def close(self):
+    self.save()
@@ -0,0 +1,130 @@
+import os
+import shutil
+import fnmatch
+import hashlib
+import tempfile
+import threading
+import subprocess
+from time import time
+from collections import namedtuple
+from src.log import init_logger
+from src.path_utils import ensure_dir, isfile, isdir, copy2_r, sync_file, rmtree_d
+from src.pool_utils import run_ordered
+from src.metrics_utils import metrics
+
+logger = init_logger('compile_utils', 'setup.log')
+compile_job_t = namedtuple('CompileJob', ['source', 'preset'])
+compile_result_t = namedtuple('CompileResult', ['source', 'status', 'returncode', 'cached', 'outputs', 'duration'])
+compile_preset_t = namedtuple('CompilePreset', ['exec_path', 'spcomp_path', 'include_dirs', 'compiled_dst_path', 'extract_path', 'accept_file_type'])
+
+def discover_sources(paths, accept_file_type='*.sp'):
+  return [path for path in paths if fnmatch.fnmatch(os.path.basename(path), accept_file_type or '*.sp')]
+
+class FileHasher:
+  # memoizes content hashes by (size, mtime) so unchanged include trees are not re-read
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._memo = dict()
+
+  def hash_file(self, path):
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    with self._lock:
+      digest = self._memo.get(key)
+    if digest is None:
+      hasher = hashlib.sha256()
+      with open(path, 'rb') as fh:
+        for b in iter(lambda: fh.read(1 << 20), b''):
+          hasher.update(b)
+      digest = hasher.hexdigest()
+      with self._lock:
+        self._memo[key] = digest
+    return digest
+
+  def hash_tree(self, root):
+    hasher = hashlib.sha256()
+    if not isdir(root):
+      return hasher.hexdigest()
+    for dirpath, dirnames, filenames in os.walk(root):
+      dirnames.sort()
+      for f in sorted(filenames):
+        path = os.path.join(dirpath, f)
+        hasher.update(os.path.relpath(path, root).replace(os.sep, '/').encode('utf8'))
+        hasher.update(self.hash_file(path).encode('utf8'))
+    return hasher.hexdigest()
+
+class CompileEngine:
+  def __init__(self, cache_dir, workers=1, sync_opts=None):
+    self.cache_dir = cache_dir
+    self.workers = max(workers, 1)
+    self.sync_opts = sync_opts or {}
+    self.hasher = FileHasher()
+    self.slots = threading.BoundedSemaphore(self.workers)
+    # legacy presets share one compiledDstPath and cannot run concurrently
+    self.legacy_lock = threading.Lock()
+    ensure_dir(cache_dir)
+
+  def cache_key(self, job):
+    hasher = hashlib.sha256()
+    hasher.update(self.hasher.hash_file(job.source).encode('utf8'))
+    for include_dir in job.preset.include_dirs + [os.path.join(os.path.dirname(job.source), 'include')]:
+      hasher.update(self.hasher.hash_tree(include_dir).encode('utf8'))
+    compiler_path = job.preset.spcomp_path or job.preset.exec_path
+    if isfile(compiler_path):
+      hasher.update(self.hasher.hash_file(compiler_path).encode('utf8'))
+    return hasher.hexdigest()
+
+  def cache_path(self, key, name):
+    return os.path.join(self.cache_dir, key[:2], key, name)
+
+  def compile(self, job):
+    t0 = time()
+    name = os.path.splitext(os.path.basename(job.source))[0] + '.smx'
+    dst_path = os.path.join(job.preset.extract_path, name)
+    if job.preset.spcomp_path is None:
+      status, returncode, outputs = self.compile_legacy(job)
+      return compile_result_t(job.source, status, returncode, False, outputs, time() - t0)
+
+    key = self.cache_key(job)
+    cached_path = self.cache_path(key, name)
+    if isfile(cached_path):
+      logger.info('compile cache hit: {}'.format(job.source))
+      return compile_result_t(job.source, True, 0, True, [sync_file(cached_path, dst_path, self.sync_opts.get('hash_check', False))[0]], time() - t0)
+
+    out_dir = tempfile.mkdtemp(dir=os.path.abspath(self.cache_dir), prefix='job_')
+    try:
+      out_path = os.path.join(out_dir, name)
+      include_dirs = [d for d in job.preset.include_dirs + [os.path.join(os.path.dirname(job.source), 'include')] if isdir(d)]
+      args = [job.preset.spcomp_path, os.path.abspath(job.source), '-o' + out_path] + ['-i' + d for d in include_dirs]
+      with self.slots:
+        proc = subprocess.run(args, cwd=os.path.dirname(job.source), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+      if proc.returncode != 0 or not isfile(out_path):
+        logger.warning('compile failed ({}): {}\n{}'.format(proc.returncode, job.source, proc.stdout.decode('utf8', 'replace').strip()))
+        return compile_result_t(job.source, False, proc.returncode, False, [], time() - t0)
+      ensure_dir(os.path.dirname(cached_path))
+      os.replace(out_path, cached_path)
+      return compile_result_t(job.source, True, 0, False, [sync_file(cached_path, dst_path, self.sync_opts.get('hash_check', False))[0]], time() - t0)
+    finally:
+      shutil.rmtree(out_dir, True)
+
+  def compile_legacy(self, job):
+    with self.legacy_lock:
+      returncode = subprocess.call([job.preset.exec_path, os.path.abspath(job.source)])
+      outputs = copy2_r(job.preset.compiled_dst_path, job.preset.extract_path, **self.sync_opts)
+      rmtree_d(job.preset.compiled_dst_path)
+    return returncode == 0 and len(outputs) > 0, returncode, outputs
+
+  def compile_timed(self, job):
+    result = self.compile(job)
+    labels = {'status': 'ok' if result.status else 'failed', 'cached': str(result.cached).lower()}
+    metrics.observe('compile_seconds', result.duration, **labels)
+    metrics.emit('compile', source=result.source, returncode=result.returncode, duration=round(result.duration, 6), outputs=len(result.outputs), **labels)
+    return result
+
+  def compile_many(self, jobs):
+    return run_ordered(self.compile_timed, jobs, self.workers, 'compile')
+
+def log_compile_report(results):
+  for result in results:
+    logger.info('{:<7} {:>3} {:>6.02f}s {}{}'.format(
+      'ok' if result.status else 'failed', result.returncode, result.duration, result.source, ' (cached)' if result.cached else ''))
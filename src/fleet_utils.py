@@ -0,0 +1,127 @@
+import os
+import json
+import errno
+import fnmatch
+import tempfile
+from collections import namedtuple
+from src.log import init_logger
+from src.path_utils import ensure_dir, scan_tree, sync_file
+
+logger = init_logger('fleet_utils', 'setup.log')
+materialize_stats_t = namedtuple('MaterializeStats', ['instance_dir', 'linked', 'copied', 'skipped', 'removed'])
+
+manifest_name = '.fleet_manifest.json'
+# store bookkeeping that never belongs in an instance
+store_private = ('.setup_state.json', manifest_name)
+
+def split_patterns(value):
+  return [p.strip() for p in value.replace('\n', ',').split(',') if p.strip()]
+
+def match_any(rel_path, patterns):
+  return any(fnmatch.fnmatch(rel_path, p) for p in patterns)
+
+def read_manifest(instance_dir):
+  try:
+    with open(os.path.join(instance_dir, manifest_name), 'r') as fh:
+      return json.load(fh).get('files', {})
+  except (OSError, ValueError):
+    return {}
+
+def write_manifest(instance_dir, store_dir, files):
+  fd, tmp_path = tempfile.mkstemp(dir=instance_dir, suffix='.json')
+  with os.fdopen(fd, 'w') as fh:
+    json.dump({'store_dir': store_dir, 'files': files}, fh, indent=1)
+  os.replace(tmp_path, os.path.join(instance_dir, manifest_name))
+
+def replace_with_link(src_path, dst_path, symlink=False):
+  # linked under a temp name and swapped in, a running server never sees the file missing
+  tmp_path = os.path.join(os.path.dirname(dst_path), '.{}.{}.link'.format(os.path.basename(dst_path), os.getpid()))
+  if symlink:
+    os.symlink(src_path, tmp_path)
+  else:
+    os.link(src_path, tmp_path)
+  try:
+    os.replace(tmp_path, dst_path)
+  except BaseException:
+    os.unlink(tmp_path)
+    raise
+
+def is_linked(src_path, src_st, dst_path, symlink=False):
+  try:
+    if symlink:
+      return os.path.islink(dst_path) and os.readlink(dst_path) == src_path
+    dst_st = os.lstat(dst_path)
+  except OSError:
+    return False
+  return dst_st.st_ino == src_st.st_ino and dst_st.st_dev == src_st.st_dev
+
+def materialize(store_dir, instance_dir, link_mode='hardlink', copy_patterns=(), symlink_patterns=()):
+  # per-instance files (copy_patterns) are copied once and then owned by the instance,
+  # everything else points back into the store and is relinked when the store replaces it
+  store_dir = os.path.abspath(store_dir)
+  ensure_dir(instance_dir)
+  _, files = scan_tree(store_dir)
+  previous = read_manifest(instance_dir)
+  manifest = dict()
+  linked, copied, skipped = 0, 0, 0
+  created_dirs = set()
+  for rel_path, src_st in files:
+    key = rel_path.replace(os.sep, '/')
+    if key in store_private:
+      continue
+    src_path = os.path.join(store_dir, rel_path)
+    dst_path = os.path.join(instance_dir, rel_path)
+    dst_dir = os.path.dirname(dst_path)
+    if not dst_dir in created_dirs:
+      os.makedirs(dst_dir, exist_ok=True)
+      created_dirs.add(dst_dir)
+
+    if match_any(key, copy_patterns):
+      if os.path.lexists(dst_path) and not (key in previous and os.lstat(dst_path).st_ino == previous[key].get('ino')):
+        # the instance owns its copy, local edits are never overwritten
+        skipped += 1
+        continue
+      # missing, or still a link from before the pattern applied
+      if os.path.lexists(dst_path):
+        os.unlink(dst_path)
+      sync_file(src_path, dst_path)
+      copied += 1
+      continue
+
+    symlink = link_mode == 'symlink' or match_any(key, symlink_patterns)
+    if not is_linked(src_path, src_st, dst_path, symlink):
+      if link_mode == 'copy':
+        _, did_copy = sync_file(src_path, dst_path)
+        copied += int(did_copy)
+        skipped += int(not did_copy)
+        manifest[key] = {'ino': os.lstat(dst_path).st_ino, 'link': 'copy'}
+        continue
+      try:
+        replace_with_link(src_path, dst_path, symlink)
+      except OSError as e:
+        if symlink or not e.errno in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+          raise
+        # hardlinks cannot cross filesystems, fall back to a read-only symlink
+        logger.warning('cannot hardlink {}, using a symlink: {}'.format(dst_path, e))
+        symlink = True
+        replace_with_link(src_path, dst_path, symlink)
+      linked += 1
+    else:
+      skipped += 1
+    manifest[key] = {'ino': os.lstat(dst_path).st_ino, 'link': 'symlink' if symlink else 'hardlink'}
+
+  # files the store no longer has are removed, but only while they are still the entry we created
+  removed = 0
+  for key, ent in previous.items():
+    if key in manifest:
+      continue
+    dst_path = os.path.join(instance_dir, *key.split('/'))
+    try:
+      if os.lstat(dst_path).st_ino == ent.get('ino'):
+        os.unlink(dst_path)
+        removed += 1
+    except OSError:
+      pass
+  write_manifest(instance_dir, store_dir, manifest)
+  logger.info('materialized {}: {} linked, {} copied, {} unchanged, {} removed'.format(instance_dir, linked, copied, skipped, removed))
+  return materialize_stats_t(instance_dir, linked, copied, skipped, removed)
@@ -2,19 +2,25 @@ import typing as t
 import os
 import requests
 import re
-from io import IOBase
-from urllib.parse import urlparse
+import json
+import hashlib
+from io import IOBase, RawIOBase
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlparse, urljoin
 from time import time, sleep
-from collections import namedtuple, deque
-from src.log import init_logger
+from collections import namedtuple
+from src.log import init_logger, progress
 from src.path_utils import extract_file_type, ensure_dir, isfile
+from src.cache_utils import HashingWriter
+from src.pool_utils import run_ordered, url_host
+from src.metrics_utils import metrics
+from src.throttle_utils import throttle
+from src import retry_utils
+from src.retry_utils import RetryableConnectionError, PermanentHTTPError, StreamReadError, transient_status, is_transient, parse_retry_after
 
 logger = init_logger('http_utils', 'setup.log')
 file_info_t = namedtuple("FileInfo", field_names=['file_name', 'file_type',  'file_size', 'content_disposition', 'content_type'])
 
-class RetryableConnectionError(requests.exceptions.BaseHTTPError):
-  pass
-
 def new_session(request_headers=None) -> requests.Session:
   session = requests.Session()
   if request_headers:
@@ -22,79 +28,149 @@ def new_session(request_headers=None) -> requests.Session:
   logger.info('instantiating new session.')
   return session
 
+def size_session_pool(session: requests.Session, pool_size):
+  pool_size = max(int(pool_size), 1)
+  adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+  logger.info('session connection pool size: {}'.format(pool_size))
+  return session
+
 def url_basename(url) -> str:
   r = urlparse(url)
   return r.path.rstrip('/').split('/')[-1]
 
-def http_request(session: requests.Session, method, url, max_retry=3, force_retry=False, max_depth=10, **kwargs) -> t.Optional[requests.Response]:
+def http_request(session: requests.Session, method, url, max_retry=None, force_retry=False, max_depth=10, ok_status=(200,), policy=None, **kwargs) -> t.Optional[requests.Response]:
+  # transient failures are retried with jittered backoff or Retry-After, permanent ones return None at once
+  policy = retry_utils.default_policy if policy is None else policy
+  breaker = retry_utils.breaker
+  max_retry = policy.max_retry if max_retry is None else max_retry
+  kwargs.setdefault('timeout', policy.timeout)
   logger.info('{} {}'.format(method, url))
+  host = url_host(url)
+  redirects = 0
+  t0 = time()
   for i_retry in range(1, max_retry + 1):
-    for i_depth in range(max_depth):
-      try:
+    if not breaker.allow(url):
+      logger.warning('circuit open, skipping request: {}'.format(url))
+      metrics.count('http_circuit_skipped_total', host=url_host(url))
+      break
+    retry_after = None
+    host_failed = True
+    try:
+      for i_depth in range(max_depth):
+        t_req = time()
         resp = session.request(method, url, **kwargs)
+        metrics.observe('http_request_seconds', time() - t_req, method=method, host=url_host(url))
         if resp.status_code == 301 or resp.status_code == 302:
-          url = resp.headers.get('location')
-          if url is None:
-            url = resp.url
+          # the redirect target is kept, later retries do not walk the chain again
+          location = resp.headers.get('location')
+          url = resp.url if location is None else urljoin(url, location)
           logger.info('redirecting connection: {} {}'.format(i_depth, url))
+          redirects += 1
+          metrics.count('http_redirects_total', host=host)
           continue
-        elif resp.status_code == 200:
-          logger.info('{} ok'.format(method))
+        elif resp.status_code in ok_status:
+          logger.info('{} ok {}'.format(method, resp.status_code))
+          breaker.success(url)
+          metrics.emit('http', method=method, url=url, status=resp.status_code, latency=round(time() - t0, 6), redirects=redirects, retries=i_retry - 1)
           return resp
-        elif force_retry:
+        retry_after = parse_retry_after(resp.headers)
+        resp.close()
+        if resp.status_code in transient_status:
+          raise RetryableConnectionError('{} {}'.format(resp.status_code, resp.reason))
+        # the host did answer, so a refused request does not count against its circuit
+        breaker.success(url)
+        host_failed = False
+        if force_retry:
           raise RetryableConnectionError('{} {} forcing retry attempt'.format(resp.status_code, resp.reason))
-        else:
-          raise requests.ConnectionError('cannot establish connection: {} {}'.format(resp.status_code, resp.reason))
-      except (requests.Timeout, RetryableConnectionError):
-        logger.warning('retrying connection {}'.format(i_retry))
-        sleep(2.5)
-        break
-      except Exception as e:
+        raise PermanentHTTPError('cannot establish connection: {} {}'.format(resp.status_code, resp.reason))
+      raise requests.TooManyRedirects('exceeded {} redirects'.format(max_depth))
+    except Exception as e:
+      if not is_transient(e):
         logger.error('error occured: {}'.format(e))
+        metrics.count('http_errors_total', method=method, host=host)
+        metrics.emit('http', method=method, url=url, status=None, latency=round(time() - t0, 6), redirects=redirects, retries=i_retry - 1, error=str(e))
         return None
+      if host_failed:
+        breaker.failure(url)
+      backoff = policy.delay(i_retry, retry_after)
+      if i_retry == max_retry or backoff is None or breaker.is_open(url):
+        logger.warning('giving up after {} attempts: {}'.format(i_retry, e))
+        break
+      logger.warning('retrying connection {} in {:.02f}s: {}'.format(i_retry, backoff, e))
+      metrics.count('http_retries_total', host=host)
+      metrics.count('http_backoff_seconds_total', backoff, host=host)
+      sleep(backoff)
+  metrics.count('http_errors_total', method=method, host=host)
   return None
 
-def stream_to_buf(resp: requests.Response, buf: IOBase, chunk_size=4096, content_length=0, update_stdout_sec=5) -> bool:
+def iter_stream_chunks(resp: requests.Response, chunk_size=4096, max_chunk_size=1 << 20, fast=True):
+  # fast path reads the undecoded urllib3 stream into one reusable buffer, each view is only valid until the next one
+  raw = resp.raw
+  encoding = resp.headers.get('content-encoding', 'identity').lower()
+  if not fast or not hasattr(raw, 'readinto') or not encoding in ('', 'identity'):
+    yield from resp.iter_content(chunk_size)
+    return
+  # max_chunk_size may be a callable, it is re-read every chunk so a running stream follows throttle changes
+  chunk_limit = max_chunk_size if callable(max_chunk_size) else lambda: max_chunk_size
+  view = memoryview(bytearray(max(chunk_limit(), chunk_size)))
+  size = chunk_size
+  while True:
+    limit = max(chunk_limit(), chunk_size)
+    if limit > len(view):
+      view = memoryview(bytearray(limit))
+    size = min(size, limit)
+    n = raw.readinto(view[:size])
+    if not n:
+      return
+    yield view[:n]
+    if n == size and size < limit:
+      size = min(size * 2, limit)
+
+def preallocate(buf, length):
+  if length <= 0 or not hasattr(os, 'posix_fallocate') or not hasattr(buf, 'fileno'):
+    return False
+  try:
+    buf.flush()
+    os.posix_fallocate(buf.fileno(), buf.tell(), length)
+    return True
+  except (OSError, ValueError, AttributeError):
+    return False
+
+def stream_to_buf(resp: requests.Response, buf: IOBase, chunk_size=4096, content_length=0, fast=True) -> bool:
   total_l = 0
   dl = 0
-  dt = 0
-  t0 = time()
-  tn = t0
-  speed = 0
-  speed_avg = 0
-  speed_rec = deque(list(), maxlen=5)
 
   if content_length == 0:
     content_length = int(resp.headers.get('content-length', 0))
+  start_pos = buf.tell() if fast and hasattr(buf, 'tell') else 0
+  preallocated = fast and preallocate(buf, content_length)
+  host = url_host(resp.url or '')
+  # concurrent downloads share one aggregated progress line instead of each printing its own
+  task = progress.task(url_basename(resp.url or ''), content_length)
   try:
-    for b in resp.iter_content(chunk_size):
+    for i_chunk, b in enumerate(iter_stream_chunks(resp, chunk_size, max_chunk_size=throttle.chunk_size, fast=fast)):
       buf.write(b)
       bl = len(b)
+      throttle.net(host, bl)
       total_l += bl
       dl += bl
-      dt = time() - tn
-      if content_length > 0 and dt > update_stdout_sec:
-        ratio = total_l / content_length
-        speed = dl/max(dt, 0.01)
-        speed_rec.append(speed)
-        speed_avg = sum(speed_rec) / len(speed_rec)
-        est_s = (content_length - total_l) / speed_avg
-
-        est_m, est_s = divmod(est_s, 60)
-        est_h, est_m = divmod(est_m, 60)
-        print('downloading: {:>7.02%} | {:>12.02f} kb/s | est {:>3d}:{:>02d}:{:>02d}.{:<02d}'.format(ratio, speed_avg/1000, int(est_h), int(est_m), int(est_s), min(int(est_s%1*100), 99)))
-        dl = 0
-        tn = time()
-      elif dt > update_stdout_sec:
-        speed = dl/max(dt, 1e-8)
-        speed_rec.append(speed)
-        speed_avg = sum(speed_rec) / len(speed_rec)
-        dl = 0
-        tn = time()
-        print('downloading {:>7.02f}kb/s | {:g}kb'.format(speed_avg, total_l/1000))
+      # progress is sampled rather than reported for every small chunk
+      if bl < 1 << 18 and i_chunk & 15:
+        continue
+      task.update(dl)
+      dl = 0
   except Exception as e:
     logger.error('error ocurred during fetch stream: {}'.format(e))
     return False
+  finally:
+    task.close()
+    metrics.count('http_bytes_total', total_l, host=host)
+    if preallocated:
+      # drop any preallocated tail the stream did not fill, so a resume sees the real length
+      buf.flush()
+      os.ftruncate(buf.fileno(), start_pos + total_l)
   logger.info('download finished')
   return True
 
@@ -131,13 +207,298 @@ def parse_file_info(headers, url):
   content_length = parse_headers_content_length(headers)
   return file_info_t(file_name, file_type, content_length, content_disposition, content_type)
 
-def download_file(session, url, dst_dir, file_name='', chunk_size=4096, head_err_max_retry=5):
+def parse_headers_validators(headers, url):
+  return {
+    'url': url,
+    'etag': headers.get('etag'),
+    'last_modified': headers.get('last-modified'),
+    'size': parse_headers_content_length(headers),
+  }
+
+def parse_headers_content_range_start(headers):
+  r = re.match(r'bytes\s+(\d+)-(\d+)/(\d+|\*)', headers.get('content-range', ''))
+  if r is None:
+    return -1
+  return int(r.group(1))
+
+def read_part_meta(part_path):
+  try:
+    with open(part_path + '.json', 'r') as fh:
+      return json.load(fh)
+  except (OSError, ValueError):
+    return None
+
+def write_part_meta(part_path, meta):
+  with open(part_path + '.json', 'w') as fh:
+    json.dump(meta, fh)
+
+def delete_part(part_path):
+  for path in (part_path, part_path + '.json'):
+    if isfile(path):
+      os.unlink(path)
+
+def part_resume_offset(part_path, validators, accept_ranges):
+  meta = read_part_meta(part_path)
+  if meta is None or not isfile(part_path):
+    return 0
+  if not accept_ranges or not (validators['etag'] or validators['last_modified']):
+    return 0
+  for k in ('url', 'etag', 'last_modified', 'size'):
+    if meta.get(k) != validators[k]:
+      logger.info('partial download is outdated, discarding: {}'.format(part_path))
+      return 0
+  # segmented and preallocated parts are full length on disk, their size says nothing about what arrived
+  if meta.get('segmented') or meta.get('preallocated'):
+    logger.info('partial download was preallocated, restarting: {}'.format(part_path))
+    return 0
+  offset = os.path.getsize(part_path)
+  if validators['size'] > 0 and offset >= validators['size']:
+    logger.warning('partial download is not smaller than content, discarding: {}'.format(part_path))
+    return 0
+  return offset
+
+def hash_file(path, hasher=None, chunk_size=1 << 20):
+  hasher = hashlib.sha256() if hasher is None else hasher
+  with open(path, 'rb') as fh:
+    for b in iter(lambda: fh.read(chunk_size), b''):
+      hasher.update(b)
+  return hasher
+
+def split_ranges(size, segments):
+  step = -(-size // segments)
+  return [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+
+def download_segment(session, url, fd, start, end, validator, chunk_size=1 << 16, max_resume=3, task=None):
+  pos = start
+  host = url_host(url)
+  for i_attempt in range(max_resume + 1):
+    headers = {'Range': 'bytes={}-{}'.format(pos, end), 'If-Range': validator}
+    resp = http_request(session, 'GET', url, stream=True, allow_redirects=False, headers=headers, ok_status=(200, 206))
+    if resp is None:
+      return False
+    if resp.status_code != 206 or parse_headers_content_range_start(resp.headers) != pos:
+      resp.close()
+      return None
+    attempt_pos = pos
+    try:
+      for b in resp.iter_content(chunk_size):
+        # a server may send past the requested end, only our slice is written
+        b = b[:end + 1 - pos]
+        os.pwrite(fd, b, pos)
+        pos += len(b)
+        throttle.net(host, len(b))
+        if not task is None:
+          task.update(len(b))
+        if pos > end:
+          break
+    except Exception as e:
+      logger.warning('segment {}-{} interrupted at byte {}: {}'.format(start, end, pos, e))
+    finally:
+      resp.close()
+      metrics.count('http_bytes_total', pos - attempt_pos, host=host)
+    if pos == end + 1:
+      return True
+  return False
+
+def download_segmented(session, url, part_path, validators, segments, chunk_size=1 << 16):
+  # returns None when the server ignores Range so the caller can fall back to a single stream
+  size = validators['size']
+  ranges = split_ranges(size, segments)
+  logger.info('segmented download: {} bytes in {} ranges'.format(size, len(ranges)))
+  delete_part(part_path)
+  write_part_meta(part_path, dict(validators, segmented=True))
+  with open(part_path, 'wb') as fh:
+    fh.truncate(size)
+  fd = os.open(part_path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+  task = progress.task(url_basename(url), size)
+  try:
+    validator = validators['etag'] or validators['last_modified']
+    results = run_ordered(lambda r: download_segment(session, url, fd, r[0], r[1], validator, chunk_size, task=task), ranges, len(ranges), 'segment')
+  finally:
+    task.close()
+    os.close(fd)
+  if any(result is None for result in results):
+    logger.warning('server ignored range request, falling back to single stream: {}'.format(url))
+    delete_part(part_path)
+    return None
+  if not all(results) or os.path.getsize(part_path) != size:
+    logger.error('segmented download incomplete: {}'.format(url))
+    delete_part(part_path)
+    return False
+  return True
+
+def parse_accept_ranges(headers, url, host_caps=None):
+  # a host seen ignoring Range is not asked again even if it keeps advertising it
+  accept_ranges = headers.get('accept-ranges', '').lower() == 'bytes'
+  if host_caps is None:
+    return accept_ranges
+  return accept_ranges and host_caps.get(url, 'ranges') != False
+
+def download_to_path(session, url, dst_path, resp, chunk_size=4096, max_resume=3, segments=1, segment_threshold=0, host_caps=None):
+  # writes into dst_path.part next to a validator sidecar, resumes with Range on later attempts
+  part_path = dst_path + '.part'
+  validators = parse_headers_validators(resp.headers, url)
+  accept_ranges = parse_accept_ranges(resp.headers, url, host_caps)
+  offset = part_resume_offset(part_path, validators, accept_ranges)
+
+  if segments > 1 and offset == 0 and accept_ranges and validators['size'] > max(segment_threshold, 0) \
+      and (validators['etag'] or validators['last_modified']) and hasattr(os, 'pwrite'):
+    resp.close()
+    status = download_segmented(session, url, part_path, validators, segments)
+    if not host_caps is None and not status is False:
+      host_caps.set(url, ranges=not status is None)
+    if status is None:
+      resp = http_request(session, 'GET', url, stream=True, allow_redirects=False)
+      if resp is None:
+        return False, None
+      validators = parse_headers_validators(resp.headers, url)
+      accept_ranges = parse_accept_ranges(resp.headers, url, host_caps)
+    elif not status:
+      return False, None
+    else:
+      hasher = hash_file(part_path)
+      os.replace(part_path, dst_path)
+      delete_part(part_path)
+      return True, hasher.hexdigest()
+
+  for i_attempt in range(max_resume + 1):
+    if offset > 0:
+      resp.close()
+      logger.info('resuming download at byte {}: {}'.format(offset, dst_path))
+      range_headers = {
+        'Range': 'bytes={}-'.format(offset),
+        'If-Range': validators['etag'] or validators['last_modified'],
+      }
+      resp = http_request(session, 'GET', url, stream=True, allow_redirects=False, headers=range_headers, ok_status=(200, 206))
+      if resp is None:
+        return False, None
+      ranges_ok = resp.status_code == 206 and parse_headers_content_range_start(resp.headers) == offset
+      if not host_caps is None and (ranges_ok or (validators['etag'] and resp.headers.get('etag') == validators['etag'])):
+        # a 200 for unchanged content means Range was ignored, not that the file changed
+        host_caps.set(url, ranges=ranges_ok)
+      if not ranges_ok:
+        logger.warning('server did not honour range request, restarting download: {}'.format(url))
+        validators = parse_headers_validators(resp.headers, url)
+        accept_ranges = parse_accept_ranges(resp.headers, url, host_caps)
+        offset = 0
+
+    if offset == 0:
+      delete_part(part_path)
+      write_part_meta(part_path, validators)
+      hasher = hashlib.sha256()
+    else:
+      hasher = hash_file(part_path)
+
+    # stream_to_buf preallocates the rest of the file and only truncates it once the stream ends,
+    # the sidecar says so meanwhile so a run killed before that restarts instead of resuming past the data
+    preallocated = validators['size'] > offset and hasattr(os, 'posix_fallocate')
+    if preallocated:
+      write_part_meta(part_path, dict(validators, preallocated=True))
+    try:
+      with open(part_path, 'r+b' if offset > 0 else 'wb') as fh:
+        fh.seek(offset)
+        writer = HashingWriter(fh, hasher)
+        status = stream_to_buf(resp, writer, chunk_size=chunk_size, content_length=max(validators['size'] - offset, 0))
+    finally:
+      if preallocated:
+        write_part_meta(part_path, validators)
+    resp.close()
+    offset += writer.size
+
+    if status:
+      break
+    if not accept_ranges or not (validators['etag'] or validators['last_modified']) or i_attempt == max_resume:
+      logger.warning('download interrupted, partial file kept: {}'.format(part_path))
+      return False, None
+    logger.warning('download interrupted at byte {}, resuming {}'.format(offset, i_attempt + 1))
+
+  if validators['size'] > 0 and offset != validators['size']:
+    logger.error('content length mismatch: expected {} got {}, discarding partial download'.format(validators['size'], offset))
+    delete_part(part_path)
+    return False, None
+
+  os.replace(part_path, dst_path)
+  delete_part(part_path)
+  return True, hasher.hexdigest()
+
+def download_cached(session, url, cache, chunk_size=4096, segments=1, segment_threshold=0, host_caps=None):
+  entry = cache.lookup(url)
+  headers = cache.conditional_headers(entry)
+  logger.info('{} file: {}'.format('revalidating cached' if entry else 'retrieving', url))
+  resp = http_request(session, 'GET', url, stream=True, allow_redirects=False, headers=headers, ok_status=(200, 304))
+  if resp is None:
+    if entry is None:
+      logger.error('unable to retrieve GET request')
+      return False, None, None
+    logger.warning('origin unreachable, using cached copy: {}'.format(url))
+    return True, cache.blob_path(entry['sha256']), file_info_t(**entry['file_info'])
+
+  if resp.status_code == 304:
+    resp.close()
+    logger.info('cached file is current: {}'.format(url))
+    if not host_caps is None:
+      host_caps.set(url, validators=True)
+    cache.touch(url)
+    return True, cache.blob_path(entry['sha256']), file_info_t(**entry['file_info'])
+
+  if headers and cache.headers_match(entry, resp.headers):
+    # the origin ignored the conditional request, the body is not read once the headers show nothing changed
+    resp.close()
+    logger.info('cached file is current by response headers: {}'.format(url))
+    if not host_caps is None:
+      host_caps.set(url, validators=False)
+    cache.touch(url)
+    return True, cache.blob_path(entry['sha256']), file_info_t(**entry['file_info'])
+
+  file_info = parse_file_info(resp.headers, url)
+  etag, last_modified = resp.headers.get('etag'), resp.headers.get('last-modified')
+  tmp_path = cache.temp_path(url)
+  status, sha256 = download_to_path(session, url, tmp_path, resp, chunk_size=chunk_size, segments=segments, segment_threshold=segment_threshold, host_caps=host_caps)
+  if not status:
+    return False, None, file_info
+
+  if not entry is None and entry['sha256'] == sha256:
+    logger.info('content unchanged: {}'.format(url))
+  file_size = os.path.getsize(tmp_path)
+  file_info = file_info._replace(file_size=file_size)
+  blob_path = cache.store(url, tmp_path, sha256, file_size, etag, last_modified, file_info)
+  return True, blob_path, file_info
+
+def use_head_request(url, dst_dir, file_name='', head='auto', host_caps=None):
+  # HEAD only pays off when a local copy may already be current, a miss costs a second round-trip
+  if head == 'always':
+    return True
+  if head != 'auto' or host_caps is None or host_caps.get(url, 'head') == False:
+    return False
+  return isfile(os.path.join(dst_dir, file_name or url_basename(url)))
+
+def download_file(session, url, dst_dir, file_name='', chunk_size=4096, head_err_max_retry=5, host_limiter=None, cache=None, segments=1, segment_threshold=0, host_caps=None, head='auto', mirror=None):
+  if not mirror is None:
+    # checked before the origin's host slot is taken, a mirror hit never waits on a slow origin
+    result = mirror.download(url, dst_dir, cache)
+    if not result is None:
+      return result
+
+  if not host_limiter is None:
+    with host_limiter.slot(url):
+      return download_file(session, url, dst_dir, file_name, chunk_size, head_err_max_retry, cache=cache, segments=segments, segment_threshold=segment_threshold, host_caps=host_caps, head=head)
+
+  if not cache is None:
+    return download_cached(session, url, cache, chunk_size, segments, segment_threshold, host_caps)
+
   logger.info('retrieving file info: {}'.format(url))
 
   skip_get_request = False
-  resp = http_request(session, 'HEAD', url, allow_redirects=False, force_retry=True)
+  resp = None
+  if use_head_request(url, dst_dir, file_name, head, host_caps):
+    # only the legacy mode retries a rejected HEAD, otherwise one refusal is enough to switch to GET
+    resp = http_request(session, 'HEAD', url, max_retry=None if head == 'always' else 1, allow_redirects=False, force_retry=head == 'always')
+    if not host_caps is None:
+      host_caps.set(url, head=not resp is None)
+    if resp is None:
+      logger.warning('cannot retrieve HEAD, changing method to GET')
   if resp is None:
-    logger.warning('cannot retrieve HEAD, changing method to GET')
+    # single request mode, the headers of a streaming GET decide whether the body is needed at all
     resp = http_request(session, 'GET', url, allow_redirects=False, stream=True)
     if resp is None:
       logger.error('unable to retrieve GET request')
@@ -165,8 +526,57 @@ def download_file(session, url, dst_dir, file_name='', chunk_size=4096, head_err
     return False, dst_path, file_info
   
   logger.info('downloading to {}'.format(dst_path))
-  with open(dst_path, 'wb') as fh:
-    status = stream_to_buf(resp, fh, content_length=file_info.file_size)
-  resp.close()
+  status, _ = download_to_path(session, url, dst_path, resp, chunk_size=chunk_size, segments=segments, segment_threshold=segment_threshold, host_caps=host_caps)
+  return status, dst_path, file_info
+
+class StreamReader(RawIOBase):
+  # sequential file view of a response body for readers like tarfile's stream mode,
+  # bytes passing through are hashed, counted and throttled like any other download
+  def __init__(self, resp):
+    self.resp = resp
+    self.host = url_host(resp.url or '')
+    self.hasher = hashlib.sha256()
+    self.nbytes = 0
+    self.task = progress.task(url_basename(resp.url or ''), parse_headers_content_length(resp.headers))
 
-  return status, dst_path, file_info
\ No newline at end of file
+  def readable(self):
+    return True
+
+  def read(self, n=-1):
+    try:
+      b = self.resp.raw.read(n if not n is None and n >= 0 else None, decode_content=True)
+    except (requests.exceptions.RequestException, requests.exceptions.BaseHTTPError, OSError) as e:
+      raise StreamReadError('response body interrupted after {} bytes: {}'.format(self.nbytes, e)) from e
+    self.hasher.update(b)
+    self.nbytes += len(b)
+    throttle.net(self.host, len(b))
+    self.task.update(len(b))
+    return b
+
+  def readinto(self, buf):
+    b = self.read(len(buf))
+    buf[:len(b)] = b
+    return len(b)
+
+  def close(self):
+    if not self.closed:
+      metrics.count('http_bytes_total', self.nbytes, host=self.host)
+      self.task.close()
+    super().close()
+
+@contextmanager
+def stream_response(session, url, host_limiter=None):
+  # yields (reader, file_info) with the body still on the wire, or (None, None) when the GET failed
+  with host_limiter.slot(url) if not host_limiter is None else nullcontext():
+    logger.info('streaming file: {}'.format(url))
+    resp = http_request(session, 'GET', url, stream=True, allow_redirects=False)
+    if resp is None:
+      logger.error('unable to retrieve GET request')
+      yield None, None
+      return
+    reader = StreamReader(resp)
+    try:
+      yield reader, parse_file_info(resp.headers, url)
+    finally:
+      reader.close()
+      resp.close()
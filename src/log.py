@@ -1,22 +1,206 @@
 import os
+import json
+import queue
+import atexit
 import logging
+import threading
+import logging.handlers
+from time import monotonic, strftime, localtime
 
 fmt_default = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 fmt_simple = logging.Formatter('{name:<12} [{levelname:<7}]: {message}', style='{')
 
+class JsonFormatter(logging.Formatter):
+  def format(self, record):
+    rec = {
+      'ts': round(record.created, 3),
+      'time': strftime('%Y-%m-%dT%H:%M:%S', localtime(record.created)),
+      'logger': record.name,
+      'level': record.levelname,
+      'thread': record.threadName,
+      # the queue handler has already folded any traceback into the message
+      'message': record.getMessage(),
+    }
+    return json.dumps(rec, default=str)
+
+fmt_json = JsonFormatter()
+
+class LogRouter(logging.Handler):
+  # the only handler behind the queue listener: every logger's records end up here on the writer thread,
+  # which owns one stdout handler and one file handler per log file for the whole process
+  def __init__(self):
+    super().__init__()
+    self.routes = dict()
+    self.stdout_handler = logging.StreamHandler()
+    self.stdout_handler.setFormatter(fmt_simple)
+    self.file_handlers = dict()
+    self.file_formatter = fmt_default
+
+  def file_path(self, file_name):
+    # json records go to a .jsonl next to the text log, so lines written before the format is configured never mix in
+    if self.file_formatter is fmt_default:
+      return os.path.join('./log', file_name)
+    return os.path.join('./log', os.path.splitext(file_name)[0] + '.jsonl')
+
+  def open_file(self, file_name):
+    os.makedirs('./log', exist_ok=True)
+    handler = logging.FileHandler(self.file_path(file_name))
+    handler.setFormatter(self.file_formatter)
+    return handler
+
+  # routes and files change on the caller's thread, the handler lock keeps the writer thread out meanwhile
+  def add_route(self, name, file_name, do_stream_stdout):
+    with self.lock:
+      if not file_name is None and not file_name in self.file_handlers:
+        self.file_handlers[file_name] = self.open_file(file_name)
+      self.routes[name] = (file_name, do_stream_stdout)
+
+  def set_file_formatter(self, formatter):
+    with self.lock:
+      if formatter is self.file_formatter:
+        return
+      self.file_formatter = formatter
+      for file_name, handler in list(self.file_handlers.items()):
+        self.file_handlers[file_name] = self.open_file(file_name)
+        handler.close()
+
+  def emit(self, record):
+    file_name, do_stream_stdout = self.routes.get(record.name, (None, True))
+    if do_stream_stdout and record.levelno >= self.stdout_handler.level:
+      self.stdout_handler.handle(record)
+    if not file_name is None:
+      self.file_handlers[file_name].handle(record)
+
+  def flush(self):
+    with self.lock:
+      self.stdout_handler.flush()
+      for handler in self.file_handlers.values():
+        handler.flush()
+
+  def close(self):
+    with self.lock:
+      for handler in self.file_handlers.values():
+        handler.close()
+    super().close()
+
+log_queue = queue.SimpleQueue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+router = LogRouter()
+listener = logging.handlers.QueueListener(log_queue, router)
+listener.start()
+
+def stop_listener():
+  # drains whatever is still queued before the interpreter goes away
+  if not listener._thread is None:
+    listener.stop()
+  router.flush()
+
+atexit.register(stop_listener)
+
 def init_logger(name: str, file_name=None, level=logging.DEBUG, do_stream_file=True, do_stream_stdout=True):
   logger = logging.getLogger(name)
   logger.setLevel(level)
   logger.handlers.clear()
-  if do_stream_stdout:
-    logger_h = logging.StreamHandler()
-    logger_h.setFormatter(fmt_simple)
-    logger.addHandler(logger_h)
-  if do_stream_file:
-    os.makedirs('./log', exist_ok=True)
-    if file_name is None:
-      file_name = name + '.log'
-    logger_h = logging.FileHandler(os.path.join('./log', file_name))
-    logger_h.setFormatter(fmt_default)
-    logger.addHandler(logger_h)
-  return logger
\ No newline at end of file
+  logger.propagate = False
+  if do_stream_file and file_name is None:
+    file_name = name + '.log'
+  router.add_route(name, file_name if do_stream_file else None, do_stream_stdout)
+  logger.addHandler(queue_handler)
+  return logger
+
+def configure_logging(file_format='text', stdout_level=logging.DEBUG):
+  router.set_file_formatter(fmt_json if file_format == 'json' else fmt_default)
+  router.stdout_handler.setLevel(stdout_level)
+
+class ProgressTask:
+  def __init__(self, progress, name, total=0, unit='B'):
+    self.progress = progress
+    self.name = name
+    self.total = total
+    self.unit = unit
+    self.done = 0
+
+  def update(self, n):
+    self.done += n
+    self.progress.maybe_report()
+
+  def close(self):
+    self.progress.remove(self)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+class Progress:
+  # concurrent transfers and extractions report here instead of printing, and a single line summarizing all of them
+  # is logged at most every interval seconds by whichever worker happens to pass the deadline
+  def __init__(self, interval=5, logger_name='progress'):
+    self.interval = interval
+    self.logger = init_logger(logger_name, 'setup.log')
+    self._lock = threading.Lock()
+    self.tasks = list()
+    self.next_report = monotonic() + interval
+    self.last_done = dict()
+    self.last_t = monotonic()
+
+  def task(self, name, total=0, unit='B'):
+    task = ProgressTask(self, name, total, unit)
+    with self._lock:
+      if not self.tasks:
+        # the first line after an idle stretch comes one interval after work resumes
+        self.next_report = monotonic() + self.interval
+        self.last_t = monotonic()
+      self.tasks.append(task)
+    return task
+
+  def remove(self, task):
+    with self._lock:
+      if task in self.tasks:
+        self.tasks.remove(task)
+      self.last_done.pop(id(task), None)
+
+  def maybe_report(self):
+    # unlocked fast path, the deadline check costs one comparison per update
+    if monotonic() < self.next_report or self.interval <= 0:
+      return
+    with self._lock:
+      now = monotonic()
+      if now < self.next_report:
+        return
+      self.next_report = now + self.interval
+      line = self.format_line(now)
+    if line:
+      self.logger.info(line)
+
+  def format_line(self, now):
+    dt = max(now - self.last_t, 1e-6)
+    self.last_t = now
+    parts = list()
+    rate = None
+    for task in self.tasks:
+      delta = task.done - self.last_done.get(id(task), 0)
+      self.last_done[id(task)] = task.done
+      if task.unit == 'B':
+        rate = (rate or 0) + delta
+      if task.total > 0:
+        parts.append('{} {:.0%}'.format(task.name, min(task.done / task.total, 1)))
+      else:
+        parts.append('{} {}'.format(task.name, format_amount(task.done, task.unit)))
+    if not parts:
+      return ''
+    shown = parts[:4] + (['+{} more'.format(len(parts) - 4)] if len(parts) > 4 else [])
+    if rate is None:
+      return '{} active | {}'.format(len(parts), ', '.join(shown))
+    return '{} active | {}/s | {}'.format(len(parts), format_amount(rate / dt, 'B'), ', '.join(shown))
+
+def format_amount(n, unit):
+  if unit != 'B':
+    return '{:g} {}'.format(n, unit)
+  for suffix in ('B', 'kB', 'MB', 'GB'):
+    if n < 1000 or suffix == 'GB':
+      return '{:.01f} {}'.format(n, suffix)
+    n /= 1000
+
+progress = Progress()
@@ -0,0 +1,177 @@
+import os
+import json
+import threading
+from time import time, perf_counter, strftime
+from contextlib import contextmanager
+from src.log import init_logger
+
+logger = init_logger('metrics_utils', 'setup.log')
+
+def prom_escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prom_labels(labels):
+  if not labels:
+    return ''
+  return '{' + ','.join('{}="{}"'.format(k, prom_escape(v)) for k, v in labels) + '}'
+
+class Metrics:
+  # per-phase timings and counters, written as json lines while running and as a prometheus textfile at close
+  prefix = 'l4d2_setup_'
+
+  def __init__(self):
+    self.enabled = False
+    self.jsonl_path = None
+    self.prom_path = None
+    self.run_id = None
+    self.t0 = time()
+    self._fh = None
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self.counters = dict()
+    self.summaries = dict()
+
+  def open(self, jsonl_path='', prom_path=''):
+    self.jsonl_path = jsonl_path or None
+    self.prom_path = prom_path or None
+    self.enabled = not (self.jsonl_path is None and self.prom_path is None)
+    self.run_id = strftime('%Y%m%dT%H%M%S')
+    self.t0 = time()
+    if not self.jsonl_path is None:
+      os.makedirs(os.path.dirname(os.path.abspath(self.jsonl_path)), exist_ok=True)
+      self._fh = open(self.jsonl_path, 'a', encoding='utf8')
+    if self.enabled:
+      logger.info('metrics enabled: {} {}'.format(self.jsonl_path or '-', self.prom_path or '-'))
+    return self
+
+  def labels(self):
+    return getattr(self._local, 'labels', {})
+
+  @contextmanager
+  def context(self, **labels):
+    # labels set here are attached to every event emitted from the same thread
+    prev = self.labels()
+    self._local.labels = dict(prev, **labels)
+    try:
+      yield
+    finally:
+      self._local.labels = prev
+
+  def emit(self, event, **fields):
+    if self._fh is None:
+      return
+    rec = {'ts': round(time(), 3), 'run': self.run_id, 'event': event}
+    rec.update(self.labels())
+    rec.update(fields)
+    line = json.dumps(rec, default=str)
+    with self._lock:
+      self._fh.write(line + '\n')
+
+  def count(self, name, value=1, **labels):
+    if not self.enabled:
+      return
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      self.counters[key] = self.counters.get(key, 0) + value
+
+  def observe(self, name, value, **labels):
+    if not self.enabled:
+      return
+    key = (name, tuple(sorted(labels.items())))
+    with self._lock:
+      s = self.summaries.get(key)
+      if s is None:
+        s = self.summaries[key] = [0, 0.0]
+      s[0] += 1
+      s[1] += value
+
+  @contextmanager
+  def phase(self, name, **labels):
+    # the yielded dict collects extra fields for the event, 'status' defaults to ok unless an exception escapes
+    fields = dict()
+    t0 = perf_counter()
+    status = 'ok'
+    try:
+      yield fields
+    except BaseException:
+      status = 'error'
+      raise
+    finally:
+      if self.enabled:
+        duration = perf_counter() - t0
+        status = fields.pop('status', status)
+        self.observe('phase_seconds', duration, phase=name, status=status, **labels)
+        self.emit(name, duration=round(duration, 6), status=status, **dict(labels, **fields))
+
+  def group_by(self, name, label):
+    totals = dict()
+    with self._lock:
+      items = list(self.summaries.items())
+    for (key, labels), (n, total) in items:
+      labels = dict(labels)
+      if key == name and label in labels:
+        totals[labels[label]] = totals.get(labels[label], 0) + total
+    return sorted(totals.items(), key=lambda x: -x[1])
+
+  def format_prometheus(self):
+    lines = list()
+    with self._lock:
+      counters = sorted(self.counters.items())
+      summaries = sorted(self.summaries.items())
+    typed = set()
+    for (name, labels), value in counters:
+      if not name in typed:
+        typed.add(name)
+        lines.append('# TYPE {}{} counter'.format(self.prefix, name))
+      lines.append('{}{}{} {}'.format(self.prefix, name, prom_labels(labels), value))
+    for (name, labels), (n, total) in summaries:
+      if not name in typed:
+        typed.add(name)
+        lines.append('# TYPE {}{} summary'.format(self.prefix, name))
+      lines.append('{}{}_count{} {}'.format(self.prefix, name, prom_labels(labels), n))
+      lines.append('{}{}_sum{} {:.6f}'.format(self.prefix, name, prom_labels(labels), total))
+    lines.append('# TYPE {}run_duration_seconds gauge'.format(self.prefix))
+    lines.append('{}run_duration_seconds {:.3f}'.format(self.prefix, time() - self.t0))
+    lines.append('# TYPE {}run_timestamp_seconds gauge'.format(self.prefix))
+    lines.append('{}run_timestamp_seconds {:.0f}'.format(self.prefix, self.t0))
+    return '\n'.join(lines) + '\n'
+
+  def write_prometheus(self):
+    if self.prom_path is None:
+      return
+    # the textfile collector may read at any time, so the file is replaced atomically
+    os.makedirs(os.path.dirname(os.path.abspath(self.prom_path)), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(self.prom_path, os.getpid())
+    with open(tmp_path, 'w', encoding='utf8') as fh:
+      fh.write(self.format_prometheus())
+    os.replace(tmp_path, self.prom_path)
+
+  def print_summary(self, top=5):
+    print()
+    print('run summary: {:.02f}s'.format(time() - self.t0))
+    for title, label in (('slowest plugins:', 'plugin'), ('slowest hosts:', 'host'), ('slowest workshop items:', 'workshop')):
+      totals = self.group_by('phase_seconds', label)
+      if not totals:
+        continue
+      print('  {}'.format(title))
+      for value, total in totals[:top]:
+        print('    {:>9.02f}s {}'.format(total, value))
+    nbytes = sum(v for (name, _), v in self.counters.items() if name == 'http_bytes_total')
+    retries = sum(v for (name, _), v in self.counters.items() if name == 'http_retries_total')
+    print('  transferred {:.02f} MB, {} retries'.format(nbytes / 1e6, retries))
+
+  def close(self):
+    if not self.enabled:
+      return
+    self.emit('run', duration=round(time() - self.t0, 3), counters={'{}{}'.format(name, prom_labels(labels)): v for (name, labels), v in self.counters.items()})
+    self.print_summary()
+    try:
+      self.write_prometheus()
+    except OSError as e:
+      logger.warning('cannot write prometheus textfile {}: {}'.format(self.prom_path, e))
+    if not self._fh is None:
+      self._fh.close()
+      self._fh = None
+    self.enabled = False
+
+metrics = Metrics()
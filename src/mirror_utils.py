@@ -0,0 +1,152 @@
+import os
+import json
+import shutil
+import tarfile
+import tempfile
+import threading
+from time import time
+from src.log import init_logger
+from src.path_utils import ensure_dir, isfile, isdir, default_file_mode
+from src.cache_utils import DownloadCache, HashingWriter
+from src.http_utils import http_request, stream_to_buf, file_info_t
+from src.metrics_utils import metrics
+
+logger = init_logger('mirror_utils', 'setup.log')
+
+# a bundle is a download cache directory, its manifest maps every url to a blob and the response metadata,
+# bundle.json adds what prefetch resolved besides files
+bundle_name = 'bundle.json'
+
+def blob_rel_path(sha256):
+  return '{}/{}/{}'.format(DownloadCache.blobs_dir_name, sha256[:2], sha256)
+
+def write_bundle_info(bundle_dir, info):
+  fd, tmp_path = tempfile.mkstemp(dir=bundle_dir, suffix='.json')
+  with os.fdopen(fd, 'w') as fh:
+    json.dump(info, fh, indent=1)
+  os.replace(tmp_path, os.path.join(bundle_dir, bundle_name))
+
+def prune_bundle(bundle, urls):
+  # urls the current steamapp_info no longer references are dropped, blobs still shared by other urls stay
+  stale = [url for url in list(bundle.entries) if not url in urls]
+  for url in stale:
+    bundle.discard(url)
+  if isdir(bundle.temp_dir) and not os.listdir(bundle.temp_dir):
+    os.rmdir(bundle.temp_dir)
+  return len(stale)
+
+def archive_bundle(bundle_dir, archive_path):
+  # blobs are already compressed archives, a plain tar keeps packing and unpacking at disk speed
+  tmp_path = '{}.{}.tmp'.format(archive_path, os.getpid())
+  with tarfile.open(tmp_path, 'w') as th:
+    for name in sorted(os.listdir(bundle_dir)):
+      if name != DownloadCache.temp_dir_name:
+        th.add(os.path.join(bundle_dir, name), arcname=name)
+  os.replace(tmp_path, archive_path)
+  return archive_path
+
+class Mirror:
+  # a prefetch bundle in a local directory or behind a lan http base url, consulted before the origin,
+  # anything it does not hold or fails to deliver falls through to the origin
+  def __init__(self, session, base):
+    self.session = session
+    self.base = base
+    self.is_http = base.startswith(('http://', 'https://'))
+    self._lock = threading.Lock()
+    self.entries = None
+    self.info = dict()
+
+  def location(self, rel_path):
+    if self.is_http:
+      return '{}/{}'.format(self.base.rstrip('/'), rel_path)
+    return os.path.join(self.base, *rel_path.split('/'))
+
+  def read_json(self, rel_path):
+    if not self.is_http:
+      with open(self.location(rel_path), 'r') as fh:
+        return json.load(fh)
+    resp = http_request(self.session, 'GET', self.location(rel_path), max_retry=1)
+    if resp is None:
+      raise OSError('cannot retrieve {}'.format(self.location(rel_path)))
+    return resp.json()
+
+  def load(self):
+    with self._lock:
+      if not self.entries is None:
+        return
+      self.entries = dict()
+      try:
+        self.entries.update(self.read_json(DownloadCache.manifest_name).get('entries', {}))
+        self.info = self.read_json(bundle_name)
+      except (OSError, ValueError) as e:
+        logger.warning('mirror unavailable, using origins: {} {}'.format(self.base, e))
+        return
+      logger.info('mirror {}: {} urls, prefetched {}'.format(self.base, len(self.entries), self.info.get('platform', '')))
+
+  def lookup(self, url):
+    self.load()
+    return self.entries.get(url)
+
+  def workshop_details(self):
+    self.load()
+    return self.info.get('workshop', {})
+
+  def fetch(self, entry, dst_path):
+    # the blob is hashed on the way in, a corrupt or partial copy never replaces dst_path
+    ensure_dir(os.path.dirname(dst_path))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst_path), prefix='.mirror', suffix='.tmp')
+    try:
+      with os.fdopen(fd, 'wb') as fh:
+        writer = HashingWriter(fh)
+        if self.is_http:
+          resp = http_request(self.session, 'GET', self.location(blob_rel_path(entry['sha256'])), max_retry=1, stream=True)
+          if resp is None or not stream_to_buf(resp, writer):
+            return False
+        else:
+          with open(self.location(blob_rel_path(entry['sha256'])), 'rb') as src_fh:
+            shutil.copyfileobj(src_fh, writer, 1 << 20)
+      if writer.hexdigest() != entry['sha256'] or writer.size != entry['size']:
+        logger.warning('mirror blob does not match its manifest: {}'.format(entry['sha256']))
+        return False
+      os.chmod(tmp_path, default_file_mode)
+      os.replace(tmp_path, dst_path)
+      return True
+    except OSError as e:
+      logger.warning('cannot read mirror blob {}: {}'.format(entry['sha256'], e))
+      return False
+    finally:
+      if isfile(tmp_path):
+        os.unlink(tmp_path)
+
+  def download(self, url, dst_dir, cache=None):
+    # same return shape as download_file, None sends the caller to the origin
+    entry = self.lookup(url)
+    if entry is None:
+      metrics.count('mirror_requests_total', status='miss')
+      return None
+    file_info = file_info_t(**entry['file_info'])
+    t0 = time()
+    if not cache is None:
+      cached = cache.lookup(url)
+      if not cached is None and cached['sha256'] == entry['sha256']:
+        cache.touch(url)
+        metrics.count('mirror_requests_total', status='cached')
+        return True, cache.blob_path(entry['sha256']), file_info
+      tmp_path = cache.temp_path(url)
+      if not self.fetch(entry, tmp_path):
+        metrics.count('mirror_requests_total', status='failed')
+        return None
+      dst_path = cache.store(url, tmp_path, entry['sha256'], entry['size'], entry.get('etag'), entry.get('last_modified'), file_info)
+    else:
+      dst_path = os.path.join(dst_dir, file_info.file_name)
+      if isfile(dst_path) and os.path.getsize(dst_path) == entry['size']:
+        logger.info('file already exists: {}'.format(dst_path))
+        metrics.count('mirror_requests_total', status='cached')
+        return True, dst_path, file_info
+      if not self.fetch(entry, dst_path):
+        metrics.count('mirror_requests_total', status='failed')
+        return None
+    logger.info('retrieved from mirror in {:.02f}s: {}'.format(time() - t0, url))
+    metrics.count('mirror_requests_total', status='hit')
+    metrics.count('mirror_bytes_total', entry['size'])
+    return True, dst_path, file_info
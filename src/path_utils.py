@@ -1,15 +1,37 @@
+import io
 import os
+import mmap
+import time
+import zlib
+import errno
 import shutil
+import hashlib
 import tempfile
 import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from collections import namedtuple
-from src.log import init_logger
+from src.log import init_logger, progress
+from src.metrics_utils import metrics
+from src.throttle_utils import throttle
 from zipfile import ZipFile
 import tarfile
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 logger = init_logger('pathlib', 'setup.log')
 extracted_file_type_t = namedtuple('ExtractedFileType', ['src', 'file_name', 'file_extension'])
 
+def read_umask():
+  umask = os.umask(0)
+  os.umask(umask)
+  return umask
+
+# mkstemp creates files as 0600, files swapped into the install tree get the mode a plain open() would give them
+default_file_mode = 0o666 & ~read_umask()
+
 def isdir(path):
   return os.path.exists(path) and os.path.isdir(path)
 
@@ -18,7 +40,10 @@ def isfile(path):
 
 def ensure_dir(path):
   if not isdir(path):
-    os.makedirs(path)
+    try:
+      os.makedirs(path)
+    except FileExistsError:
+      return None
     return path
   return None
 
@@ -57,44 +82,303 @@ def copy2(src, dst):
   ensure_dir(os.path.dirname(dst))
   return shutil.copy2(src, dst)
 
-def copy2_r(src, dst):
-  for root, dirs, files, in os.walk(src):
-    rel_dest = os.path.join(dst, os.path.relpath(root, src))
-    for d in dirs:
-      dst_dir = os.path.join(rel_dest, d)
-      d_dst = ensure_dir(dst_dir)
-      if not d_dst is None:
-        print(') {}'.format(dst_dir))
-    for f in files:
-      dst_file = os.path.join(rel_dest, f)
-      d_dst = copy2(os.path.join(root, f), dst_file)
-      if not d_dst is None:
-        print('> {}'.format(d_dst))
+def copy2_r(src, dst, workers=1, hash_check=False):
+  # every file now present under dst, copied or already identical
+  return sync_tree(src, dst, workers, hash_check).paths
 
-def archive_extract_zip(path, dst, tmpdir=None):
-  if tmpdir is None:
-    zip_tempdir, d_zip_tempdir = mkdtemp()
+sync_stats_t = namedtuple('SyncStats', ['files', 'skipped', 'bytes', 'dirs', 'paths'])
+
+FICLONE = 0x40049409
+copy_methods = ('reflink', 'copy_file_range', 'read_write')
+# (src st_dev, dst st_dev) -> methods still worth trying, so an unsupported one fails only once per device pair
+_copy_methods = dict()
+_copy_methods_lock = threading.Lock()
+
+def get_copy_methods(src_dev, dst_dev):
+  with _copy_methods_lock:
+    methods = _copy_methods.get((src_dev, dst_dev))
+    if methods is None:
+      methods = [m for m in copy_methods if not (m == 'reflink' and (fcntl is None or src_dev != dst_dev)) and not (m == 'copy_file_range' and not hasattr(os, 'copy_file_range'))]
+      _copy_methods[(src_dev, dst_dev)] = methods
+    return list(methods)
+
+def drop_copy_method(src_dev, dst_dev, method):
+  with _copy_methods_lock:
+    methods = _copy_methods.get((src_dev, dst_dev), [])
+    if method in methods and len(methods) > 1:
+      logger.info('{} unsupported between devices {} {}, falling back'.format(method, src_dev, dst_dev))
+      methods.remove(method)
+
+def copy_fd(src_fd, dst_fd, size, method, chunk_size=1 << 20):
+  if method == 'reflink':
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+  elif method == 'copy_file_range':
+    # throttled copies go in small steps so the write budget is spent evenly
+    step = throttle.chunk_size('disk') if throttle.disk_active else size
+    copied = 0
+    while copied < size:
+      n = os.copy_file_range(src_fd, dst_fd, min(size - copied, step))
+      if n == 0:
+        break
+      copied += n
+      throttle.disk(n)
   else:
-    d_zip_tempdir = lambda: None
-    zip_tempdir = tmpdir
-  with ZipFile(path) as zh:
-    zh.extractall(zip_tempdir)
-    copy2_r(zip_tempdir, dst)
-  if tmpdir is None:
-    d_zip_tempdir()
+    chunk_size = min(chunk_size, throttle.chunk_size('disk', chunk_size))
+    for b in iter(lambda: os.read(src_fd, chunk_size), b''):
+      os.write(dst_fd, b)
+      throttle.disk(len(b))
+
+def clone_file(src_path, dst_path, src_st, dst_dev):
+  # reflink when the filesystem can share extents, then an in-kernel copy, then plain reads and writes
+  dst_dir = os.path.dirname(dst_path)
+  fd, tmp_path = tempfile.mkstemp(dir=dst_dir, prefix='.' + os.path.basename(dst_path), suffix='.tmp')
+  try:
+    src_fd = os.open(src_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+      for method in get_copy_methods(src_st.st_dev, dst_dev):
+        try:
+          copy_fd(src_fd, fd, src_st.st_size, method)
+          break
+        except OSError as e:
+          if method == 'read_write' or not e.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EBADF, errno.EPERM):
+            raise
+          drop_copy_method(src_st.st_dev, dst_dev, method)
+          os.lseek(src_fd, 0, os.SEEK_SET)
+          os.lseek(fd, 0, os.SEEK_SET)
+          os.ftruncate(fd, 0)
+    finally:
+      os.close(src_fd)
+    os.close(fd)
+    fd = None
+    shutil.copystat(src_path, tmp_path)
+    os.replace(tmp_path, dst_path)
+  except BaseException:
+    if not fd is None:
+      os.close(fd)
+    if isfile(tmp_path):
+      os.unlink(tmp_path)
+    raise
+
+def sha256_file(path, chunk_size=1 << 20):
+  # large files are hashed straight from a read-only mapping in one call, hashlib drops the GIL for it
+  # so threads hashing different files run in parallel
+  with open(path, 'rb') as fh:
+    if os.fstat(fh.fileno()).st_size >= chunk_size:
+      try:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+          return hashlib.sha256(mm).hexdigest()
+      except (OSError, ValueError):
+        pass
+    hasher = hashlib.sha256()
+    for b in iter(lambda: fh.read(chunk_size), b''):
+      hasher.update(b)
+    return hasher.hexdigest()
+
+def is_same_file(src_path, src_st, dst_path, hash_check=False):
+  try:
+    dst_st = os.stat(dst_path)
+  except OSError:
+    return False
+  if dst_st.st_size != src_st.st_size:
+    return False
+  if int(dst_st.st_mtime) == int(src_st.st_mtime):
+    return True
+  if hash_check and sha256_file(src_path) == sha256_file(dst_path):
+    # same content with a different mtime, only the timestamp is brought over
+    shutil.copystat(src_path, dst_path)
+    return True
+  return False
+
+def sync_file(src_path, dst_path, hash_check=False, src_st=None, dst_dev=None):
+  # returns (dst_path, copied), skipping the copy when dst already matches by size and mtime
+  src_st = os.stat(src_path) if src_st is None else src_st
+  if is_same_file(src_path, src_st, dst_path, hash_check):
+    return dst_path, False
+  if dst_dev is None:
+    ensure_dir(os.path.dirname(dst_path))
+    dst_dev = os.stat(os.path.dirname(dst_path)).st_dev
+  clone_file(src_path, dst_path, src_st, dst_dev)
+  return dst_path, True
+
+def scan_tree(src):
+  # one scandir pass, directory entries carry their stat so files are not stat'ed twice
+  dirs, files = list(), list()
+  stack = ['']
+  while stack:
+    rel_dir = stack.pop()
+    with os.scandir(os.path.join(src, rel_dir)) as it:
+      for entry in it:
+        rel_path = os.path.join(rel_dir, entry.name)
+        if entry.is_dir(follow_symlinks=False):
+          dirs.append(rel_path)
+          stack.append(rel_path)
+        elif entry.is_file():
+          files.append((rel_path, entry.stat()))
+  return dirs, files
+
+def sync_tree(src, dst, workers=1, hash_check=False):
+  if not isdir(src):
+    return sync_stats_t(0, 0, 0, 0, list())
+  dirs, files = scan_tree(src)
+  created = 0
+  for rel_dir in [''] + sorted(dirs):
+    try:
+      os.makedirs(os.path.join(dst, rel_dir))
+      created += 1
+    except FileExistsError:
+      pass
+  dst_dev = os.stat(dst).st_dev
+
+  def sync_one(item):
+    rel_path, src_st = item
+    return sync_file(os.path.join(src, rel_path), os.path.join(dst, rel_path), hash_check, src_st, dst_dev)[1]
+
+  # the cheap size and mtime check runs inline, only files that may differ go to the copy threads
+  pending = [(rel_path, src_st) for rel_path, src_st in files if not is_same_file(None, src_st, os.path.join(dst, rel_path))]
+  if workers > 1 and len(pending) > 1:
+    with ThreadPoolExecutor(max_workers=min(workers, len(pending)), thread_name_prefix='sync') as executor:
+      results = list(executor.map(sync_one, pending))
   else:
-    rmtree_d(zip_tempdir)
+    results = [sync_one(item) for item in pending]
+  copied = sum(1 for c in results if c)
+  nbytes = sum(st.st_size for (_, st), c in zip(pending, results) if c)
+  logger.info('synced {} files ({:.02f} MB), {} unchanged, {} new dirs: {} -> {}'.format(copied, nbytes / 1e6, len(files) - copied, created, src, dst))
+  metrics.count('copy_files_total', copied)
+  metrics.count('copy_bytes_total', nbytes)
+  return sync_stats_t(copied, len(files) - copied, nbytes, created, [os.path.join(dst, rel_path) for rel_path, _ in files])
+
+extract_stats_t = namedtuple('ExtractStats', ['files', 'skipped', 'bytes', 'paths'])
+
+def sanitize_member_path(dst, name):
+  parts = [p for p in name.replace('\\', '/').split('/') if p not in ('', '.')]
+  if not parts or '..' in parts or name.startswith(('/', '\\')) or ':' in parts[0]:
+    return None
+  return os.path.join(dst, *parts)
+
+def crc32_file(path, chunk_size=1 << 20):
+  crc = 0
+  with open(path, 'rb') as fh:
+    for b in iter(lambda: fh.read(chunk_size), b''):
+      crc = zlib.crc32(b, crc)
+  return crc
+
+def write_atomic(src_fh, dst_path, mtime=None, mode=None, chunk_size=1 << 20):
+  # streams into a temp name next to the target and swaps it in, never leaving a half-written file
+  dst_dir = os.path.dirname(dst_path)
+  ensure_dir(dst_dir)
+  fd, tmp_path = tempfile.mkstemp(dir=dst_dir, prefix='.' + os.path.basename(dst_path), suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb') as fh:
+      if throttle.disk_active:
+        chunk_size = throttle.chunk_size('disk', chunk_size)
+        for b in iter(lambda: src_fh.read(chunk_size), b''):
+          fh.write(b)
+          throttle.disk(len(b))
+      else:
+        shutil.copyfileobj(src_fh, fh, chunk_size)
+    os.chmod(tmp_path, mode or default_file_mode)
+    if not mtime is None:
+      os.utime(tmp_path, (mtime, mtime))
+    os.replace(tmp_path, dst_path)
+  except BaseException:
+    if isfile(tmp_path):
+      os.unlink(tmp_path)
+    raise
+
+def is_unchanged(dst_path, size, mtime, crc=None):
+  try:
+    st = os.stat(dst_path)
+  except OSError:
+    return False
+  if st.st_size != size:
+    return False
+  if int(st.st_mtime) == int(mtime):
+    return True
+  return not crc is None and crc32_file(dst_path) == crc
+
+def archive_kind(info):
+  if info.content_type == 'application/zip' or info.file_type == 'zip':
+    return 'zip'
+  if info.content_type == 'application/x-xz' or info.file_type.startswith('tar') or info.file_type == 'tgz':
+    return 'tar'
+  return None
+
+def spool_file(size, max_size, tmpdir=None):
+  # small bodies stay in memory, large ones go to an anonymous temp file, unknown sizes start in memory and spill over
+  if 0 < size <= max_size:
+    return io.BytesIO()
+  if size > max_size:
+    return tempfile.TemporaryFile(dir=tmpdir)
+  return tempfile.SpooledTemporaryFile(max_size, dir=tmpdir)
+
+def log_extract_summary(dst, files, skipped, nbytes, rejected):
+  # members that were left out are counted here rather than logged one by one, the first name is kept as an example
+  logger.info('extracted {} files ({:.02f} MB), {} unchanged: {}'.format(files, nbytes / 1e6, skipped, dst))
+  for reason, names in rejected.items():
+    logger.warning('skipped {} {} archive members, first: {}'.format(len(names), reason, names[0]))
+
+def archive_extract_zip(path, dst, tmpdir=None):
+  files, skipped, nbytes, paths = 0, 0, 0, list()
+  rejected = dict()
+  # path is a spool file object when an uncached zip is streamed
+  task_name = path if isinstance(path, str) else getattr(path, 'name', None)
+  task_name = os.path.basename(task_name) if isinstance(task_name, str) else 'zip stream'
+  with ZipFile(path) as zh, progress.task(task_name, len(zh.infolist()), 'files') as task:
+    for info in zh.infolist():
+      task.update(1)
+      dst_path = sanitize_member_path(dst, info.filename)
+      if dst_path is None:
+        rejected.setdefault('unsafe', list()).append(info.filename)
+        continue
+      if info.is_dir():
+        ensure_dir(dst_path)
+        continue
+      mtime = time.mktime(info.date_time + (0, 0, -1))
+      paths.append(dst_path)
+      if is_unchanged(dst_path, info.file_size, mtime, info.CRC):
+        skipped += 1
+        continue
+      mode = (info.external_attr >> 16) & 0o777
+      with zh.open(info) as src_fh:
+        write_atomic(src_fh, dst_path, mtime, mode)
+      files += 1
+      nbytes += info.file_size
+  log_extract_summary(dst, files, skipped, nbytes, rejected)
+  return extract_stats_t(files, skipped, nbytes, paths)
+
+def extract_tar_members(th, dst):
+  # members are visited in archive order, which also works on a non-seekable stream
+  files, skipped, nbytes, paths = 0, 0, 0, list()
+  rejected = dict()
+  with progress.task(os.path.basename(dst.rstrip('/\\')) or dst, 0, 'files') as task:
+    for member in th:
+      task.update(1)
+      dst_path = sanitize_member_path(dst, member.name)
+      if dst_path is None:
+        rejected.setdefault('unsafe', list()).append(member.name)
+        continue
+      if member.isdir():
+        ensure_dir(dst_path)
+        continue
+      if not member.isfile():
+        rejected.setdefault('non-regular', list()).append(member.name)
+        continue
+      paths.append(dst_path)
+      if is_unchanged(dst_path, member.size, member.mtime):
+        skipped += 1
+        continue
+      src_fh = th.extractfile(member)
+      write_atomic(src_fh, dst_path, member.mtime, member.mode & 0o777)
+      files += 1
+      nbytes += member.size
+  log_extract_summary(dst, files, skipped, nbytes, rejected)
+  return extract_stats_t(files, skipped, nbytes, paths)
 
 def archive_extract_tar(path, dst, tmpdir=None):
-  if tmpdir is None:
-    tar_tempdir, d_tar_tempdir = mkdtemp()
-  else:
-    d_tar_tempdir = lambda: None
-    tar_tempdir = tmpdir
   with tarfile.open(path, mode='r') as th:
-    th.extractall(tar_tempdir)
-    copy2_r(tar_tempdir, dst)
-  if tmpdir is None:
-    d_tar_tempdir()
-  else:
-    rmtree_d(tar_tempdir)
\ No newline at end of file
+    return extract_tar_members(th, dst)
+
+def archive_extract_tar_stream(fh, dst):
+  # r|* detects gz, bz2 and xz from the stream itself and never seeks back
+  with tarfile.open(fileobj=fh, mode='r|*') as th:
+    return extract_tar_members(th, dst)
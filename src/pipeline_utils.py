@@ -0,0 +1,125 @@
+import queue
+import threading
+from time import time
+from collections import namedtuple
+from src.log import init_logger
+
+logger = init_logger('pipeline_utils', 'setup.log')
+stage_stats_t = namedtuple('StageStats', ['name', 'workers', 'processed', 'errors', 'busy_sec', 'elapsed_sec', 'queue_depth', 'queue_depth_max'])
+
+_sentinel = object()
+
+class Stage:
+  def __init__(self, name, fn, workers=1, queue_size=0, on_error=None):
+    self.name = name
+    self.fn = fn
+    self.on_error = on_error
+    self.workers = max(workers, 1)
+    self.queue = queue.Queue(max(queue_size, 0))
+    self.threads = list()
+    self._lock = threading.Lock()
+    self.processed = 0
+    self.errors = 0
+    self.busy_sec = 0.
+    self.active = 0
+    self.queue_depth_max = 0
+    self.t0 = None
+    self.t1 = None
+
+  def stats(self):
+    with self._lock:
+      elapsed = (self.t1 or time()) - (self.t0 or time())
+      return stage_stats_t(self.name, self.workers, self.processed, self.errors, self.busy_sec, elapsed, self.queue.qsize(), self.queue_depth_max)
+
+class Pipeline:
+  def __init__(self, name='pipeline', monitor_sec=10):
+    self.name = name
+    self.monitor_sec = monitor_sec
+    self.stages = list()
+    self._stop = threading.Event()
+    self._monitor = None
+
+  def add_stage(self, name, fn, workers=1, queue_size=0, on_error=None):
+    self.stages.append(Stage(name, fn, workers, queue_size, on_error))
+    return self
+
+  def get_stage(self, name):
+    for stage in self.stages:
+      if stage.name == name:
+        return stage
+    raise KeyError(name)
+
+  def put(self, name, item):
+    # blocks while the stage queue is full, bounding work held between stages
+    stage = self.get_stage(name)
+    stage.queue.put(item)
+    with stage._lock:
+      stage.queue_depth_max = max(stage.queue_depth_max, stage.queue.qsize())
+
+  def _work(self, n, stage):
+    next_stage = self.stages[n + 1].name if n + 1 < len(self.stages) else None
+    while True:
+      item = stage.queue.get()
+      if item is _sentinel:
+        return
+      with stage._lock:
+        stage.active += 1
+      t0 = time()
+      try:
+        result = stage.fn(item)
+        if not result is None and not next_stage is None:
+          self.put(next_stage, result)
+      except Exception as e:
+        logger.error('{} stage {} failed: {}'.format(self.name, stage.name, e))
+        with stage._lock:
+          stage.errors += 1
+        if not stage.on_error is None:
+          stage.on_error(item, e)
+      finally:
+        with stage._lock:
+          stage.active -= 1
+          stage.processed += 1
+          stage.busy_sec += time() - t0
+
+  def _run_monitor(self):
+    while not self._stop.wait(self.monitor_sec):
+      logger.info(self.format_stats())
+
+  def format_stats(self):
+    return '{}: {}'.format(self.name, ' | '.join('{} q={} busy={}/{} done={}'.format(
+      stage.name, stage.queue.qsize(), stage.active, stage.workers, stage.processed) for stage in self.stages))
+
+  def start(self):
+    for n, stage in enumerate(self.stages):
+      stage.t0 = time()
+      for i in range(stage.workers):
+        th = threading.Thread(target=self._work, args=(n, stage), name='{}_{}_{}'.format(self.name, stage.name, i), daemon=True)
+        th.start()
+        stage.threads.append(th)
+    if self.monitor_sec > 0:
+      self._monitor = threading.Thread(target=self._run_monitor, name='{}_monitor'.format(self.name), daemon=True)
+      self._monitor.start()
+    return self
+
+  def join(self):
+    # stages drain front to back so late items routed forward are still handled
+    for stage in self.stages:
+      for th in stage.threads:
+        stage.queue.put(_sentinel)
+      for th in stage.threads:
+        th.join()
+      stage.t1 = time()
+    self._stop.set()
+    self.log_stats()
+    return [stage.stats() for stage in self.stages]
+
+  def run(self, items):
+    self.start()
+    for item in items:
+      self.put(self.stages[0].name, item)
+    return self.join()
+
+  def log_stats(self):
+    for s in (stage.stats() for stage in self.stages):
+      logger.info('{} stage {}: {} items, {} errors, {:.02f}/s, busy {:.02f}s over {:.02f}s on {} workers, max queue depth {}'.format(
+        self.name, s.name, s.processed, s.errors, s.processed / max(s.elapsed_sec, 1e-8), s.busy_sec, s.elapsed_sec, s.workers, s.queue_depth_max))
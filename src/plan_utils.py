@@ -0,0 +1,207 @@
+import os
+import json
+import hashlib
+import tempfile
+from collections import namedtuple
+from src.log import init_logger
+from src.path_utils import ensure_dir, isfile
+from src.state_utils import fingerprint
+
+logger = init_logger('plan_utils', 'setup.log')
+plugin_t = namedtuple('PluginEnt', ['name', 'resources', 'disable_cache', 'is_meta', 'fingerprint'])
+resource_t = namedtuple('ResourceEnt', ['url', 'extract_path', 'disable_cache', 'do_compile', 'compiler_preset_name'])
+workshop_t = namedtuple('WorkshopEnt', ['workshop_id', 'name', 'rel'])
+plan_error_t = namedtuple('PlanError', ['where', 'message'])
+# plugins are in install order, metaPlugins first since the others extract into their tree
+plan_t = namedtuple('InstallPlan', ['key', 'platform', 'plugins', 'workshops', 'compiler_presets', 'errors'])
+
+plan_version = 1
+
+def plan_key(json_bytes, ini_bytes, platform):
+  hasher = hashlib.sha256('plan v{} {}\n'.format(plan_version, platform).encode('utf8'))
+  hasher.update(hashlib.sha256(json_bytes).digest())
+  hasher.update(hashlib.sha256(ini_bytes).digest())
+  return hasher.hexdigest()
+
+def platform_preset(compiler_presets, compiler_preset_name, platform):
+  presets = compiler_presets.get(compiler_preset_name)
+  if not isinstance(presets, list):
+    return None
+  presets = [preset for preset in presets if isinstance(preset, dict) and preset.get('platform') == platform]
+  return presets[0] if presets else None
+
+def is_safe_rel_path(path):
+  return not os.path.isabs(path) and not '..' in path.replace('\\', '/').split('/')
+
+def build_resources(resources, platform, compiler_presets, where, errors):
+  if not isinstance(resources, list):
+    errors.append(plan_error_t(where, 'resources must be a list'))
+    return
+  for i, resource in enumerate(resources):
+    resource_where = '{}.resources[{}]'.format(where, i)
+    if not isinstance(resource, dict):
+      errors.append(plan_error_t(resource_where, 'resource must be an object'))
+      continue
+    if resource.get('exclude', False):
+      continue
+    resource_platform = resource.get('platform', platform)
+    if not (resource_platform == platform or resource_platform == '*'):
+      continue
+    resource_url = resource.get('url')
+    if not isinstance(resource_url, str) or not resource_url:
+      errors.append(plan_error_t(resource_where, 'url is empty'))
+    resource_extract_path = resource.get('extractPath', '')
+    if not isinstance(resource_extract_path, str) or not is_safe_rel_path(resource_extract_path):
+      errors.append(plan_error_t(resource_where, 'extractPath must stay inside the app directory: {}'.format(resource_extract_path)))
+    resource_do_compile = resource.get('doCompile', False)
+    resource_compiler_preset_name = resource.get('compilerPresetName')
+    if resource_do_compile and resource_compiler_preset_name and platform_preset(compiler_presets, resource_compiler_preset_name, platform) is None:
+      errors.append(plan_error_t(resource_where, 'no {} compiler preset named {}'.format(platform, resource_compiler_preset_name)))
+    yield resource_t(resource_url, resource_extract_path, resource.get('disableCache', False), resource_do_compile, resource_compiler_preset_name)
+
+def build_plan(steamapp_info, platform, key=''):
+  # every entry is filtered for the platform and checked once here, so a bad entry stops the run before anything is installed
+  errors = list()
+  if not isinstance(steamapp_info, dict):
+    errors.append(plan_error_t('', 'steamapp_info must be an object'))
+    steamapp_info = dict()
+  compiler_presets = steamapp_info.get('compilerPresets', {})
+  if not isinstance(compiler_presets, dict):
+    errors.append(plan_error_t('compilerPresets', 'compilerPresets must be an object'))
+    compiler_presets = dict()
+
+  plugins = list()
+  plugin_names = set()
+  for section, is_meta in (('metaPlugins', True), ('plugins', False)):
+    section_plugins = steamapp_info.get(section, list())
+    if not isinstance(section_plugins, list):
+      errors.append(plan_error_t(section, '{} must be a list'.format(section)))
+      continue
+    for i, plugin in enumerate(section_plugins):
+      where = '{}[{}]'.format(section, i)
+      if not isinstance(plugin, dict):
+        errors.append(plan_error_t(where, 'plugin must be an object'))
+        continue
+      plugin_name = plugin.get('name')
+      if plugin_name is None or not plugin_name or plugin.get('exclude', False):
+        continue
+      if plugin_name in plugin_names:
+        errors.append(plan_error_t(where, 'duplicate plugin name: {}'.format(plugin_name)))
+      plugin_names.add(plugin_name)
+      plugin_resources = tuple(build_resources(plugin.get('resources', []), platform, compiler_presets, where, errors))
+      plugin_fingerprint = fingerprint([
+        plugin_name,
+        platform,
+        [resource_ent._asdict() for resource_ent in plugin_resources],
+        [compiler_presets.get(resource_ent.compiler_preset_name) for resource_ent in plugin_resources if resource_ent.do_compile],
+      ])
+      plugins.append(plugin_t(plugin_name, plugin_resources, plugin.get('disableCache', False), is_meta, plugin_fingerprint))
+
+  workshops = list()
+  workshop_ids = steamapp_info.get('workshopIds', [])
+  if not isinstance(workshop_ids, list):
+    errors.append(plan_error_t('workshopIds', 'workshopIds must be a list'))
+    workshop_ids = list()
+  for i, workshop_ent in enumerate(workshop_ids):
+    where = 'workshopIds[{}]'.format(i)
+    if not isinstance(workshop_ent, list) or len(workshop_ent) != 4:
+      errors.append(plan_error_t(where, 'expected [include, id, name, url]'))
+      continue
+    include, workshop_id, workshop_name, workshop_rel = workshop_ent
+    if not include:
+      continue
+    if not str(workshop_id).isnumeric():
+      errors.append(plan_error_t(where, 'invalid workshop id: {}'.format(workshop_id)))
+      continue
+    workshops.append(workshop_t(workshop_id, workshop_name, workshop_rel))
+
+  used_presets = set(resource_ent.compiler_preset_name for plugin_ent in plugins for resource_ent in plugin_ent.resources if resource_ent.do_compile)
+  platform_presets = {name: platform_preset(compiler_presets, name, platform) for name in sorted(used_presets, key=str)}
+  return plan_t(key, platform, plugins, workshops, {name: preset for name, preset in platform_presets.items() if not preset is None}, errors)
+
+def plan_to_json(plan):
+  return {
+    'version': plan_version,
+    'key': plan.key,
+    'platform': plan.platform,
+    'plugins': [dict(plugin_ent._asdict(), resources=[resource_ent._asdict() for resource_ent in plugin_ent.resources]) for plugin_ent in plan.plugins],
+    'workshops': [workshop_ent._asdict() for workshop_ent in plan.workshops],
+    'compiler_presets': plan.compiler_presets,
+    'errors': [error._asdict() for error in plan.errors],
+  }
+
+def plan_from_json(d):
+  return plan_t(
+    d['key'],
+    d['platform'],
+    [plugin_t(**dict(plugin, resources=tuple(resource_t(**resource) for resource in plugin['resources']))) for plugin in d['plugins']],
+    [workshop_t(**workshop) for workshop in d['workshops']],
+    d['compiler_presets'],
+    [plan_error_t(**error) for error in d['errors']],
+  )
+
+class PlanCache:
+  # plans are keyed by the bytes they were built from, a hit skips parsing steamapp_info altogether,
+  # the most recent few are kept so switching between configs or platforms stays a hit
+  def __init__(self, cache_dir, max_plans=8):
+    self.cache_dir = cache_dir
+    self.max_plans = max_plans
+
+  def path(self, key):
+    return os.path.join(self.cache_dir, '{}.json'.format(key))
+
+  def get(self, key):
+    path = self.path(key)
+    if not isfile(path):
+      return None
+    try:
+      with open(path, 'r') as fh:
+        d = json.load(fh)
+      if d.get('version') != plan_version:
+        return None
+      return plan_from_json(d)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      logger.warning('discarding unreadable plan: {} {}'.format(path, e))
+      return None
+
+  def put(self, plan):
+    ensure_dir(self.cache_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fh:
+      json.dump(plan_to_json(plan), fh)
+    os.replace(tmp_path, self.path(plan.key))
+    self.prune()
+
+  def prune(self):
+    paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.json')]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    for path in paths[self.max_plans:]:
+      os.unlink(path)
+
+  def load(self, json_path, config_path, platform):
+    if not isfile(json_path):
+      logger.error('cannot load json: {}'.format(json_path))
+      return plan_t('', platform, list(), list(), dict(), [plan_error_t('', 'cannot load json: {}'.format(json_path))])
+    with open(json_path, 'rb') as fh:
+      json_bytes = fh.read()
+    ini_bytes = b''
+    if isfile(config_path):
+      with open(config_path, 'rb') as fh:
+        ini_bytes = fh.read()
+    key = plan_key(json_bytes, ini_bytes, platform)
+    plan = self.get(key)
+    if not plan is None:
+      logger.info('install plan {} loaded from cache'.format(key[:12]))
+      return plan
+    try:
+      steamapp_info = json.loads(json_bytes)
+    except ValueError as e:
+      logger.error('cannot parse json: {} {}'.format(json_path, e))
+      return plan_t(key, platform, list(), list(), dict(), [plan_error_t('', 'cannot parse json: {}'.format(e))])
+    plan = build_plan(steamapp_info, platform, key)
+    logger.info('install plan {} built: {} plugins, {} workshops, {} errors'.format(key[:12], len(plan.plugins), len(plan.workshops), len(plan.errors)))
+    try:
+      self.put(plan)
+    except OSError as e:
+      logger.warning('cannot store plan: {}'.format(e))
+    return plan
@@ -0,0 +1,47 @@
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from src.log import init_logger
+from src.metrics_utils import metrics
+
+logger = init_logger('pool_utils', 'setup.log')
+
+def url_host(url) -> str:
+  return urlparse(url).netloc.lower()
+
+class HostLimiter:
+  def __init__(self, max_per_host=0):
+    self.max_per_host = max_per_host
+    self._lock = threading.Lock()
+    self._semaphores = dict()
+
+  def get_semaphore(self, host):
+    with self._lock:
+      sem = self._semaphores.get(host)
+      if sem is None:
+        sem = threading.BoundedSemaphore(self.max_per_host)
+        self._semaphores[host] = sem
+      return sem
+
+  @contextmanager
+  def slot(self, url):
+    if self.max_per_host <= 0:
+      yield
+      return
+    with self.get_semaphore(url_host(url)):
+      yield
+
+def run_ordered(fn, items, workers=1, name='worker'):
+  # results are always returned in submission order regardless of completion order
+  items = list(items)
+  if workers <= 1 or len(items) <= 1:
+    return [fn(item) for item in items]
+  logger.info('running {} jobs on {} workers'.format(len(items), workers))
+  # worker threads inherit the caller's metrics labels
+  labels = metrics.labels()
+  def run(item):
+    with metrics.context(**labels):
+      return fn(item)
+  with ThreadPoolExecutor(max_workers=min(workers, len(items)), thread_name_prefix=name) as executor:
+    return list(executor.map(run, items))
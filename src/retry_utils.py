@@ -0,0 +1,106 @@
+import random
+import threading
+import requests
+from time import time
+from email.utils import parsedate_to_datetime
+from src.log import init_logger
+from src.pool_utils import url_host
+
+logger = init_logger('retry_utils', 'setup.log')
+
+# statuses worth another attempt, everything else outside ok_status is treated as permanent
+transient_status = (408, 425, 429, 500, 502, 503, 504)
+
+class RetryableConnectionError(requests.exceptions.BaseHTTPError):
+  pass
+
+class PermanentHTTPError(requests.exceptions.BaseHTTPError):
+  pass
+
+# the body broke off while a consumer such as tarfile was reading it, unlike errors raised by the consumer itself
+class StreamReadError(RetryableConnectionError):
+  pass
+
+def is_transient(e):
+  if isinstance(e, RetryableConnectionError):
+    return True
+  if isinstance(e, (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema, requests.exceptions.TooManyRedirects, PermanentHTTPError)):
+    return False
+  # ConnectTimeout is both a ConnectionError and a Timeout, ReadTimeout and ChunkedEncodingError surface mid transfer
+  return isinstance(e, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+def parse_retry_after(headers):
+  value = headers.get('retry-after', '').strip()
+  if not value:
+    return None
+  if value.isdigit():
+    return float(value)
+  try:
+    return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+  except (TypeError, ValueError, IndexError, OverflowError):
+    return None
+
+class RetryPolicy:
+  def __init__(self, max_retry=3, backoff_base=0.5, backoff_max=30, connect_timeout=10, read_timeout=60, retry_after_max=120):
+    self.max_retry = max(max_retry, 1)
+    self.backoff_base = backoff_base
+    self.backoff_max = backoff_max
+    self.retry_after_max = retry_after_max
+    self.timeout = (connect_timeout or None, read_timeout or None)
+
+  def delay(self, attempt, retry_after=None):
+    # full jitter keeps parallel workers that failed together from retrying together
+    # None when the server asks for a longer pause than a worker should spend asleep
+    if not retry_after is None:
+      return retry_after if retry_after <= self.retry_after_max else None
+    return random.uniform(0, min(self.backoff_max, self.backoff_base * (1 << (attempt - 1))))
+
+class CircuitBreaker:
+  # after threshold consecutive transient failures a host is skipped for cooldown seconds,
+  # then a single trial request decides whether it is closed again
+  def __init__(self, threshold=5, cooldown=60):
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self._lock = threading.Lock()
+    self.hosts = dict()
+
+  def allow(self, url):
+    if self.threshold <= 0:
+      return True
+    with self._lock:
+      state = self.hosts.get(url_host(url))
+      if state is None or state['opened'] is None:
+        return True
+      if state['trial'] or time() - state['opened'] < self.cooldown:
+        return False
+      state['trial'] = True
+      return True
+
+  def success(self, url):
+    if self.threshold <= 0:
+      return
+    with self._lock:
+      state = self.hosts.pop(url_host(url), None)
+    if not state is None and not state['opened'] is None:
+      logger.info('circuit closed: {}'.format(url_host(url)))
+
+  def failure(self, url):
+    if self.threshold <= 0:
+      return
+    host = url_host(url)
+    with self._lock:
+      state = self.hosts.setdefault(host, {'failures': 0, 'opened': None, 'trial': False})
+      state['failures'] += 1
+      if state['trial'] or (state['opened'] is None and state['failures'] >= self.threshold):
+        logger.warning('circuit open for {}s after {} failures: {}'.format(self.cooldown, state['failures'], host))
+        state['opened'] = time()
+        state['trial'] = False
+
+  def is_open(self, url):
+    with self._lock:
+      state = self.hosts.get(url_host(url))
+      return not state is None and not state['opened'] is None
+
+# module globals so the entry point can replace them from config, read at call time by http_request
+default_policy = RetryPolicy()
+breaker = CircuitBreaker()
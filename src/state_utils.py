@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from time import time
+from src.log import init_logger
+from src.path_utils import isfile, isdir
+
+logger = init_logger('state_utils', 'setup.log')
+
+def fingerprint(obj) -> str:
+  return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+class InstallState:
+  state_file_name = '.setup_state.json'
+
+  def __init__(self, app_dir):
+    self.app_dir = app_dir
+    self.state_path = os.path.join(app_dir, self.state_file_name)
+    self._lock = threading.RLock()
+    self.state = {'plugins': {}, 'workshops': {}}
+    self.load()
+
+  def load(self):
+    if not isfile(self.state_path):
+      return
+    try:
+      with open(self.state_path, 'r') as fh:
+        self.state.update(json.load(fh))
+      logger.info('loaded install state: {}'.format(self.state_path))
+    except (ValueError, OSError) as e:
+      logger.warning('discarding unreadable install state: {}'.format(e))
+
+  def save(self):
+    with self._lock:
+      os.makedirs(self.app_dir, exist_ok=True)
+      fd, tmp_path = tempfile.mkstemp(dir=self.app_dir, suffix='.json')
+      with os.fdopen(fd, 'w') as fh:
+        json.dump(self.state, fh, indent=1)
+      os.replace(tmp_path, self.state_path)
+
+  def rel_path(self, path):
+    return os.path.relpath(os.path.abspath(path), os.path.abspath(self.app_dir)).replace(os.sep, '/')
+
+  def abs_path(self, rel_path):
+    return os.path.join(self.app_dir, *rel_path.split('/'))
+
+  def get(self, kind, key):
+    with self._lock:
+      return self.state[kind].get(key)
+
+  def iter_files(self, kind, key):
+    ent = self.get(kind, key) or {}
+    for resource in ent.get('resources', []):
+      yield from resource.get('files', [])
+
+  def is_current(self, kind, key, fp):
+    ent = self.get(kind, key)
+    if ent is None or ent.get('fingerprint') != fp:
+      return False
+    return all(isfile(self.abs_path(f)) for f in self.iter_files(kind, key))
+
+  def record(self, kind, key, fp, resources):
+    with self._lock:
+      self.state[kind][key] = {
+        'fingerprint': fp,
+        'installed_at': time(),
+        'resources': [dict(r, files=sorted(set(self.rel_path(f) for f in r.get('files', [])))) for r in resources],
+      }
+      self.save()
+
+  def find_resource(self, kind, **match):
+    with self._lock:
+      resources = [r for ent in self.state[kind].values() for r in ent.get('resources', [])]
+    for resource in resources:
+      if all(resource.get(k) == v for k, v in match.items()) and all(isfile(self.abs_path(f)) for f in resource.get('files', [])):
+        return resource
+    return None
+
+  def stale_keys(self, kind, current_keys):
+    current_keys = set(current_keys)
+    with self._lock:
+      return [key for key in self.state[kind] if not key in current_keys]
+
+  def owned_files(self, exclude=None):
+    owned = set()
+    with self._lock:
+      for kind, ents in self.state.items():
+        for key in ents:
+          if (kind, key) != exclude:
+            owned.update(self.iter_files(kind, key))
+    return owned
+
+  def remove(self, kind, key):
+    # deletes files only this entry owns and prunes directories left empty
+    owned = self.owned_files(exclude=(kind, key))
+    removed = 0
+    for rel_path in self.iter_files(kind, key):
+      if rel_path in owned:
+        continue
+      path = self.abs_path(rel_path)
+      if isfile(path):
+        os.unlink(path)
+        removed += 1
+        self.prune_dirs(os.path.dirname(path))
+    with self._lock:
+      self.state[kind].pop(key, None)
+      self.save()
+    logger.info('removed {} files of {}: {}'.format(removed, kind, key))
+    return removed
+
+  def prune_dirs(self, path):
+    app_dir = os.path.abspath(self.app_dir)
+    path = os.path.abspath(path)
+    while path.startswith(app_dir + os.sep) and isdir(path) and not os.listdir(path):
+      os.rmdir(path)
+      path = os.path.dirname(path)
@@ -0,0 +1,155 @@
+import os
+import re
+import shutil
+import tempfile
+import threading
+import subprocess
+from time import time
+from collections import namedtuple
+from src.log import init_logger, progress
+from src.path_utils import ensure_dir, isfile, sync_file
+from src.fleet_utils import replace_with_link
+
+logger = init_logger('steamcmd_utils', 'setup.log')
+steamcmd_item_t = namedtuple('SteamcmdItem', ['workshop_id', 'status', 'item_dir', 'message'])
+
+app_id = 550
+re_login = re.compile(r"Logging in user '([^']*)'.*?(OK|FAILED.*)$")
+re_downloading = re.compile(r'Downloading item (\d+)')
+re_success = re.compile(r'Success\. Downloaded item (\d+) to "([^"]+)"(?: \((\d+) bytes\))?')
+re_error = re.compile(r'ERROR! Download item (\d+) failed \(([^)]*)\)')
+
+def default_steamcmd_path(parent_dir, platform):
+  return os.path.join(parent_dir, 'steamcmd.exe' if platform == 'windows' else 'steamcmd.sh')
+
+def write_script(script_path, workshop_ids, install_dir, login='anonymous'):
+  # one login and one client startup for the whole batch, a failed item does not stop the rest
+  lines = [
+    '@ShutdownOnFailedCommand 0',
+    '@NoPromptForPassword 1',
+    'force_install_dir "{}"'.format(os.path.abspath(install_dir)),
+    'login {}'.format(login),
+  ]
+  lines += ['workshop_download_item {} {}'.format(app_id, workshop_id) for workshop_id in workshop_ids]
+  lines.append('quit')
+  with open(script_path, 'w') as fh:
+    fh.write('\n'.join(lines) + '\n')
+
+def parse_output(lines, workshop_ids):
+  # yields each line with the item it finished, or None, so the caller can report progress as it happens
+  results = dict()
+  for line in lines:
+    line = line.strip()
+    if not line:
+      continue
+    m = re_login.search(line)
+    if m and m.group(2) != 'OK':
+      logger.error('steamcmd login failed for {}: {}'.format(m.group(1), m.group(2)))
+    m = re_success.search(line)
+    if m:
+      results[m.group(1)] = steamcmd_item_t(m.group(1), True, m.group(2), '')
+      yield line, results[m.group(1)]
+      continue
+    m = re_error.search(line)
+    if m:
+      results[m.group(1)] = steamcmd_item_t(m.group(1), False, None, m.group(2))
+      yield line, results[m.group(1)]
+      continue
+    yield line, None
+  for workshop_id in workshop_ids:
+    if not workshop_id in results:
+      yield '', steamcmd_item_t(workshop_id, False, None, 'no result reported')
+
+def item_files(item_dir):
+  files = list()
+  for root, dirs, names in os.walk(item_dir):
+    dirs.sort()
+    files += [os.path.join(root, name) for name in sorted(names)]
+  return files
+
+def export_file(src_path, dst_path, export_mode='hardlink'):
+  if export_mode == 'move':
+    # os.replace keeps a running server from seeing the addon missing, shutil.move covers other filesystems
+    try:
+      os.replace(src_path, dst_path)
+    except OSError:
+      shutil.move(src_path, dst_path)
+    return
+  if export_mode == 'hardlink':
+    try:
+      replace_with_link(os.path.abspath(src_path), dst_path)
+      return
+    except OSError as e:
+      logger.info('cannot hardlink {}, copying: {}'.format(dst_path, e))
+  sync_file(src_path, dst_path)
+
+class SteamcmdWorkshop:
+  def __init__(self, steamcmd_path, install_dir, login='anonymous', export_mode='hardlink', timeout=0):
+    self.steamcmd_path = steamcmd_path
+    self.install_dir = install_dir
+    self.login = login
+    self.export_mode = export_mode
+    self.timeout = timeout
+
+  def content_dir(self, workshop_id):
+    return os.path.join(self.install_dir, 'steamapps', 'workshop', 'content', str(app_id), str(workshop_id))
+
+  def download(self, workshop_ids):
+    workshop_ids = [str(workshop_id) for workshop_id in workshop_ids]
+    if not workshop_ids:
+      return dict()
+    if not isfile(self.steamcmd_path):
+      logger.error('steamcmd not found: {}'.format(self.steamcmd_path))
+      return {workshop_id: steamcmd_item_t(workshop_id, False, None, 'steamcmd not found') for workshop_id in workshop_ids}
+    ensure_dir(self.install_dir)
+    fd, script_path = tempfile.mkstemp(dir=self.install_dir, prefix='.workshop_', suffix='.txt')
+    os.close(fd)
+    results = dict()
+    try:
+      write_script(script_path, workshop_ids, self.install_dir, self.login)
+      logger.info('running steamcmd for {} workshop items'.format(len(workshop_ids)))
+      t0 = time()
+      proc = subprocess.Popen([self.steamcmd_path, '+runscript', os.path.abspath(script_path)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, text=True, errors='replace')
+      # steamcmd can hang on a stuck login or update, the watchdog ends the batch and unfinished items count as failed
+      watchdog = threading.Timer(self.timeout, proc.kill) if self.timeout > 0 else None
+      if not watchdog is None:
+        watchdog.start()
+      task = progress.task('steamcmd', len(workshop_ids), 'items')
+      try:
+        for line, item in parse_output(proc.stdout, workshop_ids):
+          if item is None:
+            if re_downloading.search(line):
+              logger.debug('steamcmd: {}'.format(line))
+            continue
+          results[item.workshop_id] = item
+          task.update(1)
+          if not item.status:
+            logger.warning('workshop {}/{} failed: {} {}'.format(len(results), len(workshop_ids), item.workshop_id, item.message))
+      finally:
+        task.close()
+        proc.stdout.close()
+        returncode = proc.wait()
+        if not watchdog is None:
+          watchdog.cancel()
+      logger.info('steamcmd finished in {:.02f}s with exit code {}: {} ok, {} failed'.format(time() - t0, returncode, sum(item.status for item in results.values()), sum(not item.status for item in results.values())))
+    finally:
+      os.unlink(script_path)
+    return results
+
+  def export(self, item, export_dir, file_name=''):
+    # an item holds a single vpk, legacy uploads arrive as <name>_legacy.bin and get the workshop file name instead
+    item_dir = item.item_dir if not item.item_dir is None and os.path.isdir(item.item_dir) else self.content_dir(item.workshop_id)
+    files = item_files(item_dir)
+    if not files:
+      logger.warning('steamcmd left no files for workshop item: {} {}'.format(item.workshop_id, item_dir))
+      return list()
+    ensure_dir(export_dir)
+    written = list()
+    for src_path in files:
+      name = os.path.basename(src_path)
+      if len(files) == 1 and (file_name or not name.endswith('.vpk')):
+        name = os.path.basename(file_name) if file_name else '{}.vpk'.format(item.workshop_id)
+      dst_path = os.path.join(export_dir, name)
+      export_file(src_path, dst_path, self.export_mode)
+      written.append(dst_path)
+    return written
@@ -0,0 +1,96 @@
+import threading
+from time import monotonic, sleep
+from src.log import init_logger
+from src.metrics_utils import metrics
+
+logger = init_logger('throttle_utils', 'setup.log')
+
+class TokenBucket:
+  # rate in bytes per second, 0 means unlimited; a consumer larger than the burst goes into debt and
+  # sleeps it off, so the long-run rate holds for any chunk size
+  def __init__(self, rate=0, burst_sec=0.25):
+    self.burst_sec = burst_sec
+    self._lock = threading.Lock()
+    self.rate = 0
+    self.tokens = 0
+    self.t_last = monotonic()
+    self.set_rate(rate)
+
+  def set_rate(self, rate):
+    with self._lock:
+      self.rate = max(rate, 0)
+      self.tokens = min(self.tokens, self.rate * self.burst_sec)
+      self.t_last = monotonic()
+
+  def reserve(self, n):
+    with self._lock:
+      if self.rate <= 0:
+        return 0
+      now = monotonic()
+      self.tokens = min(self.tokens + (now - self.t_last) * self.rate, self.rate * self.burst_sec)
+      self.t_last = now
+      self.tokens -= n
+      return -self.tokens / self.rate if self.tokens < 0 else 0
+
+  def consume(self, n):
+    wait = self.reserve(n)
+    if wait > 0:
+      sleep(wait)
+    return wait
+
+class Throttle:
+  # one global network bucket, one bucket per host and one disk write bucket, shared by every worker thread
+  def __init__(self):
+    self.net_bucket = TokenBucket()
+    self.disk_bucket = TokenBucket()
+    self.host_rate = 0
+    self.host_buckets = dict()
+    self._lock = threading.Lock()
+    self.net_active = False
+    self.disk_active = False
+
+  def configure(self, net_rate=0, host_rate=0, disk_rate=0):
+    if (net_rate, host_rate, disk_rate) != (self.net_bucket.rate, self.host_rate, self.disk_bucket.rate):
+      logger.info('throttle limits: net {} B/s, per host {} B/s, disk {} B/s'.format(net_rate or '-', host_rate or '-', disk_rate or '-'))
+    self.net_bucket.set_rate(net_rate)
+    self.disk_bucket.set_rate(disk_rate)
+    with self._lock:
+      self.host_rate = max(host_rate, 0)
+      for bucket in self.host_buckets.values():
+        bucket.set_rate(self.host_rate)
+    self.net_active = net_rate > 0 or host_rate > 0
+    self.disk_active = disk_rate > 0
+
+  def host_bucket(self, host):
+    with self._lock:
+      bucket = self.host_buckets.get(host)
+      if bucket is None:
+        bucket = self.host_buckets[host] = TokenBucket(self.host_rate)
+      return bucket
+
+  def net(self, host, n):
+    if not self.net_active:
+      return 0
+    wait = max(self.net_bucket.reserve(n), self.host_bucket(host).reserve(n) if self.host_rate > 0 else 0)
+    if wait > 0:
+      metrics.count('throttle_wait_seconds_total', wait, kind='net')
+      sleep(wait)
+    return wait
+
+  def disk(self, n):
+    if not self.disk_active:
+      return 0
+    wait = self.disk_bucket.consume(n)
+    if wait > 0:
+      metrics.count('throttle_wait_seconds_total', wait, kind='disk')
+    return wait
+
+  def chunk_size(self, kind='net', default=1 << 20, min_size=1 << 14):
+    # throttled transfers move in chunks of about 50ms worth of budget so the pacing stays smooth
+    rates = [self.net_bucket.rate, self.host_rate] if kind == 'net' else [self.disk_bucket.rate]
+    rates = [r for r in rates if r > 0]
+    if not rates:
+      return default
+    return max(min(default, int(min(rates) / 20)), min_size)
+
+throttle = Throttle()
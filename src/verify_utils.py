@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import hashlib
+import tarfile
+import tempfile
+from zipfile import ZipFile, BadZipFile
+from collections import namedtuple
+from src.log import init_logger
+from src.path_utils import ensure_dir, isfile, isdir, sha256_file, sanitize_member_path, write_atomic, archive_kind
+from src.http_utils import file_info_t
+from src.pool_utils import run_ordered
+from src.metrics_utils import metrics
+
+logger = init_logger('verify_utils', 'setup.log')
+# source is (blob_path, kind, member) for files a cached blob can restore, None when only existence can be checked
+expected_t = namedtuple('ExpectedFile', ['rel_path', 'owner', 'size', 'sha256', 'source'])
+verify_result_t = namedtuple('VerifyResult', ['rel_path', 'status', 'owner', 'source'])
+
+manifest_version = 1
+# bookkeeping files next to installed content that are never reported as extra
+ignored_names = ('.setup_state.json', '.fleet_manifest.json')
+
+def hash_stream(fh, chunk_size=1 << 20):
+  hasher = hashlib.sha256()
+  size = 0
+  for b in iter(lambda: fh.read(chunk_size), b''):
+    hasher.update(b)
+    size += len(b)
+  return size, hasher.hexdigest()
+
+def iter_archive_members(blob_path, kind):
+  # (member name, size, sha256) of every regular file, read in archive order
+  if kind == 'zip':
+    with ZipFile(blob_path) as zh:
+      for info in zh.infolist():
+        if info.is_dir():
+          continue
+        with zh.open(info) as fh:
+          yield (info.filename,) + hash_stream(fh)
+  elif kind == 'tar':
+    with tarfile.open(blob_path, mode='r') as th:
+      for member in th:
+        if member.isfile():
+          yield (member.name,) + hash_stream(th.extractfile(member))
+  else:
+    yield '', os.path.getsize(blob_path), sha256_file(blob_path)
+
+class BlobManifests:
+  # member hashes of a cached blob never change, so each blob is read once and the result kept next to the cache
+  def __init__(self, manifest_dir):
+    self.manifest_dir = manifest_dir
+    ensure_dir(manifest_dir)
+
+  def path(self, sha256):
+    return os.path.join(self.manifest_dir, '{}.json'.format(sha256))
+
+  def get(self, sha256, blob_path, kind):
+    path = self.path(sha256)
+    if isfile(path):
+      try:
+        with open(path, 'r') as fh:
+          manifest = json.load(fh)
+        if manifest.get('version') == manifest_version and manifest.get('kind') == kind:
+          return manifest['members']
+      except (OSError, ValueError):
+        pass
+    members = [[name, size, digest] for name, size, digest in iter_archive_members(blob_path, kind)]
+    fd, tmp_path = tempfile.mkstemp(dir=self.manifest_dir, suffix='.json')
+    with os.fdopen(fd, 'w') as fh:
+      json.dump({'version': manifest_version, 'kind': kind, 'members': members}, fh)
+    os.replace(tmp_path, path)
+    return members
+
+def expected_files(install_state, cache, manifests, extract_paths=None):
+  # what the install state says should be on disk, with contents taken from the cached blob when it still matches,
+  # a path installed by several owners keeps one entry per owner
+  extract_paths = extract_paths or dict()
+  expected = dict()
+  unverifiable = 0
+  for kind_name, ents in list(install_state.state.items()):
+    for key, ent in list(ents.items()):
+      owner = '{}:{}'.format(kind_name, key)
+      for resource in ent.get('resources', []):
+        known = dict()
+        entry = cache.lookup(resource['url']) if 'url' in resource else None
+        extract_path = resource.get('extract_path', extract_paths.get(resource.get('url')))
+        if not entry is None and entry['sha256'] == resource.get('sha256') and not extract_path is None:
+          blob_path = cache.blob_path(entry['sha256'])
+          info = file_info_t(**entry['file_info'])
+          kind = archive_kind(info)
+          try:
+            members = manifests.get(entry['sha256'], blob_path, kind)
+          except (OSError, tarfile.TarError, BadZipFile, ValueError) as e:
+            logger.warning('cannot read cached blob {}: {}'.format(blob_path, e))
+            members = list()
+          for name, size, digest in members:
+            if kind is None:
+              name = info.file_name
+            dst_path = sanitize_member_path(install_state.abs_path(extract_path) if extract_path else install_state.app_dir, name)
+            if not dst_path is None:
+              known[install_state.rel_path(dst_path)] = (size, digest, (blob_path, kind, name))
+        for rel_path in resource.get('files', []):
+          size, digest, source = known.get(rel_path, (None, None, None))
+          unverifiable += int(source is None)
+          expected.setdefault(rel_path, list()).append(expected_t(rel_path, owner, size, digest, source))
+  if unverifiable:
+    logger.info('{} installed files have no cached source, only their presence is checked'.format(unverifiable))
+  return expected
+
+def check_file(install_state, claims):
+  # owners installing the same content are interchangeable, otherwise concurrent extraction leaves no telling
+  # which of them wrote the file last, so it only has to match one of them and is never repaired from a guess
+  if len(set((exp.size, exp.sha256) for exp in claims)) > 1:
+    return check_overlap(install_state, claims)
+  exp = claims[0]
+  path = install_state.abs_path(exp.rel_path)
+  try:
+    st = os.stat(path)
+  except OSError:
+    return verify_result_t(exp.rel_path, 'missing', exp.owner, exp.source)
+  if exp.sha256 is None:
+    return verify_result_t(exp.rel_path, 'unverified', exp.owner, exp.source)
+  # a size mismatch already decides it, only same-sized files are hashed
+  if st.st_size != exp.size or sha256_file(path) != exp.sha256:
+    return verify_result_t(exp.rel_path, 'modified', exp.owner, exp.source)
+  return verify_result_t(exp.rel_path, 'ok', exp.owner, exp.source)
+
+def check_overlap(install_state, claims):
+  rel_path = claims[0].rel_path
+  owners = ', '.join(exp.owner for exp in claims)
+  path = install_state.abs_path(rel_path)
+  try:
+    st = os.stat(path)
+  except OSError:
+    return verify_result_t(rel_path, 'ambiguous', owners, None)
+  digest = sha256_file(path)
+  for exp in claims:
+    if exp.size == st.st_size and exp.sha256 == digest:
+      return verify_result_t(rel_path, 'ok', exp.owner, exp.source)
+  if any(exp.sha256 is None for exp in claims):
+    return verify_result_t(rel_path, 'unverified', owners, None)
+  return verify_result_t(rel_path, 'ambiguous', owners, None)
+
+def find_extra(install_state, expected):
+  # only directories that hold installed files are scanned, and not recursively, the rest of the tree is not ours to judge
+  dirs = set(os.path.dirname(install_state.abs_path(rel_path)) for rel_path in expected)
+  extra = list()
+  for dir_path in sorted(dirs):
+    if not isdir(dir_path):
+      continue
+    with os.scandir(dir_path) as it:
+      for ent in it:
+        if not ent.is_file(follow_symlinks=False) or ent.name in ignored_names:
+          continue
+        rel_path = install_state.rel_path(ent.path)
+        if not rel_path in expected:
+          extra.append(verify_result_t(rel_path, 'extra', None, None))
+  return extra
+
+def verify_tree(install_state, cache, manifests, workers=1, extract_paths=None):
+  t0 = time.time()
+  expected = expected_files(install_state, cache, manifests, extract_paths)
+  results = run_ordered(lambda rel_path: check_file(install_state, expected[rel_path]), sorted(expected), workers, 'verify')
+  results += find_extra(install_state, expected)
+  counts = dict()
+  for result in results:
+    counts[result.status] = counts.get(result.status, 0) + 1
+    metrics.count('verify_files_total', status=result.status)
+  logger.info('verified {} files in {:.02f}s: {}'.format(len(expected), time.time() - t0, ', '.join('{} {}'.format(n, status) for status, n in sorted(counts.items()))))
+  return results
+
+def repair_files(install_state, results):
+  # only diverged files are restored, each blob is opened once and read up to the last member it has to restore
+  by_blob = dict()
+  for result in results:
+    if result.status in ('missing', 'modified') and not result.source is None:
+      blob_path, kind, name = result.source
+      by_blob.setdefault((blob_path, kind), dict())[name] = install_state.abs_path(result.rel_path)
+  repaired = list()
+  for (blob_path, kind), members in by_blob.items():
+    try:
+      if kind == 'zip':
+        with ZipFile(blob_path) as zh:
+          for info in zh.infolist():
+            if info.filename in members:
+              with zh.open(info) as src_fh:
+                write_atomic(src_fh, members[info.filename], time.mktime(info.date_time + (0, 0, -1)), (info.external_attr >> 16) & 0o777)
+              repaired.append(members[info.filename])
+      elif kind == 'tar':
+        pending = dict(members)
+        with tarfile.open(blob_path, mode='r') as th:
+          for member in th:
+            if member.name in pending and member.isfile():
+              write_atomic(th.extractfile(member), pending.pop(member.name), member.mtime, member.mode & 0o777)
+              repaired.append(members[member.name])
+              if not pending:
+                break
+      else:
+        for dst_path in members.values():
+          with open(blob_path, 'rb') as src_fh:
+            write_atomic(src_fh, dst_path)
+          repaired.append(dst_path)
+    except (OSError, tarfile.TarError, BadZipFile, ValueError) as e:
+      logger.error('cannot repair from {}: {}'.format(blob_path, e))
+  metrics.count('repaired_files_total', len(repaired))
+  logger.info('repaired {} files'.format(len(repaired)))
+  return repaired
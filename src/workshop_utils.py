@@ -0,0 +1,129 @@
+import os
+import json
+import tempfile
+import threading
+from time import time
+from collections import namedtuple, deque
+from src.log import init_logger
+from src.path_utils import isfile
+from src.http_utils import http_request
+
+logger = init_logger('workshop_utils', 'setup.log')
+workshop_tree_t = namedtuple('WorkshopTree', ['roots', 'items'])
+
+db_hostname = 'https://db.steamworkshopdownloader.io'
+db_api_path = 'prod/api/details/file'
+
+def is_collection(details):
+  return details.get('show_subscribe_all', False) and not details.get('can_subscribe', False)
+
+def iter_children_ids(details):
+  for child in details.get('children') or []:
+    child_id = child.get('publishedfileid')
+    if not child_id is None:
+      yield str(child_id)
+
+class WorkshopResolver:
+  def __init__(self, session, cache_path, ttl=3600, batch_size=100):
+    self.session = session
+    self.cache_path = cache_path
+    self.ttl = ttl
+    self.batch_size = max(batch_size, 1)
+    self._lock = threading.Lock()
+    self.cache = dict()
+    self.load()
+
+  def load(self):
+    if not isfile(self.cache_path):
+      return
+    try:
+      with open(self.cache_path, 'r') as fh:
+        self.cache.update(json.load(fh))
+    except (ValueError, OSError) as e:
+      logger.warning('discarding unreadable workshop metadata cache: {}'.format(e))
+
+  def save(self):
+    with self._lock:
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.cache_path)), suffix='.json')
+      with os.fdopen(fd, 'w') as fh:
+        json.dump(self.cache, fh)
+      os.replace(tmp_path, self.cache_path)
+
+  def seed(self, details_by_id):
+    # metadata shipped with a prefetch bundle counts as freshly fetched, the upstream api is only asked for the rest
+    now = time()
+    for workshop_id, details in details_by_id.items():
+      if self.cached(workshop_id) is None:
+        self.cache[workshop_id] = {'fetched_at': now, 'details': details}
+
+  def cached(self, workshop_id):
+    ent = self.cache.get(workshop_id)
+    if ent is None or time() - ent['fetched_at'] > self.ttl:
+      return None
+    return ent['details']
+
+  def fetch_details(self, workshop_ids):
+    fetched = dict()
+    for i in range(0, len(workshop_ids), self.batch_size):
+      batch = workshop_ids[i:i + self.batch_size]
+      logger.info('retrieving workshop info: {} items'.format(len(batch)))
+      data = bytes(json.dumps([int(workshop_id) for workshop_id in batch]), 'utf8')
+      db_resp = http_request(self.session, 'POST', url='{}/{}'.format(db_hostname, db_api_path), data=data)
+      if db_resp is None:
+        logger.warning('cannot retrieve workshop info: {}'.format(', '.join(batch)))
+        continue
+      for n, details in enumerate(db_resp.json()):
+        workshop_id = str(details.get('publishedfileid', batch[n] if n < len(batch) else ''))
+        if not workshop_id:
+          continue
+        previous = self.cache.get(workshop_id, {}).get('details', {})
+        if previous and previous.get('time_updated') != details.get('time_updated'):
+          logger.info('workshop item updated: {}'.format(workshop_id))
+        fetched[workshop_id] = details
+        self.cache[workshop_id] = {'fetched_at': time(), 'details': details}
+    if fetched:
+      self.save()
+    return fetched
+
+  def resolve(self, workshop_ids):
+    # breadth-first over collections, every id is looked up at most once per resolve
+    root_ids = [str(workshop_id) for workshop_id in workshop_ids]
+    nodes = dict()
+    visited = set()
+    level = deque(dict.fromkeys(root_ids))
+    while level:
+      pending = [workshop_id for workshop_id in level if not workshop_id in visited]
+      visited.update(pending)
+      missing = list()
+      for workshop_id in pending:
+        details = self.cached(workshop_id)
+        if details is None:
+          missing.append(workshop_id)
+        else:
+          nodes[workshop_id] = details
+      nodes.update(self.fetch_details(missing))
+      level = deque()
+      for workshop_id in pending:
+        details = nodes.get(workshop_id)
+        if not details is None and is_collection(details):
+          level.extend(child_id for child_id in iter_children_ids(details) if not child_id in visited)
+
+    roots = dict()
+    for root_id in root_ids:
+      leaves = list()
+      seen = set()
+      stack = [root_id]
+      while stack:
+        workshop_id = stack.pop()
+        if workshop_id in seen:
+          continue
+        seen.add(workshop_id)
+        details = nodes.get(workshop_id)
+        if not details is None and is_collection(details):
+          stack.extend(reversed(list(iter_children_ids(details))))
+        else:
+          leaves.append(workshop_id)
+      roots[root_id] = leaves
+    items = {workshop_id: details for workshop_id, details in nodes.items() if not is_collection(details)}
+    logger.info('resolved {} workshop ids into {} items'.format(len(root_ids), len(items)))
+    return workshop_tree_t(roots, items)